@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Compares the period estimators of lidar.period_estimators with the curve_fit of pendulum_equation() for CPU time
+and accuracy in sec/day (the error of the period times the ticks in a day, as analyze_clock_rate() counts them).
+
+The synthetic windows are a sine at a random period near --period (2 sec) sampled at the LIDAR's scan rate, with jitter in the
+scan times, scans where the pendulum wasn't found, noise, and the odd outlier. Recorded points (--points; a .npy
+of NANOS_FIRST_N_LAST_DTYPE or a text file of time, first, last rows) are cut into windows of --window seconds and,
+having no known period, are compared with curve_fit. The estimators search --band of --period either side of it, as
+they do [Fit] PERIOD_BAND of [Tracker] PERIOD in monitor_pendulum.py.
+
+The cheapest estimator whose worst error is within --target sec/day is shown for each window length.
+"""
+import time
+import argparse
+import numpy as np
+from lidar.fit_sine_with_fft_guess import pendulum_equation
+from lidar.period_estimators import PERIOD_ESTIMATORS, PERIOD_BAND, period_band, estimate_period
+
+SCAN_HZ = 14.2
+SECONDS_PER_DAY = 86400.0
+IDEAL_PERIOD = 2.0
+
+
+def sec_per_day(period_error, ideal_period=IDEAL_PERIOD):
+    return period_error * SECONDS_PER_DAY / ideal_period
+
+
+def make_window(rng, seconds, noise_mm=3.0, missed=0.05, outliers=0.005, ideal_period=IDEAL_PERIOD):
+    """A synthetic window in the format of pendulum_equation() and its period."""
+    period = ideal_period * (1.0 + rng.uniform(-0.005, 0.005))
+    t = 1.0e5 + np.arange(0.0, seconds, 1.0 / SCAN_HZ)
+    t = t + rng.normal(0.0, 0.002, len(t))
+    t = t[rng.random(len(t)) > missed]
+    theta = -20.0 + 100.0 * np.sin(2.0 * np.pi * t / period + rng.uniform(0.0, 2.0 * np.pi))
+    theta += rng.normal(0.0, noise_mm, len(t))
+    bad = rng.random(len(t)) < outliers
+    theta[bad] += rng.normal(0.0, 60.0, bad.sum())
+    return list(zip(t, theta, theta + 200.0)), period
+
+
+def curve_fit_period(data, index):
+    return pendulum_equation(data, index)[0]
+
+
+def estimators(ideal_period=IDEAL_PERIOD, band=PERIOD_BAND):
+    methods = {'curve_fit': curve_fit_period}
+    min_period, max_period = period_band(ideal_period, band)
+    for name in PERIOD_ESTIMATORS:
+        methods[name] = lambda data, index, name=name: estimate_period(data, index, name, min_period, max_period)[0]
+    return methods
+
+
+def run(windows, methods, ideal_period=IDEAL_PERIOD):
+    """{method: (seconds per window, [errors in sec/day])} of the windows of (data, reference period)."""
+    results = {}
+    for name, method in methods.items():
+        errors = []
+        start = time.perf_counter()
+        for data, period in windows:
+            errors.append(sec_per_day(method(data, 1) - period, ideal_period))
+        results[name] = ((time.perf_counter() - start) / len(windows), errors)
+    return results
+
+
+def report(label, results, target):
+    print(f"{label}")
+    print(f"{'estimator':>14} {'ms':>9} {'rms s/day':>10} {'max s/day':>10}")
+    meeting = []
+    for name, (seconds, errors) in results.items():
+        errors = np.abs(errors)
+        rms, worst = float(np.sqrt(np.mean(errors ** 2))), float(errors.max())
+        print(f"{name:>14} {seconds * 1e3:>9.2f} {rms:>10.4f} {worst:>10.4f}")
+        if worst <= target:
+            meeting.append((seconds, name))
+    print(f"cheapest within {target} s/day: {min(meeting)[1] if meeting else 'none'}\n")
+
+
+def recorded_windows(path, seconds):
+    if path.endswith('.npy'):
+        points = np.load(path)
+        if points.dtype.names:
+            points = np.column_stack([points[name] for name in points.dtype.names[:3]])
+    else:
+        points = np.loadtxt(path, delimiter=',' if path.endswith('.csv') else None)
+    edges = np.searchsorted(points[:, 0], np.arange(points[0, 0], points[-1, 0], seconds))
+    windows = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        data = [tuple(row) for row in points[start:stop, :3]]
+        if len(data) > 20:
+            # curve_fit is the reference
+            windows.append((data, curve_fit_period(data, 1)))
+    return windows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the period estimators.")
+    parser.add_argument("--trials", type=int, default=20, help="Synthetic windows of each length.")
+    parser.add_argument("--target", type=float, default=1.0, help="Accuracy target (sec/day).")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--points", help="Recorded (time, first, last) points to use instead.")
+    parser.add_argument("--window", type=float, default=300.0, help="Seconds per window of the recorded points.")
+    parser.add_argument("--period", type=float, default=IDEAL_PERIOD, help="[Tracker] PERIOD (sec/cycle).")
+    parser.add_argument("--band", type=float, default=PERIOD_BAND, help="[Fit] PERIOD_BAND.")
+    args = parser.parse_args()
+
+    methods = estimators(args.period, args.band)
+    if args.points:
+        report(f"{args.points} in {args.window:.0f} sec windows (error against curve_fit)",
+               run(recorded_windows(args.points, args.window), methods, args.period), args.target)
+    else:
+        rng = np.random.default_rng(args.seed)
+        for seconds, trials in ((60.0, args.trials), (300.0, args.trials), (3600.0, max(args.trials // 5, 1))):
+            windows = [make_window(rng, seconds, ideal_period=args.period) for _ in range(trials)]
+            report(f"{seconds:.0f} sec windows, {trials} trials", run(windows, methods, args.period), args.target)
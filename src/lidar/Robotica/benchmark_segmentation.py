@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmarks find_consecutive_proximal_points() against the list based implementation it replaced.
+
+The scans are made by lidar.rplidar_emulator.PendulumScene with the samples per revolution of the Standard, Express,
+and Boost scan modes. The LIDAR sends a scan about every 1/15 sec and each one is segmented in a subprocess, so
+the time per scan is also shown as a fraction of that budget.
+"""
+import math
+import time
+import argparse
+import numpy as np
+from lidar.const import lidar_readings_to_cartesian
+from lidar.rplidar_protocol import SCAN_DTYPE
+from lidar.rplidar_emulator import PendulumScene
+from lidar.find_proximal_points import find_consecutive_proximal_points, segment_scan
+
+SCAN_BUDGET_SEC = 1.0 / 15.0
+
+
+def _list_segments(scan, scan_radius_mm, threshold=25.0, min_segment_len=4):
+    """The list based find_consecutive_proximal_points() (with the first/last join guarded)."""
+    if isinstance(scan, np.ndarray):
+        scan = scan.tolist()
+    scan = [(x[0], 360.0 - x[1], x[2]) for x in scan if x[2] < scan_radius_mm]
+    scan = sorted(scan, key=lambda x: x[1])
+    points = lidar_readings_to_cartesian(scan)
+    if not points or len(points) < 2:
+        return []
+    points_arr = np.array(points)
+    diffs = points_arr[1:] - points_arr[:-1]
+    distances = np.sqrt(np.sum(diffs ** 2, axis=1))
+    break_indices = np.where(distances > threshold)[0] + 1
+    segments = np.split(points_arr, break_indices)
+    consecutive_segments = [segment.tolist() for segment in segments if len(segment) >= min_segment_len]
+    if len(consecutive_segments) > 1 and math.dist(points[0], points[-1]) <= threshold:
+        consecutive_segments = [consecutive_segments[-1] + consecutive_segments[0]] + consecutive_segments[1:-1]
+    return consecutive_segments
+
+
+def make_scans(samples, count, seed=1):
+    scene = PendulumScene(seed=seed)
+    scans = []
+    for i in range(count):
+        quality, angle, distance = scene.revolution(i / 14.2, samples, 14.2)
+        scan = np.empty(samples, dtype=SCAN_DTYPE)
+        scan['quality'], scan['angle'], scan['distance'] = quality, angle, distance
+        # As the drivers do, drop the samples without a reading
+        scans.append(scan[distance > 0])
+    return scans
+
+
+def per_scan_seconds(func, scans, scan_radius_mm, repeat):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for scan in scans:
+            func(scan, scan_radius_mm)
+        best = min(best, (time.perf_counter() - start) / len(scans))
+    return best
+
+
+def same_segments(a, b):
+    return len(a) == len(b) and all(np.allclose(x, y) for x, y in zip(a, b))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the scan segmentation.")
+    parser.add_argument("--scans", type=int, default=200, help="Scans per scan mode.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each; the best is shown.")
+    parser.add_argument("--radius", type=float, default=500.0, help="SCAN_RADIUS_MM")
+    args = parser.parse_args()
+
+    # 'kernel' is segment_scan() alone, without making the lists of points
+    print(f"{'samples':>8} {'lists us':>10} {'arrays us':>10} {'kernel us':>10} {'speedup':>8} {'budget':>8}"
+          f" {'same':>8}")
+    for samples in (400, 800, 1600, 3200):
+        scans = make_scans(samples, args.scans)
+        same = sum(same_segments(_list_segments(scan, args.radius), find_consecutive_proximal_points(scan, args.radius))
+                   for scan in scans)
+        old = per_scan_seconds(_list_segments, scans, args.radius, args.repeat)
+        new = per_scan_seconds(find_consecutive_proximal_points, scans, args.radius, args.repeat)
+        kernel = per_scan_seconds(segment_scan, scans, args.radius, args.repeat)
+        print(f"{samples:>8} {old * 1e6:>10.1f} {new * 1e6:>10.1f} {kernel * 1e6:>10.1f} {old / new:>7.1f}x"
+              f" {new / SCAN_BUDGET_SEC:>7.2%} {same:>4}/{len(scans)}")
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the hot paths of the LIDAR analysis, so the hardware monitor_pendulum.py is deployed on can be chosen from
+numbers, and keeps a baseline of them to flag the changes that make them slower.
+
+The scans are made by lidar.rplidar_emulator.PendulumScene (see benchmark_segmentation.py), or are those of a
+recording made with [ScanSource] RECORD_FILE (--recording; it is replayed over again, its times advanced,
+when a scenario is longer than it).
+
+functions: the time of each call of find_consecutive_proximal_points(), find_dissimilar_scans(),
+  least_squares.is_on_arc(), and HampelFilter.update() (of each scan, pair of scans, and pendulum found), and of
+  remove_outliers_zscore(), zscore_mask() (of both edges), and pendulum_equation() (of each 5 minute window that
+  pendulum_info_min_process() is given), the calls a second, and
+  the time a scan of each as a fraction of the 1/15 sec between scans.
+scenarios: the pipeline of run_scanner() over a minute and an hour of scans in this one process: segmenting each
+  scan and finding the pendulum in it, the spike filter, the StreamingSineFit, BeatTimer, and Rollup of each batch of detections, and
+  the outliers and period of each 5 minute window. The CPU seconds of each stage per second of scans is the share
+  of a core it needs; the total is the cores needed to keep up (more when the workers are busy with other scans).
+
+--save-baseline writes the results to a JSON file; --baseline compares them with one and exits with 1 when any of
+them took more than --tolerance longer than it did.
+"""
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import itertools
+from datetime import datetime
+import numpy as np
+from lidar.scan_source import read_recording
+from lidar.find_proximal_points import find_consecutive_proximal_points, find_dissimilar_scans
+from lidar.pendulum_tracker import segment_polar
+from lidar.least_squares import is_on_arc
+from lidar.remove_outliers import remove_outliers_zscore, zscore_mask, HampelFilter
+from lidar.fit_sine_with_fft_guess import pendulum_equation, StreamingSineFit
+from lidar.period_estimators import PERIOD_ESTIMATORS, PERIOD_BAND, period_band, estimate_period
+from lidar.beat_timer import BeatTimer
+from lidar.rollup import Rollup
+from lidar.rplidar_protocol import SCAN_DTYPE
+from lidar.rplidar_emulator import PendulumScene
+from lidar.Robotica.benchmark_segmentation import SCAN_BUDGET_SEC
+from lidar.Robotica.benchmark_period import make_window
+
+SCAN_HZ = 14.2
+# The points of a window of pendulum_info_min_process() (APPLY_ASYNC_WITH_N * 5 in monitor_pendulum.py)
+WINDOW_POINTS = int(SCAN_HZ * 60.0 * 5.0)
+# Detections handed to the StreamingSineFit, BeatTimer, and Rollup at a time (a batch of run_scanner())
+BATCH = 16
+SCENARIOS = {'minute': 60.0, 'hour': 3600.0}
+
+
+def synthetic_scans(samples, seed=1):
+    """Endless (time, scan) of PendulumScene with 'samples' samples per revolution (as make_scans() makes them)."""
+    scene = PendulumScene(seed=seed)
+    for i in itertools.count():
+        t = i / SCAN_HZ
+        quality, angle, distance = scene.revolution(t, samples, SCAN_HZ)
+        scan = np.empty(samples, dtype=SCAN_DTYPE)
+        scan['quality'], scan['angle'], scan['distance'] = quality, angle, distance
+        yield t, scan[distance > 0]
+
+
+def recorded_scans(path):
+    """Endless (time, scan) of a recording, replayed over again with its times advanced."""
+    offset = 0.0
+    while True:
+        last = None
+        for scan_time, scan in read_recording(path):
+            if last is None:
+                first = scan_time
+            last = scan_time
+            yield scan_time + offset, scan
+        if last is None:
+            raise ValueError(f"{path} has no scans")
+        offset += last - first + 1.0 / SCAN_HZ
+
+
+def detect(previous, segments):
+    """The pendulum's points from the segments of consecutive scans; None when it wasn't found."""
+    found = find_dissimilar_scans(previous, segments)
+    if len(found) > 1:
+        return found
+    return None
+
+
+def best_seconds(func, args, repeat):
+    """The least seconds a call of func over each of args took in 'repeat' runs."""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            func(*arg)
+        best = min(best, (time.perf_counter() - start) / len(args))
+    return best
+
+
+def benchmark_functions(scans, window, radius, repeat):
+    """{name: (seconds per call, scans per call)} of the hot functions."""
+    segments = [find_consecutive_proximal_points(scan, radius) for _, scan in scans]
+    pairs = list(zip(segments, segments[1:]))
+    pendulums = [found for found in (detect(a, b) for a, b in pairs) if found is not None]
+    results = {
+        'find_consecutive_proximal_points': (best_seconds(find_consecutive_proximal_points,
+                                                          [(scan, radius) for _, scan in scans], repeat), 1),
+        'find_dissimilar_scans': (best_seconds(find_dissimilar_scans, pairs, repeat), 1),
+        'segment_polar': (best_seconds(segment_polar, [(found,) for found in pendulums], repeat), 1),
+    }
+    if pendulums:
+        results['least_squares.is_on_arc'] = (best_seconds(is_on_arc, [(np.array(found), 3.0)
+                                                                       for found in pendulums], repeat), 1)
+    # The window functions are called once for each WINDOW_POINTS scans
+    results['remove_outliers_zscore'] = (best_seconds(remove_outliers_zscore, [(window, 1)], repeat), len(window))
+    columns = np.array(window)[:, 1:]
+    results['zscore_mask'] = (best_seconds(zscore_mask, [(columns,)], repeat), len(window))
+    results['pendulum_equation'] = (best_seconds(pendulum_equation, [(window, 1)], repeat), len(window))
+    spike_filter = HampelFilter(columns=2)
+    results['HampelFilter.update'] = (best_seconds(spike_filter.update, [(t, (first, last))
+                                                                          for t, first, last in window], 1), 1)
+    return results
+
+
+def synthetic_window(seed):
+    window, _ = make_window(np.random.default_rng(seed), WINDOW_POINTS / SCAN_HZ)
+    return window
+
+
+def recorded_window(scans, radius):
+    """The detections of the scans as a window of (time, first, last)."""
+    window = []
+    previous = None
+    for t, scan in scans:
+        segments = find_consecutive_proximal_points(scan, radius)
+        if previous is not None:
+            found = detect(previous, segments)
+            if found is not None:
+                window.append((t, found[0][1], found[-1][1]))
+        previous = segments
+    return window
+
+
+def window_period(window, estimator, min_period=1.9, max_period=2.1):
+    """The outliers and periods of a window as pendulum_info_min_process() finds them."""
+    points = np.array(window)
+    kept = zscore_mask(points[:, 1:])
+    first, last = points[kept[:, 0]].tolist(), points[kept[:, 1]].tolist()
+    if estimator == 'curve_fit':
+        return pendulum_equation(first, 1)[0], pendulum_equation(last, 2)[0]
+    return (estimate_period(first, 1, estimator, min_period, max_period)[0],
+            estimate_period(last, 2, estimator, min_period, max_period)[0])
+
+
+def run_scenario(source, seconds, radius, estimator, period=2.0, band=PERIOD_BAND):
+    """
+    The seconds of scans from source through the pipeline, of a pendulum expected to have 'period' ([Tracker]
+    PERIOD; [Fit] PERIOD_BAND). Returns ({stage: CPU seconds}, seconds of scans, scans, detections); making the scans
+    isn't counted.
+    """
+    stages = dict.fromkeys(('segment', 'find_pendulum', 'stream', 'window'), 0.0)
+    spike_filter = HampelFilter(min_sigma=3.0, columns=2)
+    sine_fit = StreamingSineFit(period, history_seconds=600.0)
+    beat_timer = BeatTimer(period=period)
+    rollup = Rollup(period)
+    search_band = period_band(period, band)
+    previous, batch, window = None, [], []
+    failures = sine_fit_blocks = scans = detections = 0
+    first = last = None
+    clock = time.perf_counter
+    for t, scan in source:
+        if first is None:
+            first = t
+        if t - first >= seconds:
+            break
+        last = t
+        scans += 1
+        start = clock()
+        segments = find_consecutive_proximal_points(scan, radius)
+        segmented = clock()
+        found = detect(previous, segments) if previous is not None else None
+        if found is not None:
+            # find_pendulum_process() also keeps its polar extent
+            segment_polar(found)
+            for t, edges, _, outliers in spike_filter.update(t, (found[0][1], found[-1][1])):
+                if any(outliers):
+                    failures += 1
+                else:
+                    batch.append((t, edges[0], edges[1]))
+                    detections += 1
+        else:
+            failures += 1
+        previous = segments
+        detected = clock()
+        stages['segment'] += segmented - start
+        stages['find_pendulum'] += detected - segmented
+        if len(batch) >= BATCH:
+            points = np.array(batch)
+            for row in batch:
+                sine_fit.add(row[0], row[1])
+            rollup.add_points(points[:, 0], points[:, 1], points[:, 2], failures)
+            rollup.add_blocks(sine_fit.blocks_since(sine_fit_blocks))
+            sine_fit_blocks = sine_fit.block_count
+            rollup.add_beats(beat_timer.update(points[:, 0], points[:, 1], points[:, 2]))
+            window += batch
+            batch, failures = [], 0
+            streamed = clock()
+            stages['stream'] += streamed - detected
+            if len(window) >= WINDOW_POINTS:
+                window_period(window, estimator, *search_band)
+                window = []
+                stages['window'] += clock() - streamed
+    if len(window) > 2.0 * SCAN_HZ:
+        # A scenario shorter than a window has the cost of the window of what it has
+        start = clock()
+        window_period(window + batch, estimator, *search_band)
+        stages['window'] += clock() - start
+    return stages, (last - first + 1.0 / SCAN_HZ) if first is not None else 0.0, scans, detections
+
+
+def machine():
+    return {'platform': platform.platform(), 'processor': platform.processor() or platform.machine(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def compare(results, baseline, tolerance):
+    """The names of the results that took more than tolerance longer than the baseline, printed with both."""
+    regressions = []
+    print(f"\nAgainst the baseline of {baseline.get('created', '?')} on {baseline.get('machine', {}).get('platform')}")
+    print(f"{'result':>44} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, value in results.items():
+        old = baseline.get('results', {}).get(name)
+        if old is None or old <= 0.0:
+            continue
+        change = value / old - 1.0
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print(f"{name:>44} {old:>12.6g} {value:>12.6g} {change:>+7.1%}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the LIDAR analysis hot paths and pipeline.")
+    parser.add_argument("--recording", help="A scan recording to use instead of synthetic scans.")
+    parser.add_argument("--samples", type=int, default=800, help="Samples per revolution of the synthetic scans.")
+    parser.add_argument("--scans", type=int, default=300, help="Scans the functions are timed over.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each function; the best is shown.")
+    parser.add_argument("--radius", type=float, default=500.0, help="SCAN_RADIUS_MM")
+    parser.add_argument("--estimator", default='curve_fit', choices=['curve_fit'] + list(PERIOD_ESTIMATORS),
+                        help="[Fit] MINUTE_ESTIMATOR of the scenarios.")
+    parser.add_argument("--period", type=float, default=2.0, help="[Tracker] PERIOD of the scenarios.")
+    parser.add_argument("--period-band", type=float, default=PERIOD_BAND, help="[Fit] PERIOD_BAND of the scenarios.")
+    parser.add_argument("--scenarios", default='minute,hour', help="Of: " + ', '.join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown that is flagged (0.25 is 25%%).")
+    args = parser.parse_args()
+
+    def source():
+        return recorded_scans(args.recording) if args.recording else synthetic_scans(args.samples, args.seed)
+
+    results = {}
+    scans = list(itertools.islice(source(), args.scans))
+    if args.recording:
+        window = recorded_window(itertools.islice(source(), WINDOW_POINTS), args.radius)
+    else:
+        window = synthetic_window(args.seed)
+    print(f"{args.recording or f'synthetic scans of {args.samples} samples'}; {len(scans)} scans, a window of"
+          f" {len(window)} points")
+    print(f"{'function':>34} {'us/call':>12} {'calls/s':>10} {'us/scan':>10} {'budget':>8}")
+    for name, (seconds, per_call) in benchmark_functions(scans, window, args.radius, args.repeat).items():
+        per_scan = seconds / per_call
+        print(f"{name:>34} {seconds * 1e6:>12.1f} {1.0 / seconds:>10.1f} {per_scan * 1e6:>10.2f}"
+              f" {per_scan / SCAN_BUDGET_SEC:>7.2%}")
+        results[f"function/{name}"] = seconds
+
+    for scenario in filter(None, args.scenarios.split(',')):
+        stages, seconds, count, detections = run_scenario(source(), SCENARIOS[scenario], args.radius, args.estimator,
+                                                          args.period, args.period_band)
+        total = sum(stages.values())
+        print(f"\n{scenario}: {count} scans ({seconds:.0f} sec), the pendulum found in {detections},"
+              f" {total:.2f} CPU sec")
+        print(f"{'stage':>34} {'CPU sec':>12} {'us/scan':>10} {'cores':>8}")
+        for name, cpu in list(stages.items()) + [('total', total)]:
+            print(f"{name:>34} {cpu:>12.3f} {cpu / max(count, 1) * 1e6:>10.1f} {cpu / seconds:>8.3f}")
+            results[f"scenario/{scenario}/{name}"] = cpu / seconds
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'machine': machine(),
+                       'recording': args.recording, 'samples': args.samples, 'estimator': args.estimator,
+                       'results': results}, f, indent=2)
+        print(f"\nBaseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions of more than {args.tolerance:.0%}")
+            sys.exit(1)
@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 
 from rplidar import RPLidar, RPLidarException
-from lidar.const import startup_lidar
+from lidar.scan_source import open_scan_source
+from lidar.scan_reader import ScanReader
+from lidar.shared_ring import SharedRing, attach_ring
+from lidar.telemetry import Telemetry, init_worker, instrumented
+from lidar.rplidar_protocol import SCAN_DTYPE
+from lidar.const import NANOS_FIRST_N_LAST_DTYPE, DETECTION_DTYPE
 from lidar.find_proximal_points import find_consecutive_proximal_points, find_dissimilar_scans
+from lidar.pendulum_tracker import PendulumTracker, find_pendulum_in_roi, segment_polar
+from lidar.background_model import BackgroundModel, attach_background
+from lidar.pendulum_filter import PendulumFilter
+from lidar.beat_timer import BeatTimer
+from lidar.rollup import Rollup
+from lidar.timeseries_store import TimeSeriesStore, StoreWriter
+from lidar.thingspeak_uploader import ThingSpeakUploader
+from lidar.dashboard import serve_dashboard
+from lidar.detection_pipeline import DetectionPipeline
 import numpy as np
 import logging
 import time
@@ -36,17 +50,16 @@ def nanos_str(nanos):
 # https://thingspeak.mathworks.com/channels/3258476/private_show
 # Channel States:  https://thingspeak.mathworks.com/channels/3258476
 # RESR API:  https://www.mathworks.com/help/thingspeak/rest-api.html
-def thingspeak_url_1(pendulum_period, projected_daily_deviation, pendulum_swing,
-                     lidar_readings_hz, pendulum_found_failure_percentage, lidar_restarts,
-                     r_squared, pendulum_width):
+def thingspeak_fields_1(pendulum_period, projected_daily_deviation, pendulum_swing,
+                        lidar_readings_hz, pendulum_found_failure_percentage, lidar_restarts,
+                        r_squared, pendulum_width):
     """https://thingspeak.mathworks.com/channels/3258476/api_keys"""
     # Pendulum Period (sec/cycle), Projected Daily Deviation (sec/day), Pendulum Swing (mm),
     # Pendulum Swing Computed (mm), Pendulum Found Errors, LIDAR Restarts
-    url = (f"https://api.thingspeak.com/update?api_key={write_api_key}"
-           f"&field1={pendulum_period:.4f}&field2={projected_daily_deviation:.3f}&field3={pendulum_swing:.1f}"
-           f"&field4={lidar_readings_hz:.1f}&field5={pendulum_found_failure_percentage:.1f}"
-           f"&field6={pendulum_width:.1f}&field8={r_squared:.4f}"
-           )
+    fields = {'field1': f"{pendulum_period:.4f}", 'field2': f"{projected_daily_deviation:.3f}",
+              'field3': f"{pendulum_swing:.1f}", 'field4': f"{lidar_readings_hz:.1f}",
+              'field5': f"{pendulum_found_failure_percentage:.1f}", 'field6': f"{pendulum_width:.1f}",
+              'field8': f"{r_squared:.4f}"}
     logging.info(f"pendulum_period: {pendulum_period:.4f} (sec/cycle)"
                  f"; projected_daily_deviation: {projected_daily_deviation:.3f} (sec/day)"
                  f"; pendulum_swing: {pendulum_swing:.1f} (mm)"
@@ -56,46 +69,14 @@ def thingspeak_url_1(pendulum_period, projected_daily_deviation, pendulum_swing,
                  f"; R Squared {r_squared:.4f}"
                  f"; Pendulum Width {pendulum_width:.1f}"
                  )
-    return url
+    return fields
 
-import requests
-
-def thingspeak_post(url):
-    """
-    Sending an HTTP POST request to ThingSpeak to update channel data, the server returns a response text that
-    indicates the status of the request, specifically how many entries were successfully written.
-    Response Text:
-    - A Number (e.g., "1", "2", "345"). Meaning: If the post is successful, ThingSpeak returns the Entry ID of the
-      newly created data point.
-    - "0" Meaning: The update failed. This usually indicates an invalid API key, incorrect URL structure, or that
-      the rate limit (maximum one update per second) was exceeded. Free accounts restricted to one update per channel
-      every 15 seconds (4 updates/minute).
-      In this case we will sleep and retry in 15 seconds. This will take a process out of commission for that time,
-      but by adding an extral process this should not be an issue.
-
-    NOTE: With ThingSpeak you can send a maximum of 3 million messages per year (roughly 8,200 messages/day)
-    total across all channels. There is a maximum of 4 channels. Each channel is limited to 8 fields of data.
-    There is a maximum of 1 message every 15 seconds.
-    """
-    try:
-        response = requests.post(url)
-        if response.status_code == 200:
-            try:
-                response_text_int = int(response.text.strip())
-            except ValueError:
-                response_text_int = -1
-            logging.info(f"ThingSpeak: Data sent OK: {response_text_int}")
-            # There should be a more graceful way of handling this...
-            if response_text_int == 0:
-                # The update failed. Retry one time after the minimum ThingSpeak delay...
-                sleep(16)
-                logging.info(f"ThingSpeak: Repeating POST for: {url}")
-                requests.post(url)
-        else:
-            logging.error(f"ThingSpeak: Failed to send data. Status code: {response.status_code}, Response: {response.text}")
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"ThingSpeak: Connection failed: {e}")
+# The fields that the minute and hour processes return are posted to ThingSpeak by a
+# lidar.thingspeak_uploader.ThingSpeakUploader in the main process (rather than by the process itself, which tied
+# it up for the request and the 16 sec retry after the rate limit).
+# NOTE: With ThingSpeak you can send a maximum of 3 million messages per year (roughly 8,200 messages/day)
+# total across all channels. There is a maximum of 4 channels. Each channel is limited to 8 fields of data.
+# There is a maximum of 1 message every 15 seconds.
 
 # This function is called in the main process's result-handling thread
 def error_handler(error):
@@ -109,42 +90,128 @@ def error_handler(error):
     exc_info_tuple = (type(error), error, error.__traceback__)
     logging.error("[ERROR CALLBACK] traceback: ", exc_info=exc_info_tuple)
 
-consecutive_scans_last = None
-pendulum_found_failures: int = 0
-def find_pendulum_process(scan_w_time):
+# The consecutive proximal points of the last few scans this subprocess has segmented; {(ring name, seq): segments}.
+# When a subprocess happens to get consecutive scans the previous scan doesn't have to be segmented again.
+_segments_cache = {}
+SEGMENTS_CACHE_SIZE = 4
+
+def _scan_segments(scan_ring, seq):
+    """find_consecutive_proximal_points() of scan 'seq' in the ring as (time, segments); None if it isn't there."""
+    key = (scan_ring.name, seq)
+    cached = _segments_cache.get(key)
+    if cached is not None:
+        return cached
+    scan_w_time = scan_ring.read(seq)
+    if scan_w_time is None:
+        return None
+    cached = (scan_w_time[0], find_consecutive_proximal_points(scan_w_time[1], lidar_scan_radius_mm))
+    if len(_segments_cache) >= SEGMENTS_CACHE_SIZE:
+        del _segments_cache[next(iter(_segments_cache))]
+    _segments_cache[key] = cached
+    return cached
+
+def _find_pendulum(scan_ring, seq, roi, background):
     """
     This function is used to find the Pendulum (only moving thing) in the LIDAR scan.
+    The scan is read from the shared memory scan ring by its sequence number, and it is compared with the scan
+    before it in the ring (seq - 1) so that the result doesn't depend on which subprocess gets which scan.
+    The result is (time, pendulum points); the points are [] when there is no previous scan and have a length
+    of 1 when the pendulum wasn't found. The time is None when the scan had been overwritten in the ring.
+    When the pendulum is being tracked 'roi' is the region of the scan where it is predicted to be (see
+    lidar.pendulum_tracker); only that region is searched and the previous scan isn't needed.
+    With a 'background' the scan updates the lidar.background_model.BackgroundModel, and once it has been
+    learned the pendulum is what stands out from the background.
+    """
+    if background is not None:
+        scan_w_time = scan_ring.read(seq)
+        if scan_w_time is None:
+            logging.warning(f"Scan {seq} was overwritten in the scan ring before it was processed")
+            return None, []
+        if background.ready:
+            scan_data_diff = background.find_pendulum(scan_w_time[1], lidar_scan_radius_mm)
+            background.update(scan_w_time[1], lidar_scan_radius_mm)
+            return scan_w_time[0], scan_data_diff
+        background.update(scan_w_time[1], lidar_scan_radius_mm)
+    if roi is not None:
+        scan_w_time = scan_ring.read(seq)
+        if scan_w_time is None:
+            logging.warning(f"Scan {seq} was overwritten in the scan ring before it was processed")
+            return None, []
+        return scan_w_time[0], find_pendulum_in_roi(scan_w_time[1], roi, lidar_scan_radius_mm)
+    current = _scan_segments(scan_ring, seq)
+    if current is None:
+        # The ring wrapped around before this worker got to the scan
+        logging.warning(f"Scan {seq} was overwritten in the scan ring before it was processed")
+        return None, []
+    nanos, consecutive_scans = current
+    previous = _scan_segments(scan_ring, seq - 1) if seq > 0 else None
+    if previous is None:
+        return nanos, []
+    scan_data_diff = find_dissimilar_scans(previous[1], consecutive_scans)
+    logging.debug(f"Found pendulum points: {len(scan_data_diff)}")
+    return nanos, scan_data_diff
+
+@instrumented
+def find_pendulum_process(scan_ring_spec, first_seq, count, rois=None, background_spec=None):
+    """
+    Find the pendulum in the 'count' consecutive scans of the scan ring from first_seq (see _find_pendulum()); a
+    batch of scans is one task so that the cost of a task is shared by the scans. 'rois' is the region of interest
+    of each scan or None.
+    The result is an array of DETECTION_DTYPE with a row for each scan.
     NOTE: any exceptions that happened here will not be propagated to the caller.
     """
-    global consecutive_scans_last, pendulum_found_failures
-    nanos = scan_w_time[0]
-    consecutive_scans = find_consecutive_proximal_points(scan_w_time[1], lidar_scan_radius_mm)
-    if consecutive_scans_last is None:
-        consecutive_scans_last = consecutive_scans
-        return 0, nanos, []
-    scan_data_diff = find_dissimilar_scans(consecutive_scans_last, consecutive_scans)
-    consecutive_scans_last = consecutive_scans
-    scan_data_diff_len = len(scan_data_diff)
-    if scan_data_diff_len == 1:
-        pendulum_found_failures += 1
-    else:
-        logging.debug(f"Found pendulum points: {scan_data_diff_len}")
-    return 0, nanos, scan_data_diff
+    scan_ring = attach_ring(scan_ring_spec)
+    background = attach_background(background_spec) if background_spec is not None else None
+    rows = np.empty(count, dtype=DETECTION_DTYPE)
+    rows.view(np.float64)[:] = np.nan
+    for i in range(count):
+        nanos, scan_data_diff = _find_pendulum(scan_ring, first_seq + i, rois[i] if rois else None, background)
+        if nanos is None:
+            continue
+        rows['time'][i] = nanos
+        if len(scan_data_diff) > 1:
+            # Scan info: <time, left_most_point, right_most_point>
+            rows[i] = (nanos, scan_data_diff[0][1], scan_data_diff[-1][1]) + segment_polar(scan_data_diff)
+    return rows
 
-from lidar.fit_sine_with_fft_guess import pendulum_equation, sine_function
+from lidar.fit_sine_with_fft_guess import pendulum_equation, sine_function, StreamingSineFit
 from lidar.analyze_clock_rate import analyze_clock_rate
-from lidar.remove_outliers import remove_outliers_zscore
+from lidar.remove_outliers import zscore_mask, HampelFilter
+from lidar.period_estimators import PERIOD_ESTIMATORS, PERIOD_BAND, period_band, estimate_period
 
-def pendulum_info_min_process(nano_first_n_last_points_orig, lidar_restarts, processing_time):
+@instrumented
+def pendulum_info_min_process(window_ring_spec, seq, lidar_restarts, processing_time, pendulum_found_failures,
+                              scans_dropped=0, scan_queue_high_water=0, min_period=1.9, max_period=2.1):
     """
     This is used to find information about the pendulum using the time associated with the
     scan and the first (left most) point, and the lsat (right most) point of the pendulum <t, f, l>.
+    The points are read from the shared memory window ring by their sequence number.
+    pendulum_found_failures is the number of scans of the window where the pendulum wasn't found.
+    scans_dropped and scan_queue_high_water are the ScanReader counters for the window; they are reported with
+    the LIDAR readings rate. min_period and max_period: the band the period estimators search ([Fit] PERIOD_BAND
+    of [Tracker] PERIOD).
+    Returns the ThingSpeak fields to post.
     """
-    global pendulum_found_failures
-    nano_first_points, outliers = remove_outliers_zscore(nano_first_n_last_points_orig, 1)
-    nano_last_points, _ = remove_outliers_zscore(nano_first_n_last_points_orig, 2)
-    pendulum_period, t_uniform, theta_uniform, fitted_params, r_squared = pendulum_equation(nano_first_points, 1)
-    _, _, theta_uniform_last, _, r_squared_last = pendulum_equation(nano_last_points, 2)
+    window = attach_ring(window_ring_spec).read(seq)
+    if window is None:
+        logging.error(f"Minute window {seq} was overwritten before it was processed")
+        return {}
+    points = window[1]
+    # Both edges are filtered in one pass; see lidar.remove_outliers
+    kept = zscore_mask(np.column_stack((points['first'], points['last'])))
+    nano_first_points = points[kept[:, 0]].tolist()
+    nano_last_points = points[kept[:, 1]].tolist()
+    outliers = points[~kept[:, 0]].tolist()
+    if minute_estimator == 'curve_fit':
+        pendulum_period, t_uniform, theta_uniform, fitted_params, r_squared = pendulum_equation(nano_first_points, 1)
+        _, _, theta_uniform_last, _, r_squared_last = pendulum_equation(nano_last_points, 2)
+    else:
+        # See lidar.period_estimators; the swing is taken from the points themselves
+        pendulum_period, _, _, r_squared = estimate_period(nano_first_points, 1, minute_estimator,
+                                                           min_period, max_period)
+        _, _, _, r_squared_last = estimate_period(nano_last_points, 2, minute_estimator, min_period, max_period)
+        theta_uniform = [x[1] for x in nano_first_points]
+        theta_uniform_last = [x[2] for x in nano_last_points]
     projected_daily_deviation, _ = analyze_clock_rate(pendulum_period)
     # the swing is how far left and right the pendulum moves based on the LIDAR data
     pendulum_swing = abs(min(theta_uniform) - max(theta_uniform))
@@ -162,52 +229,64 @@ def pendulum_info_min_process(nano_first_n_last_points_orig, lidar_restarts, pro
         logging.warning(f"projected_daily_deviation: {projected_daily_deviation:.3f} (sec/day)"
                         f"; r_squared: {r_squared:.4f}; outliers: {outliers};"
                         f" nano_first_points: {nano_first_points}")
-    lidar_readings = pendulum_found_failures + len(nano_first_n_last_points_orig)
+    lidar_readings = pendulum_found_failures + len(points)
     lidar_readings_hz = lidar_readings / processing_time
     pendulum_found_failure_percentage = (pendulum_found_failures / lidar_readings) * 100.0
-    pendulum_found_failures = 0
+    logging.info(f"lidar readings: {lidar_readings_hz:.1f} (Hz)"
+                 f"; scans dropped: {scans_dropped}; scan queue high-water mark: {scan_queue_high_water}")
     # This doesn't say how to fix the data, it just says that it is bad and not to use it.
     # See the discussion of R^2 in fit_sine_with_fft_guess:pendulum_equation()
     if r_squared < r_squared_threshold:
         logging.warning(f"Data discarded because R^2 {r_squared:.4f} < threshold of {r_squared_threshold}"
                         f"; pendulum_period: {pendulum_period:.4f} (sec/cycle)"
-                        f"; lidar readings: {lidar_readings_hz:.1f} (Hz)")
-        thingspeak_post(f"https://api.thingspeak.com/update?api_key={write_api_key}"
-                        f"&field4={lidar_readings_hz:.1f}"
-                        f"&field5={pendulum_found_failure_percentage:.1f}"
-                        f"&field8={r_squared:.4f}"
-                        )
-        # the empty array signifies that no data was found.
-        return 1, []
-    thingspeak_post(thingspeak_url_1(pendulum_period, projected_daily_deviation, pendulum_swing,
-                                     lidar_readings_hz, pendulum_found_failure_percentage, lidar_restarts,
-                                     r_squared, pendulum_width))
-    return 1, nano_first_points
-
-def pendulum_info_hr_process(nano_first_points_orig):
+                        f"; lidar readings: {lidar_readings_hz:.1f} (Hz)"
+                        f"; scans dropped: {scans_dropped}; scan queue high-water mark: {scan_queue_high_water}")
+        return {'field4': f"{lidar_readings_hz:.1f}", 'field5': f"{pendulum_found_failure_percentage:.1f}",
+                'field8': f"{r_squared:.4f}"}
+    return thingspeak_fields_1(pendulum_period, projected_daily_deviation, pendulum_swing,
+                               lidar_readings_hz, pendulum_found_failure_percentage, lidar_restarts,
+                               r_squared, pendulum_width)
+
+@instrumented
+def pendulum_info_hr_process(pendulum_period, r_squared):
     """
-    This is used to find information about the pendulum using the time associated with the
-    scan and the first (left most) point of the pendulum.
+    This is used to report the pendulum period of the last hour. It is fit as the points of the first (left most)
+    edge of the pendulum arrive by a lidar.fit_sine_with_fft_guess.StreamingSineFit in run_scanner() and combined
+    from its minutes by a lidar.rollup.Rollup, so all that is left to do here is the ThingSpeak field to post.
     """
-    nano_first_points, outliers = remove_outliers_zscore(nano_first_points_orig, 1)
-    pendulum_period, t_uniform, theta_uniform, fitted_params, r_squared = pendulum_equation(nano_first_points, 1)
     projected_daily_deviation, _ = analyze_clock_rate(pendulum_period)
-    url = (f"https://api.thingspeak.com/update?api_key={write_api_key}"
-           f"&field7={projected_daily_deviation:.3f}"
-           )
     logging.info(f"projected_daily_deviation (hr): {projected_daily_deviation:.3f} (sec/day)")
     if r_squared < r_squared_threshold:
         logging.warning(f"Data discarded because R^2: {r_squared} < threshold of {r_squared_threshold}; pendulum_period: {pendulum_period:.4f}; ")
-        return 1, []
-    thingspeak_post(url)
-    return 1, nano_first_points
+        return {}
+    return {'field7': f"{projected_daily_deviation:.3f}"}
 
-from typing import List
-from multiprocessing import Pool, TimeoutError, get_context, cpu_count
-from multiprocessing.pool import AsyncResult
-import copy
+from multiprocessing import get_context, cpu_count
+from lidar.task_dispatcher import TaskDispatcher
 
 APPLY_ASYNC_WITH_N = 14.2 * 60.0
+# Windows waiting to be processed in the window ring; a window is processed in well under the
+# time it takes to fill the next one.
+WINDOW_RING_SLOTS = 4
+
+# How the loop of run_scanner() keeps its work down:
+#
+# - The scans are read by a lidar.scan_reader.ScanReader thread, and they and the minute windows are written to
+#   lidar.shared_ring rings so that only their sequence numbers are passed to the subprocesses.
+# - The tasks are run by a lidar.task_dispatcher.TaskDispatcher whose completion callbacks mean each pass only looks
+#   at the tasks that finished; a task that misses its [Dispatcher] deadline gets the pool recycled.
+# - The scans are submitted in batches of up to [Batch] MAX_SCANS scans or MAX_MS milliseconds, the batch size
+#   doubling while tasks back up in the pool and halving when it is idle.
+# - Once a lidar.pendulum_tracker.PendulumTracker has locked on only the region where the pendulum is predicted to
+#   be is searched, against a lidar.background_model.BackgroundModel when [Background] is enabled.
+# - The results of 'find_pendulum_process' are put back in scan order and handed to a
+#   lidar.detection_pipeline.DetectionPipeline thread which does everything else with them (the spike and edge
+#   filters, the minute windows, the hour's fit, the beats, the rollup, and the store). The windows and hours it
+#   finishes come back as events that are submitted to the pool here.
+# - The ThingSpeak fields are posted by a lidar.thingspeak_uploader.ThingSpeakUploader thread, and lidar.telemetry
+#   times the loop and the tasks.
+
+
 def run_scanner(lidar_restarts):
     """
     This function simply grabs data from the LIDAR as fast as it can and sends data for analysis to one of the
@@ -223,109 +302,227 @@ def run_scanner(lidar_restarts):
 
     As the hours go by the frequency will increase to about 13.7 Hz, and 14.7 Hz.
     """
-    global nanos_first_n_last_points_min, nanos_first_n_last_points_min_len, nanos_first_n_last_points_hr, nanos_first_n_last_points_hr_len
-    results: List[AsyncResult] = []
-    completed_results: List[AsyncResult] = []
     # https://docs.python.org/3/library/multiprocessing.html
     # Use spawn to prevent issues with forking threads
     ctx = get_context('spawn')
     num_proc = cpu_count()
     logging.warning(f"num_proc: {num_proc}")
+    scan_ring = SharedRing(SCAN_DTYPE, scan_ring_slots, scan_ring_max_points)
+    min_ring = SharedRing(NANOS_FIRST_N_LAST_DTYPE, WINDOW_RING_SLOTS, int(APPLY_ASYNC_WITH_N*5.0) + 1)
+    scan_seq = 0
+    # The results of 'find_pendulum_process' waiting for the scans before them; {scan seq: DETECTION_DTYPE row}
+    detections = {}
+    next_detection = 0
+    # The scans from batch_seq on haven't been submitted yet; batch_rois has the region of interest of each
+    batch_seq = 0
+    batch_rois = []
+    batch_size = 1
+    batch_started = 0.0
+    # The scans of the batch being gathered aren't protected by the wait below, so it must fit well within the ring
+    batch_limit = max(1, min(batch_max_scans, scan_ring_slots // 4))
+    # The scans are read in their own thread so that reading the serial port never waits on this loop
+    lidar = ScanReader(open_scan_source(scan_source_mode, lidar_port, lidar_baud_rate, lidar_motor_rpm, logging,
+                                        record_file=scan_record_file, replay_file=scan_replay_file,
+                                        replay_speed=scan_replay_speed, driver=lidar_driver,
+                                        scan_mode=lidar_scan_mode),
+                       scan_queue_size, scan_drop_policy)
+    sine_fit = StreamingSineFit(**sine_fit_settings)
+    # The scan times are time.perf_counter() times of the LIDAR (in a replay, of the LIDAR that was recorded)
+    clock_offset = lidar.source.clock_offset
+    rollup = Rollup(tracker_settings['period'], clock_offset=clock_offset)
+    beat_timer = BeatTimer(**beat_settings) if beats_enabled else None
+    store = StoreWriter(TimeSeriesStore(store_directory, store_segment_rows)).start() if store_directory else None
+    telemetry = Telemetry(telemetry_report_interval, telemetry_stuck_seconds, telemetry_metrics_port)
+    telemetry.add_gauge('scan_ring_truncated', lambda: scan_ring.truncated)
     # https://pythonspeed.com/articles/python-multiprocessing/
     # maxtasksperchild specifies the number of tasks a worker process can complete before it is terminated and
     # replaced with a new, "fresh" worker process.
-    with ctx.Pool(processes=num_proc, maxtasksperchild=100) as pool:
-        start_time = time.perf_counter()
-        lidar = startup_lidar(lidar_port, lidar_baud_rate, lidar_motor_rpm, logging)
-        while True:
-            try:
-                for scan in lidar.iter_scans(): # (quality, angle, distance)
-                    # NOTE: While time.perf_counter() should be accurate to the submicrosecond (10^-6) level, when
-                    # scan_with_time is printed we use millisecond accurate (10^-3).
-                    scan_with_time = (time.perf_counter(), scan)
-                    # Submit a single task to the pool, non-blocking
-                    result_obj: AsyncResult = pool.apply_async(find_pendulum_process,
-                                                               args=(scan_with_time,),
-                                                               error_callback=error_handler
-                                                               )
-                    results.append(result_obj)
-
-                    for result in results:
-                        # Check if the task is complete without blocking the main process...
-                        if result.ready() and result not in completed_results:
-                            # Non-blocking get: use a very short timeout or check ready() first
-                            # The get() will return immediately once ready() is True
-                            # This will also prevent a crashed worker from hanging the .get
-                            value = result.get(timeout=0.1)
-                            if value[0] == 0:
-                                # Process the results of 'find_pendulum_process'...
-                                value_nanos = value[1]
-                                value_scan = value[2]
-                                if len(value_scan) > 1:
-                                    # Scan info: <time, left_most_point, right_most_point>
-                                    nano_first_n_last_point = (value_nanos, value_scan[0][1], value_scan[-1][1])
-                                    nanos_first_n_last_points_min.append(nano_first_n_last_point)
-                                    nanos_first_n_last_points_min_len += 1
-                                    nanos_first_n_last_points_hr.append(nano_first_n_last_point)
-                                    nanos_first_n_last_points_hr_len += 1
-                                    if nanos_first_n_last_points_hr_len >= APPLY_ASYNC_WITH_N*60.0:
-                                        result_obj: AsyncResult = pool.apply_async(pendulum_info_hr_process,
-                                                                                   args=(copy.deepcopy(nanos_first_n_last_points_hr),),
-                                                                                   error_callback=error_handler
-                                                                                   )
-                                        results.append(result_obj)
-                                        nanos_first_n_last_points_hr = []
-                                        nanos_first_n_last_points_hr_len = 0
-                                    elif nanos_first_n_last_points_min_len >= APPLY_ASYNC_WITH_N*5.0:
-                                        processing_time = time.perf_counter() - start_time
-                                        result_obj: AsyncResult = pool.apply_async(pendulum_info_min_process,
-                                                                                   args=(copy.deepcopy(nanos_first_n_last_points_min),
-                                                                                         lidar_restarts,
-                                                                                         processing_time,),
-                                                                                   error_callback=error_handler
-                                                                                   )
-                                        results.append(result_obj)
-                                        start_time = time.perf_counter()
-                                        nanos_first_n_last_points_min = []
-                                        nanos_first_n_last_points_min_len = 0
-                                completed_results.append(result)
-                            if value[0] == 1:
-                                # Process the results of 'pendulum_info_min_process' or 'pendulum_info_hr_process'...
-                                completed_results.append(result)
-                    completed_results_set = set(completed_results)
-                    results = [item for item in results if item not in completed_results_set]
-                    completed_results = []
-            #  If the worker raises a standard Python exception (rather than a hard crash), that exception is
-            #  caught by the pool and re-raised in the main process when AsyncResult.get() is called.
-            except RPLidarException as e:
-                health = lidar.get_health()
-                logging.error(f"RPLidar Exception: {e}; Lidar Health: {health}")
-            except TimeoutError as e:
-                logging.error(f"Subprocess Exception: {e} out (likely crashed).")
-            except KeyboardInterrupt:
-                logging.error("Keyboard Interrupt")
-            except Exception as e:
-                # This handles Python-level exceptions raised by the worker
-                logging.error(f"Exception: {e}")
-                logging.error("Exception traceback: ", exc_info=(type(e), e, e.__traceback__))
-            finally:
-                logging.fatal('Stoping...')
-                lidar.stop()
-                lidar.stop_motor()
-                lidar.disconnect()
-                pool.close()
-                pool.join()
-                return lidar_restarts+1
+    dispatcher = TaskDispatcher(ctx, num_proc, task_deadlines, maxtasksperchild=100,
+                                initializer=init_worker, initargs=telemetry.worker_args,
+                                error_handler=error_handler)
+    telemetry.add_gauge('deadline_misses', lambda: dispatcher.deadline_misses)
+    telemetry.add_gauge('tasks_cancelled', lambda: dispatcher.cancelled)
+    telemetry.add_gauge('batch_size', lambda: batch_size)
+    tracker = PendulumTracker(**tracker_settings) if tracker_enabled else None
+    background = BackgroundModel(**background_settings) if background_enabled else None
+    background_spec = None
+    if background is not None:
+        background.load(background_file)
+        background_spec = background.spec
+        telemetry.add_gauge('background_ready', lambda: background.ready)
+    if tracker is not None:
+        telemetry.add_gauge('tracker_locked', lambda: tracker.locked)
+        telemetry.add_gauge('tracker_roi_scans', lambda: tracker.roi_scans)
+        telemetry.add_gauge('tracker_losses', lambda: tracker.losses)
+    edge_filters = (PendulumFilter(**filter_settings), PendulumFilter(**filter_settings)) if filter_enabled else None
+    spike_filter = HampelFilter(columns=2, **hampel_settings) if hampel_settings['half_window'] > 0 else None
+    if spike_filter is not None:
+        telemetry.add_gauge('spikes', lambda: spike_filter.outliers)
+    if edge_filters is not None:
+        telemetry.add_gauge('filter_first', edge_filters[0].summary)
+        telemetry.add_gauge('filter_last', edge_filters[1].summary)
+    telemetry.add_gauge('rollup', rollup.summary)
+    if store is not None:
+        telemetry.add_gauge('store', store.summary)
+    if beat_timer is not None:
+        telemetry.add_gauge('beats', beat_timer.summary)
+    pipeline = DetectionPipeline(min_ring, APPLY_ASYNC_WITH_N*5.0, sine_fit, rollup, spike_filter, edge_filters,
+                                 filter_reject, filter_filtered, beat_timer, store, clock_offset).start()
+    telemetry.add_gauge('pipeline', pipeline.summary)
+    # The result of a scan whose task was cancelled
+    lost_detection = np.full(len(DETECTION_DTYPE.names), np.nan).view(DETECTION_DTYPE)[0]
+    telemetry.add_gauge('scans_read', lambda: lidar.scans_read)
+    telemetry.add_gauge('scans_dropped', lambda: lidar.scans_dropped)
+    telemetry.add_gauge('scan_queue_high_water', lambda: lidar.high_water)
+    uploader = ThingSpeakUploader(write_api_key, **uploader_settings)
+    telemetry.add_gauge('thingspeak', uploader.summary)
+    uploader.start()
+    telemetry.start()
+
+    def submit_batch():
+        """Submit the batch as a single task to the pool, non-blocking."""
+        nonlocal batch_seq, batch_rois
+        rois = batch_rois if any(roi is not None for roi in batch_rois) else None
+        dispatcher.submit('find_pendulum_process', find_pendulum_process,
+                          (scan_ring.spec, batch_seq, len(batch_rois), rois, background_spec,),
+                          tag=batch_seq)
+        batch_seq = scan_seq
+        batch_rois = []
+
+    def handle_completed():
+        """Only the tasks that have completed are looked at..."""
+        for kind, tag, ok, value, elapsed in dispatcher.completed():
+            telemetry.task_completed(kind, elapsed)
+            if not ok:
+                # As AsyncResult.get() did, re-raise the exception of the worker
+                raise value
+            if kind == 'find_pendulum_process':
+                # The scans complete out of order; they are put back in order before they are used
+                for i, row in enumerate(value):
+                    detections[tag + i] = row
+            else:
+                # The ThingSpeak fields of 'pendulum_info_min_process' and 'pendulum_info_hr_process'
+                uploader.submit(value)
+
+    def release_detections():
+        """
+        Hand the results of 'find_pendulum_process' to the pipeline in scan order. A scan older than the oldest one
+        still pending that hasn't completed was cancelled (see lidar.task_dispatcher).
+        """
+        nonlocal next_detection
+        oldest_scan = dispatcher.oldest('find_pendulum_process')
+        released = []
+        while next_detection < batch_seq:
+            row = detections.pop(next_detection, None)
+            if row is None:
+                if oldest_scan is not None and next_detection >= oldest_scan:
+                    break
+                # Lost
+                row = lost_detection
+            next_detection += 1
+            if tracker is not None and row['time'] == row['time']:
+                found = row['first'] == row['first']  # not NaN
+                tracker.update_polar(row['time'], (row['centre'], row['half_width'], row['distance_min'],
+                                                   row['distance_max']) if found else None)
+            released.append(row)
+        if released:
+            pipeline.add(released)
+
+    def submit_events():
+        """The minute windows and hours that the pipeline has finished go to the pool..."""
+        for event in pipeline.events():
+            if event[0] == 'minute':
+                _, min_seq, processing_time, pendulum_found_failures = event
+                scans_dropped, scan_queue_high_water = lidar.take_window_counters()
+                dispatcher.submit('pendulum_info_min_process', pendulum_info_min_process,
+                                  (min_ring.spec, min_seq, lidar_restarts, processing_time,
+                                   pendulum_found_failures, scans_dropped, scan_queue_high_water)
+                                  + period_search_band,
+                                  tag=min_seq)
+                if background is not None and background_file:
+                    background.save(background_file)
+            else:
+                _, hr_seq, pendulum_period, r_squared = event
+                dispatcher.submit('pendulum_info_hr_process', pendulum_info_hr_process,
+                                  (pendulum_period, r_squared,), tag=hr_seq)
+
+    def wait_for_tasks(kinds):
+        """Handle the tasks as they complete until none of 'kinds' are pending."""
+        while any(dispatcher.oldest(kind) is not None for kind in kinds):
+            if not dispatcher.wait(1.0):
+                dispatcher.check_deadlines()
+            handle_completed()
+            release_detections()
+
+    while True:
+        try:
+            for scan_with_time in lidar.iter_scans(): # (time, [(quality, angle, distance), ...])
+                telemetry.scan_arrived(scan_with_time[0])
+                # Don't overwrite a scan in the ring that a worker has not processed yet, or the scan before it
+                # that the worker compares it with...
+                oldest_scan = dispatcher.oldest('find_pendulum_process')
+                while oldest_scan is not None and oldest_scan <= scan_seq - scan_ring_slots + 1:
+                    if not dispatcher.wait(1.0):
+                        dispatcher.check_deadlines()
+                    oldest_scan = dispatcher.oldest('find_pendulum_process')
+                scan_ring.write(scan_seq, scan_with_time[1], scan_with_time[0])
+                if not batch_rois:
+                    batch_started = time.perf_counter()
+                batch_rois.append(tracker.roi(scan_with_time[0]) if tracker is not None else None)
+                scan_seq += 1
+                if len(batch_rois) >= batch_size or time.perf_counter() - batch_started >= batch_max_seconds:
+                    submit_batch()
+                    if dispatcher.pending_count > num_proc:
+                        batch_size = min(batch_size * 2, batch_limit)
+                    elif dispatcher.pending_count <= 1:
+                        batch_size = max(batch_size // 2, 1)
+                dispatcher.check_deadlines()
+                handle_completed()
+                release_detections()
+                submit_events()
+                telemetry.pending(dispatcher.pending_count)
+            # The scan source has ended (the end of a replay): everything that was read goes through the pipeline
+            # and the pool, and the results are handed to the uploader before it is stopped below.
+            logging.warning(f"The scans have ended; finishing the {scan_seq - next_detection} scans in progress")
+            if batch_rois:
+                submit_batch()
+            wait_for_tasks(('find_pendulum_process',))
+            pipeline.stop()
+            submit_events()
+            wait_for_tasks(('pendulum_info_min_process', 'pendulum_info_hr_process'))
+        #  If the worker raises a standard Python exception (rather than a hard crash), that exception is
+        #  caught by the pool and re-raised in the main loop when its completion is processed.
+        except RPLidarException as e:
+            health = lidar.get_health()
+            logging.error(f"RPLidar Exception: {e}; Lidar Health: {health}")
+        except KeyboardInterrupt:
+            logging.error("Keyboard Interrupt")
+        except Exception as e:
+            # This handles Python-level exceptions raised by the worker
+            logging.error(f"Exception: {e}")
+            logging.error("Exception traceback: ", exc_info=(type(e), e, e.__traceback__))
+        finally:
+            logging.fatal('Stoping...')
+            lidar.close()
+            pipeline.stop()
+            dispatcher.close()
+            telemetry.stop()
+            uploader.stop()
+            if store is not None:
+                store.stop()
+                store.store.close()
+            if background is not None:
+                if background_file:
+                    background.save(background_file)
+                background.close()
+            scan_ring.close()
+            min_ring.close()
+            return lidar_restarts+1
 
 import configparser
 import os
 from time import sleep
 
-nanos_first_n_last_points_min = []
-nanos_first_n_last_points_hr = []
-nanos_first_n_last_points_min_len = 0
-nanos_first_n_last_points_hr_len = 0
-
 # Copy config.ini.example to config.ini and change the WRITE_API_KEY to the one that you get from
 # https://thingspeak.mathworks.com/channels/??????/api_keys
 config = configparser.ConfigParser()
@@ -333,27 +530,139 @@ ini_path = os.path.join(os.getcwd(), 'config.ini')
 config.read(ini_path)
 write_api_key = config.get('ThingSpeak', 'WRITE_API_KEY').strip('\'"')
 lidar_port = config.get('RPLIDAR', 'PORT').strip('\'"')
+lidar_driver = config.get('RPLIDAR', 'DRIVER', fallback='roboticia').strip('\'"')
+lidar_scan_mode = config.get('RPLIDAR', 'SCAN_MODE', fallback='normal').strip('\'"')
 try:
     lidar_baud_rate: int = int(config.get('RPLIDAR', 'BAUD_RATE').strip('\'"'))
     lidar_motor_rpm: int = int(config.get('RPLIDAR', 'MOTOR_PWM').strip('\'"'))
     lidar_scan_radius_mm: float = float(config.get('RPLIDAR', 'SCAN_RADIUS_MM').strip('\'"'))
     # R_SQUARED_THRESHOLD = 0.7 # .25 was not sensitive enough see fit_sine_with_fft_guess; Typically 0.99?? is seen in logs.
     r_squared_threshold: float = float(config.get('pendulum_info_min_process', 'R_SQUARED_THRESHOLD').strip('\'"'))
+    # The scan ring must hold the scans waiting in the pool (SLOTS / 15 Hz seconds of them), each up to MAX_POINTS
+    scan_ring_slots: int = int(config.get('ScanRing', 'SLOTS', fallback='512').strip('\'"'))
+    scan_ring_max_points: int = int(config.get('ScanRing', 'MAX_POINTS', fallback='2048').strip('\'"'))
+    # Where the scans come from; see lidar.scan_source
+    scan_source_mode = config.get('ScanSource', 'MODE', fallback='lidar').strip('\'"')
+    scan_record_file = config.get('ScanSource', 'RECORD_FILE', fallback='').strip('\'"')
+    scan_replay_file = config.get('ScanSource', 'REPLAY_FILE', fallback='').strip('\'"')
+    scan_replay_speed: float = float(config.get('ScanSource', 'REPLAY_SPEED', fallback='1.0').strip('\'"'))
+    # The queue between the scan reader thread and run_scanner; see lidar.scan_reader
+    scan_queue_size: int = int(config.get('ScanReader', 'QUEUE_SIZE', fallback='64').strip('\'"'))
+    # A replay has no serial port to overflow so nothing needs to be dropped
+    scan_drop_policy = config.get('ScanReader', 'DROP_POLICY',
+                                  fallback='block' if scan_source_mode == 'replay' else 'drop_oldest').strip('\'"')
+    # See lidar.telemetry; a METRICS_PORT of 0 doesn't serve the metrics
+    telemetry_report_interval: float = float(config.get('Telemetry', 'REPORT_INTERVAL', fallback='300').strip('\'"'))
+    telemetry_stuck_seconds: float = float(config.get('Telemetry', 'STUCK_SECONDS', fallback='120').strip('\'"'))
+    telemetry_metrics_port: int = int(config.get('Telemetry', 'METRICS_PORT', fallback='0').strip('\'"'))
+    # Search only the region of the scan where the pendulum is predicted to be; see lidar.pendulum_tracker
+    tracker_enabled = config.get('Tracker', 'ENABLED', fallback='true').strip('\'"').lower() == 'true'
+    tracker_settings = {
+        'period': float(config.get('Tracker', 'PERIOD', fallback='2.0').strip('\'"')),
+        'history_seconds': float(config.get('Tracker', 'HISTORY_SECONDS', fallback='4.0').strip('\'"')),
+        'margin_deg': float(config.get('Tracker', 'MARGIN_DEG', fallback='3.0').strip('\'"')),
+        'lock_after': int(config.get('Tracker', 'LOCK_AFTER', fallback='15').strip('\'"')),
+        'lose_after': int(config.get('Tracker', 'LOSE_AFTER', fallback='3').strip('\'"')),
+    }
+    # Find the pendulum against a learned model of the background; see lidar.background_model
+    background_enabled = config.get('Background', 'ENABLED', fallback='false').strip('\'"').lower() == 'true'
+    background_file = config.get('Background', 'FILE', fallback='background.npz').strip('\'"')
+    background_settings = {
+        'bins': int(config.get('Background', 'BINS', fallback='720').strip('\'"')),
+        'quantile': float(config.get('Background', 'QUANTILE', fallback='0.9').strip('\'"')),
+        'learn_scans': int(config.get('Background', 'LEARN_SCANS', fallback='150').strip('\'"')),
+        'step_mm': float(config.get('Background', 'STEP_MM', fallback='0.5').strip('\'"')),
+        'deviation_mm': float(config.get('Background', 'DEVIATION_MM', fallback='30.0').strip('\'"')),
+    }
+    # Follow each edge of the pendulum with a Kalman filter; see lidar.pendulum_filter
+    filter_enabled = config.get('Filter', 'ENABLED', fallback='true').strip('\'"').lower() == 'true'
+    filter_reject = config.get('Filter', 'REJECT', fallback='false').strip('\'"').lower() == 'true'
+    filter_filtered = config.get('Filter', 'FILTERED', fallback='false').strip('\'"').lower() == 'true'
+    filter_settings = {
+        'period': tracker_settings['period'],
+        'measurement_mm': float(config.get('Filter', 'MEASUREMENT_MM', fallback='3.0').strip('\'"')),
+        'acceleration_mm': float(config.get('Filter', 'ACCELERATION_MM', fallback='20.0').strip('\'"')),
+        'gate_sigma': float(config.get('Filter', 'GATE_SIGMA', fallback='4.0').strip('\'"')),
+    }
+    # Drop the scans where an edge is a spike against the scans either side; see lidar.remove_outliers.HampelFilter
+    hampel_settings = {
+        'half_window': int(config.get('Outliers', 'HAMPEL_WINDOW', fallback='3').strip('\'"')),
+        'threshold': float(config.get('Outliers', 'HAMPEL_THRESHOLD', fallback='3.0').strip('\'"')),
+        'min_sigma': float(config.get('Outliers', 'MIN_SIGMA_MM', fallback='3.0').strip('\'"')),
+    }
+    # The hour's pendulum period is fit as the points arrive; see lidar.fit_sine_with_fft_guess.StreamingSineFit
+    sine_fit_settings = {
+        'period': tracker_settings['period'],
+        'block_seconds': float(config.get('Fit', 'BLOCK_SECONDS', fallback='10.0').strip('\'"')),
+        # The longer windows come from lidar.rollup
+        'history_seconds': 600.0,
+    }
+    # Time each beat; see lidar.beat_timer. The beats (BEAT_DTYPE rows) are kept in the [Store]
+    beats_enabled = config.get('Beats', 'ENABLED', fallback='true').strip('\'"').lower() == 'true'
+    beat_settings = {
+        'period': tracker_settings['period'],
+        'hysteresis': float(config.get('Beats', 'HYSTERESIS', fallback='0.1').strip('\'"')),
+    }
+    # Keep the scans, beats, and rollups at full resolution; see lidar.timeseries_store. None when DIRECTORY is empty
+    store_directory = config.get('Store', 'DIRECTORY', fallback='').strip('\'"')
+    store_segment_rows: int = int(config.get('Store', 'SEGMENT_ROWS', fallback='1048576').strip('\'"'))
+    # Posting to ThingSpeak; see lidar.thingspeak_uploader. The bulk update of a backlog needs the CHANNEL_ID
+    uploader_settings = {
+        'channel_id': config.get('ThingSpeak', 'CHANNEL_ID', fallback='').strip('\'"'),
+        'queue_file': config.get('ThingSpeak', 'QUEUE_FILE', fallback='thingspeak_queue.json').strip('\'"'),
+        'url': config.get('ThingSpeak', 'URL', fallback='https://api.thingspeak.com').strip('\'"'),
+        'interval': float(config.get('ThingSpeak', 'INTERVAL', fallback='16').strip('\'"')),
+    }
+    # A dashboard of the store and Prometheus metrics on this local port; see lidar.dashboard. 0 doesn't serve it
+    dashboard_port: int = int(config.get('Dashboard', 'PORT', fallback='0').strip('\'"'))
+    # How the minute window's period is found: 'curve_fit' (pendulum_equation) or one of PERIOD_ESTIMATORS
+    minute_estimator = config.get('Fit', 'MINUTE_ESTIMATOR', fallback='curve_fit').strip('\'"')
+    # The estimators search the periods within this fraction of [Tracker] PERIOD
+    period_search_band = period_band(tracker_settings['period'],
+                                     float(config.get('Fit', 'PERIOD_BAND', fallback=str(PERIOD_BAND)).strip('\'"')))
+    # Batches of scans per 'find_pendulum_process' task; MAX_SCANS of 1 submits each scan on its own
+    batch_max_scans: int = int(config.get('Batch', 'MAX_SCANS', fallback='16').strip('\'"'))
+    batch_max_seconds: float = float(config.get('Batch', 'MAX_MS', fallback='200').strip('\'"')) / 1000.0
+    # Seconds from submitting a task until it must be complete; see lidar.task_dispatcher
+    task_deadlines = {
+        'find_pendulum_process':
+            float(config.get('Dispatcher', 'FIND_PENDULUM_DEADLINE', fallback='60').strip('\'"')),
+        'pendulum_info_min_process':
+            float(config.get('Dispatcher', 'MIN_DEADLINE', fallback='300').strip('\'"')),
+        'pendulum_info_hr_process':
+            float(config.get('Dispatcher', 'HR_DEADLINE', fallback='1200').strip('\'"')),
+    }
 except ValueError:
     print("Error reading config.ini; string to number conversion error")
     logging.fatal("Error reading config.ini; string to number conversion error")
     exit(1)
+if dashboard_port and not store_directory:
+    print("Error reading config.ini; [Dashboard] PORT needs a [Store] DIRECTORY")
+    logging.fatal("Error reading config.ini; [Dashboard] PORT needs a [Store] DIRECTORY")
+    exit(1)
+if minute_estimator != 'curve_fit' and minute_estimator not in PERIOD_ESTIMATORS:
+    print(f"Error reading config.ini; unknown [Fit] MINUTE_ESTIMATOR {minute_estimator}")
+    logging.fatal(f"Error reading config.ini; unknown [Fit] MINUTE_ESTIMATOR {minute_estimator}")
+    exit(1)
 
 # When a new process starts using the 'spawn' method, it re-imports the main script.
 # Any code at the global scope that is not protected by an if __name__ == '__main__': block will be executed during
 # this re-import process, which can lead to infinite loops of spawning new processes or other errors.
 if __name__ == '__main__':
     print("Starting...")
+    if dashboard_port:
+        # The dashboard only reads the store and the telemetry, in a process of its own
+        metrics_url = f"http://127.0.0.1:{telemetry_metrics_port}/metrics" if telemetry_metrics_port else ''
+        get_context('spawn').Process(target=serve_dashboard, name='Dashboard', daemon=True,
+                                     args=(store_directory, dashboard_port, metrics_url,
+                                           tracker_settings['period'])).start()
     lidar_restarts: int = 0
     while True:
-        consecutive_scans_last = None
         # this needs to be a local and not a global because it needs to be passed to another process
         lidar_restarts = run_scanner(lidar_restarts)
+        if scan_source_mode == 'replay':
+            # The recording has been replayed through the pipeline; there is nothing to restart.
+            break
         sleep(2)
 
 # TODO:
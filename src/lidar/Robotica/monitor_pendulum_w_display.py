@@ -83,7 +83,7 @@ class Pendulum:
         self.pendulum_width.append(width)
 
         # Is there a new maximum angle?
-        # NOTE: This does not work when crossing 0
+        # NOTE: This does not work when crossing 0 (see lidar.beat_timer which times the beats from centre crossings)
         if l_pendulum[1] > self.max_l_pendulum[1]:
             self.max_angle_unchanged_cnt = 0
             self.max_l_pendulum = l_pendulum
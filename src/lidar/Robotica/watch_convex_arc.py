@@ -2,7 +2,7 @@
 
 import numpy as np
 from lidar.const import startup_lidar, lidar_readings_to_cartesian, SCAN_RADIUS_MM
-from lidar.least_squares import is_on_arc
+from lidar.least_squares import find_arcs
 import time
 
 TESTS_CNT = 100
@@ -29,15 +29,15 @@ def find_pendulum_arc(iterator, readings_about_center, pendulum_width, threshold
     scan = get_scan_in_readings_about_center(iterator, readings_about_center)
     print(f"Scan Readings: {len(scan)}")
     scan_cartesian = np.array(lidar_readings_to_cartesian(scan))
-    for k in range(0, readings_about_center * 2 - pendulum_width):
-        datapoints = scan_cartesian[k: k + pendulum_width]
-        is_arc, circle_params = is_on_arc(datapoints, threshold)
-        if is_arc:
-            pendulum_arc_in_scan = scan[k: k + pendulum_width]
-            # x = [cord[2] for cord in pendulum_arc_in_scan]
-            # pendumum_width_degrees = pendulum_arc_in_scan[-1][1] - pendulum_arc_in_scan[0][1]
-            # print(f"find_pendulum_arc Angle: {pendumum_width_degrees} max x diff: {max(x)-min(x)}")
-            return pendulum_arc_in_scan
+    # Every window of pendulum_width readings that starts before readings_about_center * 2 - pendulum_width is fit
+    # at once (see lidar.least_squares.sliding_circle_fits()) and the first that is an arc is taken
+    k = find_arcs(scan_cartesian[:readings_about_center * 2 - 1], [pendulum_width], threshold).get(pendulum_width)
+    if k is not None:
+        pendulum_arc_in_scan = scan[k: k + pendulum_width]
+        # x = [cord[2] for cord in pendulum_arc_in_scan]
+        # pendumum_width_degrees = pendulum_arc_in_scan[-1][1] - pendulum_arc_in_scan[0][1]
+        # print(f"find_pendulum_arc Angle: {pendumum_width_degrees} max x diff: {max(x)-min(x)}")
+        return pendulum_arc_in_scan
     return None
 
 class Swing:
@@ -119,7 +119,8 @@ def determine_search_parameters(readings_about_center = 40, pendulum_width= 35,
 
     Each of these tests must succeed TESTS_CNT times.
 
-    The entire search can take on the order of 3 minutes, smaller if the initial guesses are close, but that risks
+    The entire search can take on the order of 3 minutes (most of it waiting for the TESTS_CNT scans of each step;
+    the windows of a scan are all fit at once), smaller if the initial guesses are close, but that risks
     not finding the values. You should error on the size of a large initial readings_about_center and a small
     pendulum_width.
 
@@ -0,0 +1,166 @@
+import os
+import logging
+import numpy as np
+from multiprocessing import shared_memory
+from lidar.find_proximal_points import segment_scan
+
+logger = logging.getLogger(__name__)
+
+# A model of the static background of the clock case (everything but the pendulum) as the range seen at each angle.
+# The scan angles are binned and each bin keeps a streaming estimate of a high quantile of its ranges (ranges past
+# the scan radius count as the scan radius): q += step * (quantile - (range < q)). While the model is learning the
+# step is large so that it settles within learn_scans scans, afterward it is small so that the background only
+# follows slow changes (and a pendulum that stopped for a long time becomes part of it).
+#
+# The points of a scan that are nearer than the background by more than deviation_mm are in the foreground. The
+# pendulum is the segment of the scan (see lidar.find_proximal_points.segment_scan) with the most foreground
+# points. It needn't move between scans to be found, and only one scan is segmented. Where the pendulum covers a bin
+# for more of its swing than the quantile allows for, the pendulum is the background there, so the segment rather
+# than only its foreground points is used.
+#
+# The model is in shared memory so that the pool workers that run find_pendulum_process all update and use the same
+# one; updates may race, which loses the odd step. run_scanner() saves it to disk so that a restart doesn't have
+# to learn it again.
+
+_HEADER_DTYPE = np.dtype([('scans', np.int64)])
+
+
+class BackgroundModel:
+    """
+    bins: angle bins over 360 degrees. quantile: of the ranges in a bin that is the background.
+    learn_scans: scans to learn the model at learn_step_mm, after which it is updated at step_mm.
+    deviation_mm: how much nearer than the background a point is to be in the foreground.
+    min_points: foreground points needed in a segment for it to be the pendulum.
+    """
+
+    def __init__(self, bins=720, quantile=0.9, learn_scans=150, learn_step_mm=20.0, step_mm=0.5,
+                 deviation_mm=30.0, min_points=3, name=None):
+        self.bins = bins
+        self.quantile = quantile
+        self.learn_scans = learn_scans
+        self.learn_step_mm = learn_step_mm
+        self.step_mm = step_mm
+        self.deviation_mm = deviation_mm
+        self.min_points = min_points
+        size = _HEADER_DTYPE.itemsize + np.dtype(np.float64).itemsize * bins
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            try:
+                # Python 3.13+; the creating process is responsible for unlinking the memory
+                self._shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self.header = np.ndarray((1,), dtype=_HEADER_DTYPE, buffer=self._shm.buf)
+        self.ranges = np.ndarray((bins,), dtype=np.float64, buffer=self._shm.buf, offset=_HEADER_DTYPE.itemsize)
+        if self._owner:
+            self.header['scans'] = 0
+            self.ranges[:] = np.nan
+
+    @property
+    def spec(self):
+        """What a worker needs to attach to the model (see attach_background)."""
+        return (self.name, self.bins, self.quantile, self.learn_scans, self.learn_step_mm, self.step_mm,
+                self.deviation_mm, self.min_points)
+
+    @property
+    def scans(self):
+        return int(self.header['scans'][0])
+
+    @property
+    def ready(self):
+        return self.scans >= self.learn_scans
+
+    def _bin(self, angle):
+        return (np.asarray(angle) * (self.bins / 360.0)).astype(np.intp) % self.bins
+
+    def update(self, scan, scan_radius_mm):
+        """Update the model with a scan (a structured array of (quality, angle, distance))."""
+        scan = scan[scan['distance'] > 0]
+        index = self._bin(scan['angle'])
+        distance = np.minimum(scan['distance'], scan_radius_mm)
+        q = self.ranges[index]
+        step = self.step_mm if self.ready else self.learn_step_mm
+        self.ranges[index] = np.where(np.isnan(q), distance, q + step * (self.quantile - (distance < q)))
+        self.header['scans'] += 1
+
+    def foreground(self, scan, scan_radius_mm):
+        """A mask of the points of 'scan' within scan_radius_mm that are nearer than the background."""
+        distance = scan['distance']
+        background = self.ranges[self._bin(scan['angle'])]
+        with np.errstate(invalid='ignore'):
+            return (distance > 0) & (distance < scan_radius_mm) & (distance < background - self.deviation_mm)
+
+    def find_pendulum(self, scan, scan_radius_mm):
+        """
+        The pendulum points of 'scan' in the format of find_dissimilar_scans(): a list of [x, y], or [number of
+        foreground points] when there is no segment with min_points of them.
+        """
+        foreground = self.foreground(scan, scan_radius_mm)
+        found = int(np.count_nonzero(foreground))
+        if found < self.min_points:
+            return [found]
+        order, xy, ranges = segment_scan(scan, scan_radius_mm)
+        if len(ranges) == 0:
+            return [found]
+        # The foreground points in each segment from their cumulative sum
+        cumulative = np.concatenate(([0], np.cumsum(foreground[order])))
+        hits = cumulative[ranges[:, 1]] - cumulative[ranges[:, 0]]
+        best = int(np.argmax(hits))
+        if hits[best] < self.min_points:
+            return [found]
+        start, stop = ranges[best]
+        return xy[start:stop].tolist()
+
+    def save(self, path):
+        """Write the model to 'path' (a .npz file) once it has been learned."""
+        if not self.ready:
+            return False
+        temp = path + '.tmp.npz'
+        np.savez(temp, ranges=self.ranges, quantile=self.quantile, scans=self.scans)
+        os.replace(temp, path)
+        return True
+
+    def load(self, path):
+        """Read a model saved by save(); False if there is none or it has a different number of bins."""
+        if not path or not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as saved:
+                ranges = saved['ranges']
+                quantile = float(saved['quantile'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Unable to read the background model {path}: {e}")
+            return False
+        if len(ranges) != self.bins or quantile != self.quantile:
+            logger.warning(f"The background model {path} has {len(ranges)} bins at quantile {quantile}"
+                           f"; learning a new one")
+            return False
+        self.ranges[:] = ranges
+        self.header['scans'] = self.learn_scans
+        logger.info(f"Loaded the background model {path}")
+        return True
+
+    def close(self):
+        # The numpy views must be released before the shared memory can be closed
+        self.header = None
+        self.ranges = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+_attached = {}
+
+
+def attach_background(spec):
+    """Attach to a BackgroundModel given its spec; attachments are cached for the life of the (worker) process."""
+    model = _attached.get(spec[0])
+    if model is None:
+        name, bins, quantile, learn_scans, learn_step_mm, step_mm, deviation_mm, min_points = spec
+        model = BackgroundModel(bins, quantile, learn_scans, learn_step_mm, step_mm, deviation_mm, min_points,
+                                name=name)
+        _attached[name] = model
+    return model
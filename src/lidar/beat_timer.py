@@ -0,0 +1,170 @@
+import math
+import logging
+from collections import deque
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Times each beat (half swing) of the pendulum from the positions of its edges in consecutive scans, rather than
+# averaging them away in the minute and hour fits. BeatTimer.update() is given the scans in batches and returns a
+# BEAT_DTYPE record for each beat completed in them.
+#
+# The direction change logic of Pendulum.update_max_swing_angles() (monitor_pendulum_w_display.py) compares angles
+# with the largest ones seen so far, which doesn't work when they cross 0. Here the position of the pendulum is the
+# middle of its edges in mm, and a beat ends when it crosses the centre of the swing (the middle of the last two
+# turning points). A crossing is only counted once the position is more than hysteresis of the amplitude past the
+# centre on the other side, and its time is where a straight line fit to the points from the last one on the old
+# side to the first one on the new side crosses the centre, so it falls between the scans. The turning point of a
+# beat is the vertex of a parabola fit to the points within turning_window periods of its most extreme point.
+#
+# The classification of the points against the centre, and finding the crossings, is done for the whole batch at
+# once; only the few beats in a batch are handled one at a time. The points from the last crossing on are kept for
+# the next batch.
+#
+# For each beat: time (of the crossing that ends it), direction (+1 when the position crosses the centre increasing),
+# half_period (from the crossing before), period (from two crossings before), asymmetry (half_period less the one
+# before it; a clock that is out of beat has unequal ticks and tocks), amplitude (of its turning point from the
+# centre, in mm), and turning_time.
+
+BEAT_DTYPE = np.dtype([('time', np.float64), ('direction', np.int8), ('half_period', np.float64),
+                       ('period', np.float64), ('asymmetry', np.float64), ('amplitude', np.float64),
+                       ('turning_time', np.float64)])
+
+
+class BeatTimer:
+    """
+    period: the expected pendulum period (sec). hysteresis: of the amplitude past the centre to count a crossing.
+    turning_window: periods either side of the most extreme point used to fit the turning point.
+    min_amplitude_mm: below this the pendulum is taken to be stopped. recent_beats: beats kept for summary().
+    """
+
+    def __init__(self, period=2.0, hysteresis=0.1, turning_window=0.125, min_amplitude_mm=5.0, recent_beats=60):
+        self.period = period
+        self.hysteresis = hysteresis
+        self.turning_window = turning_window
+        self.min_amplitude_mm = min_amplitude_mm
+        self.centre = None
+        self.amplitude = None
+        self.beats = 0
+        self.gaps = 0
+        self._t = np.empty(0)
+        self._x = np.empty(0)
+        self._side = 0
+        self._crossings = []
+        self._half_period = math.nan
+        self._turning = []
+        self.recent = deque(maxlen=recent_beats)
+
+    def _start(self, t, x):
+        """Take the centre and amplitude from a period of points."""
+        high, low = x.max(), x.min()
+        self.centre = (high + low) / 2.0
+        self.amplitude = (high - low) / 2.0
+
+    def _crossing_time(self, t, x):
+        """Where the line fit to the points crosses the centre."""
+        t_mean, x_mean = t.mean(), x.mean()
+        dt = t - t_mean
+        slope = np.dot(dt, x - x_mean) / np.dot(dt, dt)
+        return t_mean + (self.centre - x_mean) / slope
+
+    def _turning_point(self, t, x, sign):
+        """The (time, position) of the vertex of a parabola fit around the most extreme point (sign * x)."""
+        peak = int(np.argmax(sign * x))
+        near = np.abs(t - t[peak]) <= self.turning_window * self.period
+        if np.count_nonzero(near) < 3:
+            return t[peak], x[peak]
+        tn = t[near] - t[peak]
+        a, b, c = np.polyfit(tn, x[near], 2)
+        if a * sign >= 0.0:
+            # Not a turning point of this shape; use the extreme point itself
+            return t[peak], x[peak]
+        vertex = -b / (2.0 * a)
+        if abs(vertex) > self.turning_window * self.period:
+            return t[peak], x[peak]
+        return t[peak] + vertex, c - b * b / (4.0 * a)
+
+    def update(self, t, first, last):
+        """
+        Add the scans at times t (sec) where the pendulum's edges were at first and last (mm), in time order.
+        Returns the beats completed by them as an array of BEAT_DTYPE.
+        """
+        t = np.concatenate((self._t, np.asarray(t, dtype=np.float64)))
+        x = np.concatenate((self._x, (np.asarray(first, dtype=np.float64) + np.asarray(last, dtype=np.float64)) / 2.0))
+        beats = []
+        if self.centre is None:
+            if len(t) < 2 or t[-1] - t[0] < self.period:
+                self._t, self._x = t, x
+                return np.array(beats, dtype=BEAT_DTYPE)
+            self._start(t, x)
+        if self.amplitude < self.min_amplitude_mm:
+            # Stopped (or not there); start over with the next period of points
+            self.centre = None
+            self._side = 0
+            self._crossings = []
+            self._turning = []
+            keep = t >= t[-1] - self.period
+            self._t, self._x = t[keep], x[keep]
+            return np.array(beats, dtype=BEAT_DTYPE)
+
+        band = self.hysteresis * self.amplitude
+        side = np.where(x > self.centre + band, 1, np.where(x < self.centre - band, -1, 0))
+        # The side each point is on, carrying the last side through the band around the centre
+        index = np.where(side != 0, np.arange(len(side)), -1)
+        np.maximum.accumulate(index, out=index)
+        carried = np.where(index >= 0, side[np.maximum(index, 0)], self._side)
+        previous = np.concatenate(([self._side], carried[:-1]))
+        switches = np.flatnonzero((carried != previous) & (previous != 0))
+
+        start = 0
+        for i in switches:
+            # The last point on the old side to the first on the new one
+            j = index[i - 1] if i > 0 and index[i - 1] >= 0 else 0
+            crossing = self._crossing_time(t[j:i + 1], x[j:i + 1]) if i > j else t[i]
+            direction = int(carried[i])
+            if self._crossings and crossing - self._crossings[-1] > 0.75 * self.period:
+                # Scans were missing; the beat can't be timed
+                self.gaps += 1
+                self._crossings = []
+                self._turning = []
+                self._half_period = math.nan
+            if self._crossings:
+                # The beat's turning point is between the crossings; before an increasing crossing it is a minimum
+                turning_time, turning = self._turning_point(t[start:j + 1], x[start:j + 1], -direction)
+                half_period = crossing - self._crossings[-1]
+                period = crossing - self._crossings[-2] if len(self._crossings) > 1 else math.nan
+                beats.append((crossing, direction, half_period, period, half_period - self._half_period,
+                              abs(turning - self.centre), turning_time))
+                self._half_period = half_period
+                self._turning = (self._turning + [turning])[-2:]
+                if len(self._turning) == 2:
+                    self.centre = (self._turning[0] + self._turning[1]) / 2.0
+                    self.amplitude = abs(self._turning[0] - self._turning[1]) / 2.0
+            self._crossings = (self._crossings + [crossing])[-2:]
+            start = i
+        self._side = int(carried[-1]) if len(carried) else self._side
+        # Keep the points of the beat in progress (but not more than a couple of periods of them)
+        t, x = t[start:], x[start:]
+        recent = t >= t[-1] - 2.0 * self.period
+        self._t, self._x = t[recent], x[recent]
+        self.beats += len(beats)
+        self.recent.extend(beats)
+        return np.array(beats, dtype=BEAT_DTYPE)
+
+    def summary(self):
+        """Statistics of the recent beats for the telemetry summary; {} until there are some."""
+        beats = np.array(list(self.recent), dtype=BEAT_DTYPE)
+        if len(beats) < 2:
+            return {}
+        increasing = beats['half_period'][beats['direction'] > 0]
+        decreasing = beats['half_period'][beats['direction'] < 0]
+        periods = beats['period'][~np.isnan(beats['period'])]
+        record = {'beats': self.beats, 'gaps': self.gaps,
+                  'amplitude_mm': round(float(beats['amplitude'].mean()), 1)}
+        if len(periods):
+            record['period_sec'] = round(float(periods.mean()), 5)
+            record['period_std_sec'] = round(float(periods.std()), 5)
+        if len(increasing) and len(decreasing):
+            # Out of beat: the beats ending in one direction are longer than those in the other
+            record['beat_error_sec'] = round(float(increasing.mean() - decreasing.mean()) / 2.0, 5)
+        return record
@@ -1,5 +1,7 @@
 import math
+import numpy as np
 from rplidar import RPLidar
+from lidar.rplidar_protocol import RPLidarNative, ignore_missing_modem_lines
 import logging
 
 logger = logging.getLogger(__name__)
@@ -19,6 +21,22 @@ logger.setLevel(logging.INFO) # Set the minimum level for this logger
 #
 # SCAN_RADIUS_MM = 500.0
 
+# Scan info: <time, left_most_point, right_most_point> of the pendulum found in a scan
+NANOS_FIRST_N_LAST_DTYPE = np.dtype([('time', np.float64), ('first', np.float64), ('last', np.float64)])
+# What find_pendulum_process returns for each scan: the scan info, and the segment_polar() of the pendulum for
+# lidar.pendulum_tracker. All but the time are NaN when the pendulum wasn't found, and the time is NaN when the scan
+# was lost.
+DETECTION_DTYPE = np.dtype(NANOS_FIRST_N_LAST_DTYPE.descr + [('centre', np.float64), ('half_width', np.float64),
+                                                             ('distance_min', np.float64),
+                                                             ('distance_max', np.float64)])
+# The rows of the 'scans' series of the store (see lidar.detection_pipeline): the result of the scan, and the position,
+# velocity, period, and amplitude of each edge estimated by its lidar.pendulum_filter.PendulumFilter at the scan.
+# The estimates are NaN when the scan wasn't used by the filters (the pendulum wasn't found or it was a spike).
+SCAN_RECORD_DTYPE = np.dtype(DETECTION_DTYPE.descr + [('first_position', np.float64), ('first_velocity', np.float64),
+                                                      ('first_period', np.float64), ('first_amplitude', np.float64),
+                                                      ('last_position', np.float64), ('last_velocity', np.float64),
+                                                      ('last_period', np.float64), ('last_amplitude', np.float64)])
+
 def _polar_to_cartesian(r, theta):
     """
     Converts single polar coordinates (radius r, angle theta in radians)
@@ -36,8 +54,18 @@ def lidar_readings_to_cartesian(readings):
     """
     return [_polar_to_cartesian(x[2], math.radians(x[1])) for x in readings]
 
-def startup_lidar(port, baud_rate, motor_rpm, rplidar_logger):
-    lidar = RPLidar(port, baud_rate, logger=rplidar_logger)
+def startup_lidar(port, baud_rate, motor_rpm, rplidar_logger, driver='roboticia', scan_mode='normal'):
+    """
+    Connect to the LIDAR.
+    driver: 'roboticia' uses the rplidar-roboticia RPLidar, 'native' uses lidar.rplidar_protocol.RPLidarNative
+    which decodes straight into NumPy arrays and supports the express and boost scan modes given by scan_mode.
+    """
+    if driver == 'native':
+        lidar = RPLidarNative(port, baud_rate, logger=rplidar_logger, scan_mode=scan_mode)
+    elif driver == 'roboticia':
+        lidar = RPLidar(port, baud_rate, logger=rplidar_logger)
+    else:
+        raise ValueError(f"Unknown LIDAR driver: {driver}")
     #lidar.motor_speed = motor_rpm
     lidar.clean_input()
 
@@ -48,6 +76,7 @@ def startup_lidar(port, baud_rate, motor_rpm, rplidar_logger):
     logger.info(f"Lidar Health: {health}")
 
     lidar.connect()
+    ignore_missing_modem_lines(lidar._serial)
     lidar.clean_input()
 
     return lidar
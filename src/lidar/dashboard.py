@@ -0,0 +1,247 @@
+import re
+import json
+import math
+import logging
+import argparse
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import requests
+from lidar.timeseries_store import TimeSeriesStore
+from lidar.rollup import estimate
+
+logger = logging.getLogger(__name__)
+
+# A local dashboard of the results kept in a lidar.timeseries_store.TimeSeriesStore, run in a process of its own so
+# that nothing it does is on the acquisition loop of run_scanner(); it only reads the store's files (which the loop
+# appends to without locks) and the telemetry summary (which the Telemetry thread serves on [Telemetry] METRICS_PORT).
+#
+#   /                      a page that charts any field of any series over the last hour, day, week, or everything
+#   /api/series            the series and their fields
+#   /api/data?series=beats&field=period&seconds=604800&points=1000
+#                          [[time, value], ...] downsampled to 'points' points
+#   /metrics               Prometheus text: the telemetry summary, the rows of each series, the last minute's
+#                          rollup, and the last beat
+#
+# The points are downsampled on the server with largest triangle three buckets (LTTB): the points are split into
+# buckets and from each the point that makes the largest triangle with the point kept from the bucket before and the
+# mean of the bucket after is kept, which keeps the peaks and the shape that a plain decimation loses. Only the time
+# and the one field are read from the store, so a week of beats is charted in a few milliseconds.
+
+PREFIX = 'clock'
+
+
+def lttb(x, y, points):
+    """The indexes of the 'points' points of (x, y) that largest triangle three buckets keeps."""
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+    # The first and last points are always kept; the rest are split into points - 2 buckets
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    keep = np.empty(points, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    # The mean of each bucket, for the bucket before it
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    mean_x = np.append(sums_x / sizes, x[-1])
+    mean_y = np.append(sums_y / sizes, y[-1])
+    a = 0
+    for i in range(points - 2):
+        start, stop = edges[i], edges[i + 1]
+        cx, cy = mean_x[i + 1], mean_y[i + 1]
+        bx, by = x[start:stop], y[start:stop]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def _metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join((PREFIX,) + parts))
+
+
+def prometheus_text(values):
+    """Prometheus text exposition of the numbers in a (nested) dict, as gauges named by their keys."""
+    lines = []
+
+    def walk(record, parts):
+        for key, value in record.items():
+            if isinstance(value, dict):
+                walk(value, parts + (str(key),))
+            elif isinstance(value, (bool, int, float, np.number)) and not (isinstance(value, float) and
+                                                                           math.isnan(value)):
+                name = _metric_name(*parts, str(key))
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {float(value)!r}")
+    walk(values, ())
+    return '\n'.join(lines) + '\n'
+
+
+class Dashboard:
+    """
+    store_directory: of the TimeSeriesStore. telemetry_url: the Telemetry metrics (JSON) to include in /metrics;
+    none when empty. period: the expected pendulum period (for the rollup estimates).
+    """
+
+    def __init__(self, store_directory, telemetry_url='', period=2.0):
+        self.store = TimeSeriesStore(store_directory, readonly=True)
+        self.telemetry_url = telemetry_url
+        self.omega0 = 2.0 * math.pi / period
+
+    def _series(self, name):
+        try:
+            return self.store.series(name)
+        except FileNotFoundError:
+            return None
+
+    def series(self):
+        return {name: list(self.store.series(name).dtype.names) for name in self.store.names()}
+
+    def data(self, name, field, seconds=None, points=1000):
+        series = self._series(name)
+        if series is None or field not in series.dtype.names:
+            return None
+        last = series.last_time()
+        if last is None:
+            return []
+        start = last - seconds if seconds else -np.inf
+        rows = series.read(start, np.inf, fields=(series.time_field, field))
+        x, y = rows[series.time_field], rows[field].astype(np.float64)
+        good = ~np.isnan(y)
+        x, y = x[good], y[good]
+        keep = lttb(x, y, points)
+        return np.column_stack((x[keep], y[keep])).tolist()
+
+    def metrics(self):
+        values = {}
+        if self.telemetry_url:
+            try:
+                values['telemetry'] = requests.get(self.telemetry_url, timeout=2.0).json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f"Unable to read the telemetry {self.telemetry_url}: {e}")
+        text = prometheus_text(values) + f"# TYPE {_metric_name('store_rows')} gauge\n"
+        for name in self.store.names():
+            series = self.store.series(name)
+            text += f"{_metric_name('store_rows')}{{series=\"{name}\"}} {series.count}\n"
+        for name in self.store.names():
+            series = self.store.series(name)
+            if series.last_time() is None:
+                continue
+            last = series.read(series.last_time(), np.inf)[-1]
+            if name == 'minutes':
+                text += prometheus_text({'minute': estimate(last, self.omega0)})
+            elif name == 'beats':
+                text += prometheus_text({'beat': {key: last[key] for key in last.dtype.names}})
+        return text
+
+    def serve(self, port):
+        dashboard = self
+
+        class DashboardHandler(BaseHTTPRequestHandler):
+            def _send(self, body, content_type):
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                try:
+                    if url.path == '/':
+                        self._send(_PAGE, 'text/html; charset=utf-8')
+                    elif url.path == '/metrics':
+                        self._send(dashboard.metrics(), 'text/plain; version=0.0.4')
+                    elif url.path == '/api/series':
+                        self._send(json.dumps(dashboard.series()), 'application/json')
+                    elif url.path == '/api/data':
+                        seconds = float(query['seconds']) if query.get('seconds') else None
+                        data = dashboard.data(query.get('series', ''), query.get('field', ''), seconds,
+                                              int(query.get('points', 1000)))
+                        if data is None:
+                            self.send_error(404)
+                        else:
+                            self._send(json.dumps(data), 'application/json')
+                    else:
+                        self.send_error(404)
+                except ValueError:
+                    self.send_error(400)
+                except OSError as e:
+                    # e.g. a series the writer is still creating
+                    logger.warning(f"Dashboard {url.path}: {e}")
+                    self.send_error(503)
+
+            def log_message(self, format, *args):
+                pass
+
+        class DashboardServer(ThreadingHTTPServer):
+            allow_reuse_address = True
+
+        server = DashboardServer(('127.0.0.1', port), DashboardHandler)
+        logger.warning(f"Dashboard on http://127.0.0.1:{port}/")
+        server.serve_forever()
+
+
+def serve_dashboard(store_directory, port, telemetry_url='', period=2.0):
+    """The target of the dashboard's process (see monitor_pendulum.py)."""
+    logging.basicConfig(level=logging.WARNING)
+    Dashboard(store_directory, telemetry_url, period).serve(port)
+
+
+_PAGE = """<!DOCTYPE html>
+<html><head><title>Clock</title><style>
+body { font-family: sans-serif; margin: 1em; } canvas { border: 1px solid #ccc; width: 100%; height: 420px; }
+</style></head><body>
+<select id="series"></select> <select id="field"></select>
+<select id="seconds"><option value="3600">hour</option><option value="86400" selected>day</option>
+<option value="604800">week</option><option value="">all</option></select>
+<span id="status"></span>
+<canvas id="chart" width="1200" height="420"></canvas>
+<script>
+let fields = {};
+const $ = id => document.getElementById(id);
+async function load() {
+  fields = await (await fetch('/api/series')).json();
+  $('series').innerHTML = Object.keys(fields).map(s => `<option>${s}</option>`).join('');
+  pick();
+}
+function pick() {
+  $('field').innerHTML = (fields[$('series').value] || []).slice(1).map(f => `<option>${f}</option>`).join('');
+  draw();
+}
+async function draw() {
+  const started = performance.now();
+  const query = `series=${$('series').value}&field=${$('field').value}&seconds=${$('seconds').value}&points=1200`;
+  const points = await (await fetch('/api/data?' + query)).json();
+  const canvas = $('chart'), context = canvas.getContext('2d');
+  context.clearRect(0, 0, canvas.width, canvas.height);
+  $('status').textContent = `${points.length} points in ${(performance.now() - started).toFixed(0)} ms`;
+  if (points.length < 2) return;
+  const xs = points.map(p => p[0]), ys = points.map(p => p[1]);
+  const x0 = Math.min(...xs), x1 = Math.max(...xs), y0 = Math.min(...ys), y1 = Math.max(...ys);
+  const sx = x => 50 + (x - x0) / (x1 - x0 || 1) * (canvas.width - 60);
+  const sy = y => canvas.height - 20 - (y - y0) / (y1 - y0 || 1) * (canvas.height - 40);
+  context.fillText(y1.toPrecision(7), 2, 14); context.fillText(y0.toPrecision(7), 2, canvas.height - 20);
+  context.fillText(new Date(x0 * 1000).toLocaleString(), 50, canvas.height - 4);
+  context.fillText(new Date(x1 * 1000).toLocaleString(), canvas.width - 160, canvas.height - 4);
+  context.beginPath();
+  points.forEach((p, i) => i ? context.lineTo(sx(p[0]), sy(p[1])) : context.moveTo(sx(p[0]), sy(p[1])));
+  context.stroke();
+}
+$('series').onchange = pick; $('field').onchange = draw; $('seconds').onchange = draw;
+load(); setInterval(draw, 60000);
+</script></body></html>
+"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the dashboard of a monitor_pendulum store.")
+    parser.add_argument("store", help="[Store] DIRECTORY of config.ini")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--telemetry", default='', help="The telemetry metrics URL, e.g. http://127.0.0.1:8000/metrics")
+    parser.add_argument("--period", type=float, default=2.0)
+    args = parser.parse_args()
+    serve_dashboard(args.store, args.port, args.telemetry, args.period)
@@ -0,0 +1,297 @@
+import queue
+import logging
+import threading
+from collections import deque
+import numpy as np
+from lidar.const import DETECTION_DTYPE, SCAN_RECORD_DTYPE
+from lidar.rollup import estimate
+
+logger = logging.getLogger(__name__)
+
+# What run_scanner() does with the detections (the DETECTION_DTYPE rows of 'find_pendulum_process') once they are
+# back in scan order, in a thread of its own so that none of it is done in the acquisition loop, which only puts the
+# rows it releases on a bounded queue (add()) and hands the events that come back to the pool (events()).
+#
+# Each scan goes through, in order:
+#
+#   spike filter    a lidar.remove_outliers.HampelFilter of both edges: a scan where either edge is a spike against
+#                   the half_window scans either side of it is a failure. A scan is decided half_window scans after
+#                   it arrives, which delays the rest of the pipeline (not the acquisition loop) by as much.
+#   edge filters    a lidar.pendulum_filter.PendulumFilter of each edge, which gives its position, velocity, period,
+#                   and amplitude at every scan. With reject a scan where either edge fails the innovation gate is a
+#                   failure; without it the gate's outliers are only counted (in the filters' rejections). With
+#                   filtered the positions of the filters rather than the measured edges go on to everything below.
+#   minute window   the scans that weren't failures are written into the window ring slot; when it has window_points
+#                   it is published and a 'minute' event hands it to pendulum_info_min_process.
+#   hour's fit      a lidar.fit_sine_with_fft_guess.StreamingSineFit of the first edge.
+#   beats           a lidar.beat_timer.BeatTimer (optional).
+#   rollup          a lidar.rollup.Rollup of the points, the blocks of the StreamingSineFit, the beats, and the
+#                   failures; an 'hour' event has the estimate() of each hour the rollup closes.
+#   store           the rows of every scan (SCAN_RECORD_DTYPE, with the estimates of the edge filters), the beats,
+#                   and the rollup records are appended to a lidar.timeseries_store.StoreWriter (optional) with wall
+#                   clock times. The rows of the scans wait for the spike filter so that they are stored in order.
+#
+# When the thread falls so far behind that the queue is full the rows are dropped and counted (as failures of the
+# window and the rollup) rather than holding up the acquisition loop.
+
+# The fields of each series of the store that are scan times (the rollup records are on the wall clock already)
+STORE_TIME_FIELDS = {'scans': ('time',), 'beats': ('time', 'turning_time'), 'minutes': (), 'hours': (), 'days': ()}
+
+
+def store_rows(store, name, rows, clock_offset):
+    """
+    Append rows to the series 'name' of the store (a StoreWriter) with their times on the wall clock (time.time()).
+    """
+    rows = rows.copy()
+    for field in STORE_TIME_FIELDS[name]:
+        rows[field] += clock_offset
+    store.append(name, rows)
+
+
+class DetectionPipeline:
+    """
+    window_ring: the lidar.shared_ring.SharedRing of the minute windows (NANOS_FIRST_N_LAST_DTYPE); window_points:
+    the points of a window. sine_fit, rollup: the StreamingSineFit and Rollup. spike_filter (HampelFilter of 2
+    columns), edge_filters (a PendulumFilter of each edge), beat_timer, store (StoreWriter): None to leave them out.
+    reject, filtered: see [Filter] REJECT and FILTERED. clock_offset: time.time() - time.perf_counter() of the scan
+    times. queue_size: batches of rows waiting.
+
+    events() gives ('minute', window seq, processing time, failures) when a window has been published, and ('hour',
+    hour seq, period, r_squared) of each hour the rollup closes that has enough points for its fit.
+    """
+
+    def __init__(self, window_ring, window_points, sine_fit, rollup, spike_filter=None, edge_filters=None,
+                 reject=False, filtered=False, beat_timer=None, store=None, clock_offset=0.0, queue_size=1024):
+        self.window_ring = window_ring
+        self.window_points = window_points
+        self.sine_fit = sine_fit
+        self.rollup = rollup
+        self.spike_filter = spike_filter
+        self.edge_filters = edge_filters
+        self.reject = reject
+        self.filtered = filtered
+        self.beat_timer = beat_timer
+        self.store = store
+        self.clock_offset = clock_offset
+        self.dropped = 0
+        # The dropped rows that the thread has counted as failures
+        self._dropped_counted = 0
+        self._rows = queue.Queue(maxsize=queue_size)
+        self._events = queue.SimpleQueue()
+        self._thread = None
+        self._window_seq = 0
+        self._window = window_ring.claim(0)
+        self._window_len = 0
+        self._window_failures = 0
+        self._start_time = None
+        self._rollup_failures = 0
+        self._hour_seq = 0
+        self._sine_fit_blocks = 0
+        # The (time, first, last) of the scans used since the rollup was last updated
+        self._released = []
+        # [row of SCAN_RECORD_DTYPE, decided] of each scan in order, until it is decided and stored
+        self._records = deque()
+        # The rollup records that are in the store
+        self._stored_rollups = {'minutes': 0, 'hours': 0, 'days': 0}
+
+    def add(self, rows):
+        """Queue the rows (DETECTION_DTYPE, in scan order; a scan whose task was lost has NaN in every field)."""
+        try:
+            self._rows.put_nowait(np.array(rows, dtype=DETECTION_DTYPE))
+        except queue.Full:
+            if self.dropped == 0:
+                logger.error("The detection pipeline is behind; dropping scans")
+            self.dropped += len(rows)
+
+    def events(self):
+        """Generator over the events since the last call; it doesn't wait."""
+        while True:
+            try:
+                yield self._events.get_nowait()
+            except queue.Empty:
+                return
+
+    def _run(self):
+        while True:
+            rows = self._rows.get()
+            try:
+                if rows is None:
+                    # The scans waiting for the spike filter are decided with the scans there are
+                    if self.spike_filter is not None:
+                        for decided in self._spike_decided(self.spike_filter.flush()):
+                            self._use(*decided)
+                    self._finish()
+                    return
+                self._process(rows)
+            except Exception as e:
+                logger.error(f"Detection pipeline: {e}", exc_info=(type(e), e, e.__traceback__))
+
+    @staticmethod
+    def _spike_decided(decided):
+        return [(t, edges[0], edges[1], record, not any(outliers)) for t, edges, record, outliers in decided]
+
+    def _decide(self, t, first, last, record):
+        """The scans decided now, as (time, first, last, record, False when it is a failure)."""
+        if first != first:
+            # Lost, or the pendulum wasn't found
+            return [(t, first, last, record, False)]
+        if self.spike_filter is None:
+            return [(t, first, last, record, True)]
+        return self._spike_decided(self.spike_filter.update(t, (first, last), record))
+
+    def _use(self, t, first, last, record, used):
+        """Pass a decided scan on to the edge filters and, unless it is a failure, everything after them."""
+        if used and self.edge_filters is not None:
+            accepted = self.edge_filters[0].update(t, first)
+            accepted = self.edge_filters[1].update(t, last) and accepted
+            if record is not None:
+                row = record[0]
+                for edge, edge_filter in zip(('first', 'last'), self.edge_filters):
+                    row[edge + '_position'] = edge_filter.position
+                    row[edge + '_velocity'] = edge_filter.velocity
+                    row[edge + '_period'] = edge_filter.period
+                    row[edge + '_amplitude'] = edge_filter.amplitude
+            if self.filtered:
+                first, last = self.edge_filters[0].position, self.edge_filters[1].position
+            used = accepted or not self.reject
+        if record is not None:
+            record[1] = True
+        if not used:
+            self._window_failures += 1
+            self._rollup_failures += 1
+            return
+        point = (t, first, last)
+        self._window[self._window_len] = point
+        self._window_len += 1
+        self.sine_fit.add(t, first)
+        self._released.append(point)
+        if self._window_len >= self.window_points:
+            self._publish(t)
+
+    def _process(self, rows):
+        dropped = self.dropped - self._dropped_counted
+        self._dropped_counted += dropped
+        self._window_failures += dropped
+        self._rollup_failures += dropped
+        scanned = ~np.isnan(rows['time'])
+        if self._start_time is None and scanned.any():
+            self._start_time = float(rows['time'][scanned][0])
+        records = np.full(len(rows), np.nan, dtype=SCAN_RECORD_DTYPE)
+        for name in DETECTION_DTYPE.names:
+            records[name] = rows[name]
+        for i, (t, first, last) in enumerate(zip(rows['time'].tolist(), rows['first'].tolist(),
+                                                 rows['last'].tolist())):
+            # A lost scan isn't stored
+            record = None
+            if self.store is not None and scanned[i]:
+                record = [records[i], False]
+                self._records.append(record)
+            for decided in self._decide(t, first, last, record):
+                self._use(*decided)
+        self._finish()
+
+    def _finish(self):
+        """Update the rollup with the scans used and store the scans that have been decided."""
+        self._roll_up(self._released)
+        self._released = []
+        decided = []
+        while self._records and self._records[0][1]:
+            decided.append(self._records.popleft()[0])
+        if self.store is not None and decided:
+            store_rows(self.store, 'scans', np.array(decided, dtype=SCAN_RECORD_DTYPE), self.clock_offset)
+
+    def _publish(self, t):
+        self.window_ring.publish(self._window_seq, self._window_len, t)
+        self._events.put(('minute', self._window_seq, t - self._start_time, self._window_failures))
+        self._start_time = t
+        self._window_failures = 0
+        self._window_seq += 1
+        self._window = self.window_ring.claim(self._window_seq)
+        self._window_len = 0
+
+    def _roll_up(self, released):
+        if not released and not self._rollup_failures:
+            return
+        released = np.array(released).reshape(-1, 3)
+        for hour in self.rollup.add_points(released[:, 0], released[:, 1], released[:, 2], self._rollup_failures):
+            fit_hr = estimate(hour, self.rollup.omega0)
+            if 'period' not in fit_hr:
+                logger.warning("Not enough points for the hour's sine fit")
+            else:
+                self._events.put(('hour', self._hour_seq, fit_hr['period'], fit_hr['r_squared']))
+            self._hour_seq += 1
+        self._rollup_failures = 0
+        self.rollup.add_blocks(self.sine_fit.blocks_since(self._sine_fit_blocks))
+        self._sine_fit_blocks = self.sine_fit.block_count
+        if self.beat_timer is not None and len(released):
+            beats = self.beat_timer.update(released[:, 0], released[:, 1], released[:, 2])
+            self.rollup.add_beats(beats)
+            if self.store is not None and len(beats):
+                store_rows(self.store, 'beats', beats, self.clock_offset)
+        if self.store is not None:
+            for name, ring in (('minutes', self.rollup.minutes), ('hours', self.rollup.hours),
+                               ('days', self.rollup.days)):
+                if ring.count > self._stored_rollups[name]:
+                    store_rows(self.store, name, ring.latest(ring.count - self._stored_rollups[name]),
+                               self.clock_offset)
+                    self._stored_rollups[name] = ring.count
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='DetectionPipeline', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Process what is queued (and the scans waiting for the spike filter) and stop the thread."""
+        if self._thread is None:
+            return
+        self._rows.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def summary(self):
+        """Counters for the telemetry summary."""
+        return {'queued': self._rows.qsize(), 'dropped': self.dropped}
+
+
+if __name__ == '__main__':
+    # Example Usage: a little over an hour of detections of a swinging pendulum with a few spikes and scans where it
+    # wasn't found, with the measured and then the filtered edges going to the fits
+    import tempfile
+    from lidar.const import NANOS_FIRST_N_LAST_DTYPE
+    from lidar.shared_ring import SharedRing
+    from lidar.fit_sine_with_fft_guess import StreamingSineFit
+    from lidar.remove_outliers import HampelFilter
+    from lidar.pendulum_filter import PendulumFilter
+    from lidar.beat_timer import BeatTimer
+    from lidar.rollup import Rollup
+    from lidar.timeseries_store import TimeSeriesStore, StoreWriter
+    window_points = int(14.2 * 60.0 * 5.0)
+    rng = np.random.default_rng(1)
+    t = np.arange(0.0, 3700.0, 1.0 / 14.2)
+    rows = np.full(len(t), np.nan, dtype=DETECTION_DTYPE)
+    rows['time'] = t
+    rows['first'] = -20.0 + 100.0 * np.sin(np.pi * t) + rng.normal(0.0, 3.0, len(t))
+    rows['last'] = rows['first'] + 200.0
+    rows['first'][rng.random(len(t)) < 0.001] += 300.0
+    rows['first'][rng.random(len(t)) < 0.02] = np.nan
+    for filtered in (False, True):
+        ring = SharedRing(NANOS_FIRST_N_LAST_DTYPE, 4, window_points + 1)
+        with tempfile.TemporaryDirectory() as directory:
+            store = StoreWriter(TimeSeriesStore(directory)).start()
+            pipeline = DetectionPipeline(ring, window_points, StreamingSineFit(), Rollup(),
+                                         spike_filter=HampelFilter(min_sigma=3.0, columns=2),
+                                         edge_filters=(PendulumFilter(), PendulumFilter()), filtered=filtered,
+                                         beat_timer=BeatTimer(), store=store).start()
+            for start in range(0, len(rows), 64):
+                pipeline.add(rows[start:start + 64])
+            pipeline.stop()
+            store.stop()
+            events = list(pipeline.events())
+            scans = store.store.read('scans')
+            store.store.close()
+        print(f"filtered: {filtered}; minutes: {sum(event[0] == 'minute' for event in events)}"
+              f"; hours: {[event[2:] for event in events if event[0] == 'hour']}"
+              f"; spikes: {pipeline.spike_filter.outliers}; beats: {pipeline.beat_timer.summary()}")
+        print(f"    scans stored: {len(scans)}; first edge period of the last one: {scans['first_period'][-1]:.5f}")
+        ring.close()
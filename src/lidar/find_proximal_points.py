@@ -1,6 +1,5 @@
 import numpy as np
 from typing import List, Tuple
-from lidar.const import lidar_readings_to_cartesian
 import math
 import logging
 
@@ -30,6 +29,53 @@ def angular_distance_degrees(angle1, angle2):
 
     return distance
 
+def segment_scan(scan, scan_radius_mm: float, threshold: float=25.0, min_segment_len=4):
+    """
+    The vectorized kernel of find_consecutive_proximal_points().
+
+    scan: an N x 3 array of (quality, angle, distance) rows, a structured scan from lidar.rplidar_protocol, or a list
+    of (quality, angle, distance).
+
+    Returns (order, xy, ranges):
+        order: the indices into 'scan' of the points within scan_radius_mm sorted by their mirrored angle
+            (360 - angle), rotated so that the segment that wraps around from the last point to the first isn't split.
+        xy: the Cartesian points in 'order' (len(order) x 2).
+        ranges: the [start, stop) of each segment of at least min_segment_len points in 'order' and 'xy'
+            (segments x 2).
+    """
+    if isinstance(scan, np.ndarray) and scan.dtype.names:
+        angle, distance = scan['angle'], scan['distance']
+    else:
+        rows = np.asarray(scan, dtype=np.float64).reshape(-1, 3)
+        angle, distance = rows[:, 1], rows[:, 2]
+    keep = np.flatnonzero(distance < scan_radius_mm)
+    mirrored = 360.0 - angle[keep]
+    sort = np.argsort(mirrored, kind='stable')
+    order = keep[sort]
+    n = len(order)
+    if n < 2:
+        return order, np.empty((n, 2)), np.empty((0, 2), dtype=np.intp)
+
+    theta = np.radians(mirrored[sort])
+    r = distance[order]
+    xy = np.column_stack((r * np.cos(theta), r * np.sin(theta)))
+
+    # A segment ends where the distance to the next point exceeds the threshold
+    steps = np.diff(xy, axis=0)
+    breaks = np.flatnonzero(np.hypot(steps[:, 0], steps[:, 1]) > threshold) + 1
+    if len(breaks) and math.dist(xy[0], xy[-1]) <= threshold:
+        # The segment at the end continues with the one at the start; rotate it to the front
+        shift = breaks[-1]
+        order = np.roll(order, -shift)
+        xy = np.roll(xy, -shift, axis=0)
+        breaks = breaks[:-1] + (n - shift)
+
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [n]))
+    long_enough = stops - starts >= min_segment_len
+    return order, xy, np.column_stack((starts[long_enough], stops[long_enough]))
+
+
 def find_consecutive_proximal_points(scan: List[Tuple[int, float, float]],
                                      scan_radius_mm: float,
                                      threshold: float=25.0,
@@ -46,78 +92,138 @@ def find_consecutive_proximal_points(scan: List[Tuple[int, float, float]],
 
     Returns:
         A list of lists, where each inner list is a sequence of consecutive
-        proximal points.
+        proximal points. The points are ordered by mirrored angle (360 - angle), and a
+        group that wraps around from the last point to the first comes first.
+        See segment_scan() for the index ranges without building the lists.
+    """
+    _, xy, ranges = segment_scan(scan, scan_radius_mm, threshold, min_segment_len)
+    return [xy[start:stop].tolist() for start, stop in ranges]
+
+
+# The signature of a segment of consecutive proximal points: its angular span (start, and end >= start, in the
+# mirrored degrees of the points; end is past 360 when the segment wraps around), its mean range, and the number of
+# points; what match_segments() compares.
+SEGMENT_SIGNATURE_DTYPE = np.dtype([('start', np.float64), ('end', np.float64), ('range', np.float64),
+                                    ('count', np.int64)])
+
+
+def segment_signatures(xy, ranges):
+    """The SEGMENT_SIGNATURE_DTYPE of each [start, stop) range of the points 'xy' (see segment_scan())."""
+    signatures = np.zeros(len(ranges), dtype=SEGMENT_SIGNATURE_DTYPE)
+    if len(ranges) == 0:
+        return signatures
+    starts, stops = ranges[:, 0], ranges[:, 1]
+    first, last = xy[starts], xy[stops - 1]
+    start = np.degrees(np.arctan2(first[:, 1], first[:, 0])) % 360.0
+    span = (np.degrees(np.arctan2(last[:, 1], last[:, 0])) - start) % 360.0
+    count = stops - starts
+    # The sum of the ranges over each range of points from their cumulative sum
+    cumulative = np.zeros(len(xy) + 1)
+    np.cumsum(np.hypot(xy[:, 0], xy[:, 1]), out=cumulative[1:])
+    signatures['start'], signatures['end'] = start, start + span
+    signatures['range'] = (cumulative[stops] - cumulative[starts]) / count
+    signatures['count'] = count
+    return signatures
+
+
+def _segments_to_arrays(segments):
+    """(xy, ranges) of a list of segments of [x, y] points from find_consecutive_proximal_points()."""
+    counts = np.fromiter((len(segment) for segment in segments), dtype=np.intp, count=len(segments))
+    stops = np.cumsum(counts)
+    xy = np.array([point for segment in segments for point in segment], dtype=np.float64).reshape(-1, 2)
+    return xy, np.column_stack((stops - counts, stops))
+
+
+class SegmentIndex:
+    """
+    The angular spans of the segments of a scan sorted by their start. The segments of a scan don't overlap, so the
+    ends are sorted as well and the segments overlapping a span are found with two binary searches. A segment that
+    wraps around past 360 is also indexed 360 degrees earlier.
+    """
+
+    def __init__(self, signatures):
+        wraps = np.flatnonzero(signatures['end'] > 360.0)
+        segment = np.concatenate((np.arange(len(signatures)), wraps))
+        start = np.concatenate((signatures['start'], signatures['start'][wraps] - 360.0))
+        end = np.concatenate((signatures['end'], signatures['end'][wraps] - 360.0))
+        order = np.argsort(start, kind='stable')
+        self.segment, self.start, self.end = segment[order], start[order], end[order]
+
+    def overlapping(self, start, end):
+        """The indexes of the segments overlapping [start, end] (in degrees, end >= start)."""
+        found = self.segment[np.searchsorted(self.end, start): np.searchsorted(self.start, end, side='right')]
+        if end > 360.0:
+            found = np.concatenate((found, self.segment[np.searchsorted(self.end, start - 360.0):
+                                                        np.searchsorted(self.start, end - 360.0, side='right')]))
+        return found
+
+
+def _angle_difference(a, b):
+    """a - b in degrees between -180 and 180."""
+    return (a - b + 180.0) % 360.0 - 180.0
+
+
+def match_segments(signatures_a, signatures_b, threshold: float=10.0, angle_margin: float=2.0,
+                   min_shift_deg: float=0.75):
+    """
+    Classify the segments of scan b against those of the scan before it, scan a, by their signatures.
+
+    A segment of b moved when a segment of a overlapping it has the same mean range (to within 'threshold' mm) and
+    both its edges shifted by the same angle (to within two of the angles between its points), by more than
+    min_shift_deg and one and a quarter of the angles between its points. The LIDAR starts each revolution at a
+    different angle so everything seems to shift by up to the angle between the points. Something still keeps its
+    edges, and a segment that was split or merged because something moved in front of it keeps the edge away from
+    whatever moved, so neither shifts as a whole. A segment that appeared overlaps no segment of a.
+
+    Returns (moved, appeared): the indexes of the segments of b that moved, the most rigidly moved first (the
+    difference of the shifts of its edges is the smallest fraction of the shift), and that appeared.
+    """
+    index = SegmentIndex(signatures_a)
+    moved = []
+    rigidity = []
+    appeared = []
+    for i, b in enumerate(signatures_b):
+        candidates = signatures_a[index.overlapping(b['start'] - angle_margin, b['end'] + angle_margin)]
+        if len(candidates) == 0:
+            appeared.append(i)
+            continue
+        step = (b['end'] - b['start']) / max(b['count'] - 1, 1)
+        start_shift = _angle_difference(b['start'], candidates['start'])
+        end_shift = _angle_difference(b['end'], candidates['end'])
+        rigid = ((np.abs(start_shift - end_shift) <= 2.0 * step)
+                 & (np.abs(start_shift + end_shift) / 2.0 > max(1.25 * step, min_shift_deg))
+                 & (np.abs(candidates['range'] - b['range']) <= threshold))
+        if rigid.any():
+            moved.append(i)
+            rigidity.append(np.min(np.abs(start_shift - end_shift)[rigid] / np.abs(start_shift + end_shift)[rigid]))
+    return [moved[j] for j in np.argsort(rigidity, kind='stable')], appeared
+
+
+def find_dissimilar_scans(scan_a: List, scan_b: List, threshold: float=10.0):
+    """
+    Compare scan_a with scan_b (the segments of consecutive scans from find_consecutive_proximal_points()) and return
+    the segment of scan_b that moved (the pendulum), or [0] when nothing did.
+
+    The segments are matched by their signatures (see match_segments()), so the scans needn't have the same number
+    of segments. When more than one moved the most rigidly moved one is taken. A segment that appeared is only
+    taken when nothing moved and it is the only one; otherwise [number of segments that appeared] is returned.
     """
-    scan = [(x[0], 360.0 - x[1], x[2]) for x in scan if x[2] < scan_radius_mm]
-    scan = sorted(scan, key=lambda x: x[1])
-    points = lidar_readings_to_cartesian(scan)
-    if not points or len(points) < 2:
-        return []
-
-    # Convert the list of points to a NumPy array for efficient calculation
-    points_arr = np.array(points)
-    # scan_arr = np.array(scan)
-
-    # Calculate the Euclidean distance between consecutive points
-    # This involves shifting the array by one and calculating the distance
-    diffs = points_arr[1:] - points_arr[:-1]
-    distances = np.sqrt(np.sum(diffs ** 2, axis=1))
-
-    # Identify where the distance exceeds the threshold
-    # These are the breakpoints between sequences
-    break_indices = np.where(distances > threshold)[0] + 1
-    # print(f"scan: {scan}")
-    # print(f"points: {points}")
-    # print(f"break indices: {break_indices}")
-
-    # Use the breakpoints to split the array into contiguous segments
-    # The start and end indices of these segments represent the proximal sequences
-    segments = np.split(points_arr, break_indices)
-    # scans = np.split(scan_arr, break_indices)
-    # indices = np.split(np.array(range(0, len(points))), break_indices)
-
-    # Filter out segments that have only one point, as they can't be "consecutive" proximal
-    consecutive_segments = [segment.tolist() for segment in segments if len(segment) >= min_segment_len]
-    # consecutive_scans = [scan.tolist() for scan in scans if len(scan) >= min_segment_len]
-    # consecutive_indices = [index.tolist() for index in indices if len(index) >= min_segment_len]
-
-    # If the first point is close to the last point then join them assuming that they are the same froup...
-    distance_first_last = math.dist(points[0], points[-1])
-    if distance_first_last <= threshold:
-        consecutive_segments = [consecutive_segments[-1]+consecutive_segments[0]] + consecutive_segments[1:-1]
-        # consecutive_scans = [consecutive_scans[-1]+consecutive_scans[0]] + consecutive_scans[1:-1]
-        # consecutive_indices = [consecutive_indices[-1]+consecutive_indices[0]] + consecutive_indices[1:-1]
-
-    # scan_data = []
-    # for s in consecutive_scans:
-    #     # angle = angular_distance_degrees(s[0][1], s[-1][1])
-    #     scan_data.append([s[0][1], s[0][2], s[-1][1], s[-1][2]])
-
-    return consecutive_segments
-
-
-def find_dissimilar_scans(scan_a: List, scan_b: List, threshold: float=2.5):
-    """Compare scan_a with scan_b and return a scan from scan_b which is different or an empty list"""
-    # print(f"len(scan_a) = {len(scan_a)}; len(scan_b) = {len(scan_b)}")
-    if len(scan_a) != len(scan_b):
-        return []
-    found = []
-    for pts_a, pts_b in zip(scan_a, scan_b):
-        # diff_distance = [abs(a[2] - b[2]) for a, b in zip(pts_a, pts_b)]
-        diff_angle = [abs(a[1] - b[1]) for a, b in zip(pts_a, pts_b)]
-        # avg_diff_distance = sum(diff_distance) / len(diff_distance)
-        avg_diff_angle = sum(diff_angle) / len(diff_angle)
-        # avg_diff_distance = sum(diff_distance) / len(diff_distance)
-        # THERE MUST BE A BETTER WAY OF DOING THIS!
-        if avg_diff_angle > threshold:
-            # print(f"avg_dif_distance = {avg_diff_distance} avg_diff_angle = {avg_diff_angle} "
-            #       f"max(diff_distance) = {max(diff_distance)} max_diff_angle = {max(diff_angle)}")
-            found.append(pts_b)
-    if len(found) != 1:
-        return  [len(found)]
-
-    logger.debug(f"find_dissimilar_scans: {found}")
-    return found[0]
+    if not scan_b:
+        return [0]
+    signatures_b = segment_signatures(*_segments_to_arrays(scan_b))
+    if not scan_a:
+        moved, appeared = [], list(range(len(scan_b)))
+    else:
+        moved, appeared = match_segments(segment_signatures(*_segments_to_arrays(scan_a)), signatures_b, threshold)
+    if moved:
+        found = moved[0]
+    elif len(appeared) == 1:
+        found = appeared[0]
+    else:
+        return [len(appeared)]
+
+    logger.debug(f"find_dissimilar_scans: {scan_b[found]}")
+    return scan_b[found]
 
 if __name__ == "__main__":
 # Example Usage:
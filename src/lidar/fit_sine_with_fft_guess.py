@@ -1,3 +1,4 @@
+import math
 import numpy as np
 from scipy.optimize import curve_fit
 from scipy.optimize import OptimizeWarning
@@ -110,6 +111,134 @@ def pendulum_equation(data, index):
 
     return period, t_uniform, theta_uniform, fitted_params, r_squared
 
+# StreamingSineFit keeps a running least squares fit of the points as they arrive rather than fitting a window of
+# them from scratch with curve_fit (which re-interpolates them and can run out of function evaluations).
+#
+# The points are fit in blocks of block_seconds at the fixed expected frequency omega0, which is linear:
+# theta = a sin(omega0 t) + b cos(omega0 t) + offset, from sums that are updated in O(1) for each point. When a block
+# is complete its amplitude and phase are kept and its sums are started over. If the pendulum's frequency is
+# omega0 + d the phase of the blocks advances by d each second, so the frequency over any window is omega0 plus the
+# slope of a (weighted) straight line through the unwrapped phases of its blocks. The R^2 of a window comes from the
+# residuals of the blocks' fits and the variance of all of the points of the window. The blocks of the last
+# history_seconds are kept, so the last minute, hour, or day can be reported at any moment; the block being filled
+# isn't included.
+
+_SINE_BLOCK_DTYPE = np.dtype([('time', np.float64), ('phase', np.float64), ('amplitude', np.float64),
+                              ('offset', np.float64), ('count', np.float64), ('sse', np.float64),
+                              ('sum', np.float64), ('sum_sq', np.float64)])
+
+
+class StreamingSineFit:
+    """
+    period: the expected pendulum period (sec/cycle); it needs to be within about 10% of the actual period.
+    block_seconds: the seconds of points fit at a time. history_seconds: the longest window that can be reported.
+    min_block_points: blocks with fewer points are dropped.
+    """
+
+    def __init__(self, period=2.0, block_seconds=10.0, history_seconds=86400.0, min_block_points=20):
+        self.omega0 = 2.0 * np.pi / period
+        self.block_seconds = block_seconds
+        self.min_block_points = min_block_points
+        self.blocks = np.zeros(int(history_seconds / block_seconds) + 2, dtype=_SINE_BLOCK_DTYPE)
+        self.block_count = 0
+        self.points = 0
+        self._t0 = None
+        self._block_start = None
+        self._domega = 0.0
+        self._reset_sums()
+
+    def _reset_sums(self):
+        self._n = self._st = 0.0
+        self._ss = self._sc = self._cc = self._s = self._c = 0.0
+        self._y = self._ys = self._yc = self._yy = 0.0
+
+    def add(self, t, theta):
+        """Add the point theta at time t (sec); the points must be added in time order."""
+        if self._t0 is None:
+            self._t0 = self._block_start = t
+        elif t - self._block_start >= self.block_seconds:
+            self._close_block()
+            self._block_start += self.block_seconds * np.floor((t - self._block_start) / self.block_seconds)
+        t = t - self._t0
+        angle = self.omega0 * t
+        s, c = math.sin(angle), math.cos(angle)
+        self._n += 1.0
+        self._st += t
+        self._ss += s * s
+        self._sc += s * c
+        self._cc += c * c
+        self._s += s
+        self._c += c
+        self._y += theta
+        self._ys += theta * s
+        self._yc += theta * c
+        self._yy += theta * theta
+        self.points += 1
+
+    def _close_block(self):
+        n = self._n
+        if n >= self.min_block_points:
+            normal = np.array([[self._ss, self._sc, self._s], [self._sc, self._cc, self._c], [self._s, self._c, n]])
+            moments = np.array([self._ys, self._yc, self._y])
+            try:
+                a, b, offset = np.linalg.solve(normal, moments)
+            except np.linalg.LinAlgError:
+                a = None
+            if a is not None:
+                t = self._st / n
+                phase = math.atan2(b, a)
+                if self.block_count:
+                    # Unwrap the phase to be nearest where the last block and the frequency so far put it
+                    last = self.blocks[(self.block_count - 1) % len(self.blocks)]
+                    predicted = last['phase'] + self._domega * (t - last['time'])
+                    phase += 2.0 * np.pi * np.round((predicted - phase) / (2.0 * np.pi))
+                sse = max(self._yy - (a * self._ys + b * self._yc + offset * self._y), 0.0)
+                self.blocks[self.block_count % len(self.blocks)] = (t, phase, math.hypot(a, b), offset, n, sse,
+                                                                    self._y, self._yy)
+                self.block_count += 1
+                recent = self._window_blocks(6.0 * self.block_seconds)
+                if len(recent) >= 3:
+                    self._domega = self._phase_slope(recent)
+        self._reset_sums()
+
+    def _window_blocks(self, seconds):
+        kept = min(self.block_count, len(self.blocks))
+        index = np.arange(self.block_count - kept, self.block_count) % len(self.blocks)
+        blocks = self.blocks[index]
+        if kept == 0:
+            return blocks
+        start = np.searchsorted(blocks['time'], blocks['time'][-1] - seconds, side='left')
+        return blocks[start:]
+
+    def blocks_since(self, count):
+        """The blocks completed after the first 'count' of them (that are still kept), e.g. for lidar.rollup."""
+        first = max(count, self.block_count - len(self.blocks))
+        return self.blocks[np.arange(first, self.block_count) % len(self.blocks)]
+
+    @staticmethod
+    def _phase_slope(blocks):
+        weights = blocks['count']
+        t_mean = np.average(blocks['time'], weights=weights)
+        phase_mean = np.average(blocks['phase'], weights=weights)
+        dt = blocks['time'] - t_mean
+        return float(np.sum(weights * dt * (blocks['phase'] - phase_mean)) / np.sum(weights * dt * dt))
+
+    def window(self, seconds):
+        """
+        The (period, amplitude, offset, r_squared) of the last 'seconds' of points, or None until there are two
+        complete blocks in it.
+        """
+        blocks = self._window_blocks(seconds)
+        if len(blocks) < 2:
+            return None
+        omega = self.omega0 + self._phase_slope(blocks)
+        count = blocks['count'].sum()
+        amplitude = float(np.sum(blocks['amplitude'] * blocks['count']) / count)
+        offset = float(np.sum(blocks['offset'] * blocks['count']) / count)
+        total = blocks['sum_sq'].sum() - blocks['sum'].sum() ** 2 / count
+        r_squared = float(1.0 - blocks['sse'].sum() / total) if total > 0.0 else 0.0
+        return 2.0 * np.pi / omega, amplitude, offset, r_squared
+
 # LiDAR Data Conversion: Ensure the 2D LiDAR points are converted to linear Cartesian
 # coordinates to calculate the arc length or tangential distance the pendulum swings.
 
@@ -1,32 +1,120 @@
 import numpy as np
-from scipy.optimize import leastsq
 #from const import lidar_readings_to_cartesian
 
-def _fit_circle(points):
-    """Fits a circle to 2D points using least squares. Returns (xc, yc, r)."""
-    x = points[:, 0]
-    y = points[:, 1]
+# Circles are fit algebraically (Taubin's fit, as taubinSVD of the circle_fit package that analize_points.py uses)
+# rather than by iterating scipy.optimize.leastsq, so a fit takes a fixed number of operations on the moments of the
+# points: the means of x^i y^j up to the fourth order. The moments of every window of consecutive points are
+# differences of the prefix sums of x^i y^j, so sliding_circle_fits() fits every window of every width of a scan in
+# one vectorized pass, O(1) for each window whatever its width. The residual of a window is the sum of the squared
+# algebraic distances (d^2 - r^2)^2 / 4 r^2, which is the sum of the squared distances (d - r)^2 of the points from
+# the circle when they are near it, also from the moments.
+
+# The fit of a window of consecutive points: its first point and number of points, the centre, radius, and residual
+CIRCLE_FIT_DTYPE = np.dtype([('start', np.int64), ('width', np.int64), ('x', np.float64), ('y', np.float64),
+                             ('radius', np.float64), ('residual', np.float64)])
+
+# The (i, j) of the moments x^i y^j that are needed
+_POWERS = [(i, n - i) for n in range(5) for i in range(n + 1)]
+
+
+def _binomial(n, k):
+    return 1 if k == 0 else n * _binomial(n - 1, k - 1) // k
 
-    # Initial guess for center (mean of points)
-    x_m = np.mean(x)
-    y_m = np.mean(y)
 
-    def calc_R(xc, yc):
-        """Calculate distance of each point from center (xc, yc)"""
-        return np.sqrt((x - xc) ** 2 + (y - yc) ** 2)
+def _central_moments(moments):
+    """
+    The (mean_x, mean_y, mxx, myy, mxy, mxz, myz, mzz) of points from the (..., moment) means of x^i y^j (in the
+    order of _POWERS); the m are the means of the products of X, Y, and z = X^2 + Y^2 of the centred X and Y.
+    """
+    raw = {power: moments[..., index] for index, power in enumerate(_POWERS)}
+    mean_x, mean_y = raw[(1, 0)], raw[(0, 1)]
 
-    def f_2(c):
-        """Calculate algebraic distance from points to circle center c"""
-        Ri = calc_R(*c)
-        return Ri - Ri.mean()
+    def central(i, j):
+        # The mean of (x - mean_x)^i (y - mean_y)^j from the raw moments
+        total = 0.0
+        for a in range(i + 1):
+            for b in range(j + 1):
+                total = total + (_binomial(i, a) * _binomial(j, b) * (-mean_x) ** (i - a) * (-mean_y) ** (j - b)
+                                 * raw[(a, b)])
+        return total
 
-    # Optimize for center
-    center_estimate = x_m, y_m
-    center, _ = leastsq(f_2, center_estimate)
+    return (mean_x, mean_y, central(2, 0), central(0, 2), central(1, 1), central(3, 0) + central(1, 2),
+            central(2, 1) + central(0, 3), central(4, 0) + 2.0 * central(2, 2) + central(0, 4))
 
-    xc, yc = center
-    Ri = calc_R(xc, yc)
-    R = Ri.mean()
+
+def _taubin(mxx, myy, mxy, mxz, myz, mzz):
+    """
+    The fits of points (arrays of them) from their central moments (see _central_moments()).
+    Returns (x, y, radius, mean squared algebraic distance / 4 r^2) with the centre relative to the mean.
+    """
+    mz = mxx + myy
+    cov_xy = mxx * myy - mxy * mxy
+    var_z = mzz - mz * mz
+    # Newton's method from 0 for the root of the characteristic polynomial (Chernov's CircleFitByTaubin)
+    a3, a2 = 4.0 * mz, -3.0 * mz * mz - mzz
+    a1 = var_z * mz + 4.0 * cov_xy * mz - mxz * mxz - myz * myz
+    a0 = mxz * (mxz * myy - myz * mxy) + myz * (myz * mxx - mxz * mxy) - var_z * cov_xy
+    root, value = np.zeros_like(a0), a0
+    active = np.ones(np.shape(a0), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(50):
+            slope = a1 + root * (2.0 * a2 + 3.0 * a3 * root)
+            step = np.where(active, value / slope, 0.0)
+            new_root = root - step
+            new_value = a0 + new_root * (a1 + new_root * (a2 + new_root * a3))
+            # A root is kept until the polynomial stops getting closer to 0
+            active &= np.isfinite(new_root) & (np.abs(new_value) < np.abs(value)) & (new_root != root)
+            root, value = np.where(active, new_root, root), np.where(active, new_value, value)
+            if not active.any():
+                break
+        det = 2.0 * (root * root - root * mz + cov_xy)
+        x = (mxz * (myy - root) - myz * mxy) / det
+        y = (myz * (mxx - root) - mxz * mxy) / det
+        radius = np.sqrt(x * x + y * y + mz)
+        # The mean of (d^2 - r^2)^2 with d^2 - r^2 = z - 2 x X - 2 y Y - mz of the centred X, Y, and z = X^2 + Y^2
+        algebraic = (var_z + 4.0 * (x * x * mxx + 2.0 * x * y * mxy + y * y * myy) - 4.0 * (x * mxz + y * myz))
+        spread = np.maximum(algebraic, 0.0) / (4.0 * radius * radius)
+    return x, y, radius, spread
+
+
+def sliding_circle_fits(points, widths=None):
+    """
+    The circle fit of every window of 'widths' (an iterable; every width from 3 when None) consecutive points of
+    'points' (n, 2), as an array of CIRCLE_FIT_DTYPE ordered by width and then start.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    origin = points.mean(axis=0)
+    x, y = (points - origin).T
+    powers = np.column_stack([x ** i * y ** j for i, j in _POWERS])
+    n = len(powers)
+    widths = np.arange(3, n + 1) if widths is None else np.asarray([w for w in widths if 3 <= w <= n], dtype=np.int64)
+    prefix = np.zeros((n + 1, len(_POWERS)))
+    np.cumsum(powers, axis=0, out=prefix[1:])
+    # The start and width of every window
+    counts = n - widths + 1
+    width = np.repeat(widths, counts)
+    start = np.arange(len(width)) - np.repeat(np.cumsum(counts) - counts, counts)
+    fits = np.zeros(len(width), dtype=CIRCLE_FIT_DTYPE)
+    fits['start'], fits['width'] = start, width
+    if len(width):
+        mean_x, mean_y, *moments = _central_moments((prefix[start + width] - prefix[start]) / width[:, None])
+        x, y, radius, spread = _taubin(*moments)
+        fits['x'], fits['y'] = x + mean_x + origin[0], y + mean_y + origin[1]
+        fits['radius'], fits['residual'] = radius, spread * width
+    return fits
+
+
+def _fit_circle(points):
+    """Fits a circle to 2D points (Taubin's algebraic fit). Returns (xc, yc, r, residual)."""
+    origin = points.mean(axis=0)
+    x, y = (points - origin).T
+    z = x * x + y * y
+    n = len(points)
+    moments = [np.dot(a, b) / n for a, b in ((x, x), (y, y), (x, y), (x, z), (y, z), (z, z))]
+    xc, yc, radius, _ = _taubin(*np.array(moments)[:, None])
+    xc, yc = float(xc[0]) + origin[0], float(yc[0]) + origin[1]
+    Ri = np.hypot(points[:, 0] - xc, points[:, 1] - yc)
+    R = float(radius[0])
 
     # Calculate residual to determine quality of fit
     residu = np.sum((Ri - R) ** 2)
@@ -37,7 +125,7 @@ def is_on_arc(points, threshold=0.1):
     """Checks if points lie on an arc within a residual threshold."""
     if len(points) < 3: return False, (0, 0, 0)
 
-    xc, yc, r, residu = _fit_circle(np.array(points))
+    xc, yc, r, residu = _fit_circle(np.array(points, dtype=np.float64))
 
     # If residual is low, points fit a circle well
     is_circle = (residu / len(points)) < threshold
@@ -48,6 +136,18 @@ def is_on_arc(points, threshold=0.1):
     return is_circle, (xc, yc, r)
 
 
+def find_arcs(points, widths, threshold=0.1):
+    """
+    {width: the first start of 'width' consecutive points that is_on_arc() with threshold} of the widths that are
+    found, from sliding_circle_fits() (the residual of each window is its algebraic residual).
+    """
+    fits = sliding_circle_fits(points, widths)
+    arcs = fits[fits['residual'] / fits['width'] < threshold]
+    # The first of each width (they are in order of width and start)
+    widths, first = np.unique(arcs['width'], return_index=True)
+    return dict(zip(widths.tolist(), arcs['start'][first].tolist()))
+
+
 def get_equation_coefficients(x_points, y_points, degree):
     """
     Fits a polynomial of a specified degree to the given x and y points
@@ -72,6 +172,7 @@ def get_equation_coefficients(x_points, y_points, degree):
     return coefficients
 
 if __name__ == "__main__":
+    from lidar.const import lidar_readings_to_cartesian
     # Use the 'annotate.py' utility to make_hover_over_plot() to get a sample of these points...
     # Fudge the threshold till it works....
     # Points lie on an arc. Center: (673.54, -32.99), Radius: 319.93 threshold: 3.0
@@ -0,0 +1,152 @@
+import math
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# A streaming estimate of the swing of a pendulum edge (the first or last point of the pendulum in each scan) that
+# is updated in O(1) as each scan is released in scan order by run_scanner(), rather than only being cleaned up by
+# lidar.remove_outliers.zscore_mask() and fit once a minute.
+#
+# It is an extended Kalman filter with a harmonic oscillator model. The state is (offset, x, velocity, omega) where
+# the edge is at offset + x, x'' = -omega^2 x, and the offset (the rest position of the edge) and omega drift slowly
+# as random walks. Between scans the oscillator is propagated exactly (a rotation of (x, velocity / omega) by
+# omega dt), which is what makes it non-linear in omega; the prediction is linearized about the current state. The
+# period is 2 pi / omega and the amplitude is the length of (x, velocity / omega).
+#
+# A measurement whose innovation is more than gate_sigma standard deviations from the prediction is rejected (and
+# not used to update the state). After reset_after rejections in a row, or a gap of more than max_gap_seconds
+# between measurements, the filter starts over from the next measurement.
+
+# The order of the state vector
+_OFFSET, _X, _VELOCITY, _OMEGA = range(4)
+
+
+class PendulumFilter:
+    """
+    period: the expected pendulum period (sec). amplitude_mm: the expected amplitude, used for the initial uncertainty.
+    measurement_mm: the standard deviation of an edge measurement.
+    acceleration_mm: the spectral density (mm/s^2/sqrt(Hz)) of the acceleration that the oscillator doesn't model.
+    omega_drift: how fast omega may drift (rad/s/sqrt(s)). offset_drift_mm: how fast the rest position may drift.
+    """
+
+    def __init__(self, period=2.0, amplitude_mm=150.0, measurement_mm=3.0, acceleration_mm=20.0, omega_drift=1e-4,
+                 offset_drift_mm=0.5, gate_sigma=4.0, reset_after=15, max_gap_seconds=2.0):
+        self.omega0 = 2.0 * math.pi / period
+        self.amplitude_mm = amplitude_mm
+        self.measurement_var = measurement_mm ** 2
+        self.acceleration_var = acceleration_mm ** 2
+        self.omega_var = omega_drift ** 2
+        self.offset_var = offset_drift_mm ** 2
+        self.gate_sigma = gate_sigma
+        self.reset_after = reset_after
+        self.max_gap_seconds = max_gap_seconds
+        self.state = None
+        self.covariance = None
+        self.time = None
+        self.innovation = 0.0
+        self.misses = 0
+        self.updates = 0
+        self.rejections = 0
+        self.resets = 0
+
+    def _start(self, scan_time, z):
+        self.state = np.array([z, 0.0, 0.0, self.omega0])
+        a = self.amplitude_mm
+        self.covariance = np.diag([a * a, a * a, (a * self.omega0) ** 2, (0.02 * self.omega0) ** 2])
+        self.time = scan_time
+        self.misses = 0
+
+    def _predict(self, dt):
+        offset, x, velocity, omega = self.state
+        c, s = math.cos(omega * dt), math.sin(omega * dt)
+        self.state = np.array([offset, x * c + velocity * s / omega, -x * omega * s + velocity * c, omega])
+        jacobian = np.eye(4)
+        jacobian[_X, _X] = c
+        jacobian[_X, _VELOCITY] = s / omega
+        jacobian[_X, _OMEGA] = -x * s * dt + velocity * (dt * c / omega - s / (omega * omega))
+        jacobian[_VELOCITY, _X] = -omega * s
+        jacobian[_VELOCITY, _VELOCITY] = c
+        jacobian[_VELOCITY, _OMEGA] = -x * (s + omega * dt * c) - velocity * s * dt
+        q = self.acceleration_var
+        noise = np.zeros((4, 4))
+        noise[_OFFSET, _OFFSET] = self.offset_var * dt
+        noise[_X, _X] = q * dt ** 3 / 3.0
+        noise[_X, _VELOCITY] = noise[_VELOCITY, _X] = q * dt ** 2 / 2.0
+        noise[_VELOCITY, _VELOCITY] = q * dt
+        noise[_OMEGA, _OMEGA] = self.omega_var * dt
+        self.covariance = jacobian @ self.covariance @ jacobian.T + noise
+
+    def update(self, scan_time, z):
+        """
+        Feed the edge position z (mm) of the scan at scan_time (sec), in scan order. Returns False if it was
+        rejected as an outlier.
+        """
+        if self.state is None or scan_time - self.time > self.max_gap_seconds or scan_time < self.time:
+            if self.state is not None:
+                self.resets += 1
+            self._start(scan_time, z)
+        dt = scan_time - self.time
+        if dt > 0.0:
+            self._predict(dt)
+            self.time = scan_time
+        # The measurement is offset + x
+        innovation = z - self.state[_OFFSET] - self.state[_X]
+        p = self.covariance
+        variance = p[_OFFSET, _OFFSET] + 2.0 * p[_OFFSET, _X] + p[_X, _X] + self.measurement_var
+        self.innovation = innovation / math.sqrt(variance)
+        if abs(self.innovation) > self.gate_sigma:
+            self.rejections += 1
+            self.misses += 1
+            if self.misses >= self.reset_after:
+                logger.warning(f"Edge filter rejected {self.misses} measurements in a row; starting over")
+                self.resets += 1
+                self._start(scan_time, z)
+            return False
+        self.misses = 0
+        gain = (p[:, _OFFSET] + p[:, _X]) / variance
+        self.state = self.state + gain * innovation
+        self.covariance = p - np.outer(gain, p[_OFFSET, :] + p[_X, :])
+        # Keep omega positive; it is far from 0 for any real pendulum
+        self.state[_OMEGA] = max(self.state[_OMEGA], 0.1 * self.omega0)
+        self.updates += 1
+        return True
+
+    @property
+    def ready(self):
+        return self.state is not None
+
+    @property
+    def position(self):
+        return float(self.state[_OFFSET] + self.state[_X])
+
+    @property
+    def velocity(self):
+        return float(self.state[_VELOCITY])
+
+    @property
+    def offset(self):
+        return float(self.state[_OFFSET])
+
+    @property
+    def period(self):
+        return 2.0 * math.pi / float(self.state[_OMEGA])
+
+    @property
+    def period_std(self):
+        """The standard deviation of the period estimate (sec)."""
+        omega = float(self.state[_OMEGA])
+        return 2.0 * math.pi * math.sqrt(max(self.covariance[_OMEGA, _OMEGA], 0.0)) / (omega * omega)
+
+    @property
+    def amplitude(self):
+        return math.hypot(float(self.state[_X]), float(self.state[_VELOCITY] / self.state[_OMEGA]))
+
+    def summary(self):
+        """The latest estimates rounded for the telemetry summary; {} before the first measurement."""
+        if self.state is None:
+            return {}
+        return {'position_mm': round(self.position, 1), 'velocity_mm_s': round(self.velocity, 1),
+                'period_sec': round(self.period, 5), 'period_std_sec': round(self.period_std, 6),
+                'amplitude_mm': round(self.amplitude, 1), 'updates': self.updates, 'rejections': self.rejections,
+                'resets': self.resets}
@@ -0,0 +1,154 @@
+import math
+import logging
+from collections import deque
+import numpy as np
+from lidar.find_proximal_points import find_consecutive_proximal_points
+
+logger = logging.getLogger(__name__)
+
+# Once the pendulum has been found in a run of scans there is no need to search the whole SCAN_RADIUS_MM disc for it.
+# PendulumTracker (in run_scanner) fits the swing of the centre of the pendulum (its angle as seen by the LIDAR) over
+# the last few seconds of detections to a sine at the pendulum period, and predicts a region of interest (ROI) for
+# each new scan: an angular window around the predicted centre that is wide enough for the pendulum, the error of the
+# fit, and how far the pendulum moves during a revolution, and a distance band around the distances it was seen at.
+# find_pendulum_in_roi() (in the subprocess) only segments the points of the scan in the ROI.
+#
+# The tracker locks on once it has lock_after detections in the last history_seconds (comparing whole scans misses
+# the pendulum at the ends of its swing where it hardly moves between scans, so they won't be in a row), and falls
+# back to searching the whole scan after lose_after scans in a row where the pendulum wasn't found in its ROI (or it
+# was cut off by the edge of the ROI). Only the scans that were searched with an ROI count towards losing it; the
+# results of the scans already submitted for a whole scan search when it locked on still come back for a while.
+#
+# An ROI is (centre angle, half width in degrees, minimum distance, maximum distance) in the LIDAR's angles.
+
+
+def _wrap180(angle):
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+def segment_polar(points):
+    """
+    The (centre angle, half width in degrees, minimum distance, maximum distance) of a pendulum segment from
+    find_consecutive_proximal_points() in the LIDAR's angles; the segment's angles are mirrored (360 - angle).
+    """
+    pts = np.asarray(points, dtype=np.float64)
+    angles = np.degrees(np.arctan2(pts[:, 1], pts[:, 0]))
+    first = angles[0]
+    relative = _wrap180(angles - first)
+    low, high = relative.min(), relative.max()
+    centre = (360.0 - (first + (low + high) / 2.0)) % 360.0
+    distances = np.hypot(pts[:, 0], pts[:, 1])
+    return centre, (high - low) / 2.0, distances.min(), distances.max()
+
+
+def find_pendulum_in_roi(scan, roi, scan_radius_mm):
+    """
+    The pendulum points of 'scan' (a structured array of (quality, angle, distance)) in the 'roi', in the format of
+    find_dissimilar_scans(): a list of [x, y], or [0] when it isn't there or touches the edge of the ROI.
+    """
+    centre, half_width, distance_min, distance_max = roi
+    offset = np.abs(_wrap180(scan['angle'] - centre))
+    distance = scan['distance']
+    inside = (offset <= half_width) & (distance >= distance_min) & (distance <= min(distance_max, scan_radius_mm))
+    segments = find_consecutive_proximal_points(scan[inside], scan_radius_mm)
+    if not segments:
+        return [0]
+    segment = max(segments, key=len)
+    # Keep clear of the edges of the window by a couple of the angles between samples
+    guard = 2.0 * 360.0 / max(len(scan), 1)
+    seg_centre, seg_half_width, _, _ = segment_polar(segment)
+    if abs(_wrap180(seg_centre - centre)) + seg_half_width > half_width - guard:
+        return [0]
+    return segment
+
+
+class PendulumTracker:
+    """
+    period: the pendulum period (sec) used by the swing model. history_seconds: the detections that are fit.
+    margin_deg: added to both sides of the predicted window. scan_period: seconds per LIDAR revolution.
+    """
+
+    def __init__(self, period=2.0, history_seconds=4.0, margin_deg=3.0, lock_after=15, lose_after=3,
+                 range_margin_mm=50.0, scan_period=1.0 / 14.2):
+        self.omega = 2.0 * math.pi / period
+        self.history_seconds = history_seconds
+        self.margin_deg = margin_deg
+        self.lock_after = lock_after
+        self.lose_after = lose_after
+        self.range_margin_mm = range_margin_mm
+        self.scan_period = scan_period
+        self.history = deque()  # (time, centre relative to reference, half width, min distance, max distance)
+        self.reference = None
+        self.locked = False
+        self.misses = 0
+        self.locks = 0
+        self.losses = 0
+        self.roi_scans = 0
+        self._roi_times = deque()
+        self._model = None
+
+    def update(self, scan_time, points):
+        """Feed the pendulum points found in the scan at scan_time (None if it was lost), in scan order."""
+        self.update_polar(scan_time, segment_polar(points) if points is not None and len(points) > 1 else None)
+
+    def update_polar(self, scan_time, polar):
+        """As update() given the segment_polar() of the pendulum points; None when it wasn't found."""
+        searched_roi = False
+        if scan_time is not None:
+            while self._roi_times and self._roi_times[0] < scan_time:
+                self._roi_times.popleft()
+            if self._roi_times and self._roi_times[0] == scan_time:
+                self._roi_times.popleft()
+                searched_roi = True
+        if polar is not None:
+            centre, half_width, distance_min, distance_max = polar
+            if self.reference is None:
+                self.reference = centre
+            self.history.append((scan_time, _wrap180(centre - self.reference), half_width,
+                                 distance_min, distance_max))
+            while self.history and self.history[0][0] < scan_time - self.history_seconds:
+                self.history.popleft()
+            self._model = None
+            self.misses = 0
+            if not self.locked and len(self.history) >= self.lock_after:
+                self.locked = True
+                self.locks += 1
+                logger.info(f"Tracking the pendulum at {centre:.1f} deg")
+        elif searched_roi:
+            self.misses += 1
+            if self.locked and self.misses >= self.lose_after:
+                self.locked = False
+                self.losses += 1
+                self.history.clear()
+                self.reference = None
+                self._model = None
+                logger.warning(f"Lost track of the pendulum after {self.misses} scans; searching the whole scan")
+
+    def _fit(self):
+        """Least squares fit of centre = a + b sin(wt) + c cos(wt); (coefficients, rms residual)."""
+        h = np.array(self.history)
+        t = h[:, 0] - h[-1, 0]
+        design = np.column_stack((np.ones_like(t), np.sin(self.omega * t), np.cos(self.omega * t)))
+        coefficients, _, _, _ = np.linalg.lstsq(design, h[:, 1], rcond=None)
+        rms = float(np.sqrt(np.mean((design @ coefficients - h[:, 1]) ** 2)))
+        return coefficients, rms, h[-1, 0], h[:, 2].max(), h[:, 3].min(), h[:, 4].max()
+
+    def roi(self, scan_time):
+        """The ROI to search the scan at scan_time for the pendulum, or None to search the whole scan."""
+        if not self.locked or len(self.history) < 3:
+            return None
+        if scan_time - self.history[-1][0] > self.history_seconds:
+            # The detections are too old to predict from
+            return None
+        if self._model is None:
+            self._model = self._fit()
+        (a, b, c), rms, t_last, half_width, distance_min, distance_max = self._model
+        t = scan_time - t_last
+        predicted = a + b * math.sin(self.omega * t) + c * math.cos(self.omega * t)
+        # How far the pendulum can move during a revolution
+        sweep = math.hypot(b, c) * self.omega * self.scan_period
+        window = half_width + self.margin_deg + 3.0 * rms + sweep
+        self.roi_scans += 1
+        self._roi_times.append(scan_time)
+        return ((self.reference + predicted) % 360.0, window,
+                max(distance_min - self.range_margin_mm, 0.0), distance_max + self.range_margin_mm)
@@ -0,0 +1,215 @@
+import math
+import logging
+import numpy as np
+from scipy.signal import lombscargle
+
+logger = logging.getLogger(__name__)
+
+# Estimators of the pendulum period that work directly on the nonuniform times of the scans (no interp1d onto a
+# uniform grid first) and have no optimizer that can fail to converge. They all have the same signature:
+#
+#     estimator(t, theta, min_period, max_period) -> period (sec/cycle)
+#
+# and only look for the period between min_period and max_period (period_band() of the expected period; the
+# defaults are those of a seconds beater). PERIOD_ESTIMATORS names them so that the one that is
+# used can be chosen in config.ini ([Fit] MINUTE_ESTIMATOR) and compared by Robotica/benchmark_period.py.
+#
+# - 'dft': the discrete time Fourier transform of the points at the Fourier frequencies k / T of the band, the peak
+#   refined by Quinn's estimator from its neighbours, then by Aboutanios-Mulgrew iterations (the transform half a
+#   bin either side of the estimate), with the negative frequency image of the sine taken out of the transform.
+# - 'grid': a linear least squares fit of a sine and an offset at each frequency of a grid (vectorized over the
+#   frequencies), the best one refined by finer grids around it.
+# - 'lomb_scargle': the Lomb-Scargle periodogram (scipy.signal.lombscargle) searched the same way.
+#
+# The frequency resolution depends on how long the points span, not on how many there are, so the coarse searches
+# use every n-th point (as long as that is still well above the Nyquist rate of the band) and only the refinement
+# uses all of them. A long window is first searched over a short stretch of it (see NARROW_SECONDS).
+# estimate_period() takes the window format of pendulum_equation() and also returns the amplitude, offset, and R^2
+# of the sine at the period.
+
+# Points the coarse searches are thinned to (they need at least ~3 per period of the shortest period)
+COARSE_POINTS = 2000
+# A window longer than four times this is first searched over its last NARROW_SECONDS; its own search is then only
+# over a few of its (much narrower) frequency bins around that period.
+NARROW_SECONDS = 300.0
+# The fraction of the expected period searched either side of it
+PERIOD_BAND = 0.05
+
+
+def period_band(period, band=PERIOD_BAND):
+    """The (min_period, max_period) to search for a pendulum expected to have 'period' (sec/cycle)."""
+    return period * (1.0 - band), period * (1.0 + band)
+
+
+def _centered(t, theta):
+    t = np.asarray(t, dtype=np.float64)
+    theta = np.asarray(theta, dtype=np.float64)
+    return t - t.mean(), theta - theta.mean()
+
+
+def _coarse(t, y, min_period):
+    """Every n-th point, keeping at least 3 points per min_period."""
+    span = t[-1] - t[0]
+    step = max(1, int(len(t) / max(COARSE_POINTS, 3.0 * span / min_period)))
+    return t[::step], y[::step]
+
+
+def _narrow(estimator, t, theta, min_period, max_period):
+    """The (min_period, max_period) to search a long window over."""
+    span = t[-1] - t[0]
+    if span <= 4.0 * NARROW_SECONDS:
+        return min_period, max_period
+    recent = t >= t[-1] - NARROW_SECONDS
+    period = estimator(t[recent], theta[recent], min_period, max_period)
+    # Two frequency bins of the whole window either side
+    margin = 2.0 * period * period / span
+    return max(period - margin, min_period), min(period + margin, max_period)
+
+
+def _transform(t, y, frequencies):
+    """The discrete time Fourier transform of y at 'frequencies' (Hz)."""
+    return np.array([np.dot(y, np.exp(-2j * np.pi * f * t)) for f in np.atleast_1d(frequencies)])
+
+
+def _image(t, y, frequency, frequencies):
+    """
+    The transform at 'frequencies' of the negative frequency half of the sine fit to y at 'frequency'. A real sine
+    is the sum of two complex exponentials, and the one at -frequency leaks into the peak enough to bias the
+    refinements over a short window.
+    """
+    angle = 2.0 * np.pi * frequency * t
+    design = np.column_stack((np.sin(angle), np.cos(angle)))
+    (a, b), _, _, _ = np.linalg.lstsq(design, y, rcond=None)
+    # a sin + b cos = c exp(i angle) + conj(c) exp(-i angle)
+    c = (b - 1j * a) / 2.0
+    return np.conj(c) * _transform(t, np.ones_like(t), np.asarray(frequencies) + frequency)
+
+
+def _sine_power(t, y, frequencies, chunk=64):
+    """
+    The variance explained by a least squares fit of a sine and an offset to y at each frequency; the fits are
+    solved together for a chunk of frequencies at a time.
+    """
+    frequencies = np.atleast_1d(frequencies)
+    power = np.empty(len(frequencies))
+    n = float(len(t))
+    for start in range(0, len(frequencies), chunk):
+        f = frequencies[start:start + chunk]
+        e = np.exp(2j * np.pi * f[:, None] * t[None, :])
+        e1 = e.sum(axis=1)
+        e2 = (e * e).sum(axis=1)
+        ey = e @ y
+        ss = (n - e2.real) / 2.0
+        cc = (n + e2.real) / 2.0
+        sc = e2.imag / 2.0
+        normal = np.empty((len(f), 3, 3))
+        normal[:, 0, 0], normal[:, 0, 1], normal[:, 0, 2] = ss, sc, e1.imag
+        normal[:, 1, 0], normal[:, 1, 1], normal[:, 1, 2] = sc, cc, e1.real
+        normal[:, 2, 0], normal[:, 2, 1], normal[:, 2, 2] = e1.imag, e1.real, n
+        moments = np.stack((ey.imag, ey.real, np.full(len(f), y.sum())), axis=1)
+        coefficients = np.linalg.solve(normal, moments[:, :, None])[:, :, 0]
+        power[start:start + chunk] = np.sum(coefficients * moments, axis=1)
+    return power
+
+
+def _lomb_scargle_power(t, y, frequencies):
+    return lombscargle(t, y, 2.0 * np.pi * np.atleast_1d(frequencies))
+
+
+def _parabolic(x, y):
+    """The x of the vertex of the parabola through three points."""
+    denominator = (y[0] - 2.0 * y[1] + y[2])
+    if denominator == 0.0:
+        return x[1]
+    return x[1] + 0.5 * (x[1] - x[0]) * (y[0] - y[2]) / denominator
+
+
+def _grid_search(power, t, y, min_period, max_period, oversample=4, zoom=2):
+    """The frequency of the peak of power(t, y, frequencies) between 1/max_period and 1/min_period."""
+    span = t[-1] - t[0]
+    step = 1.0 / (oversample * span)
+    frequencies = np.arange(1.0 / max_period, 1.0 / min_period + step, step)
+    coarse_t, coarse_y = _coarse(t, y, min_period)
+    best = frequencies[np.argmax(power(coarse_t, coarse_y, frequencies))]
+    for _ in range(zoom):
+        frequencies = best + step * np.linspace(-1.0, 1.0, 5)
+        values = power(t, y, frequencies)
+        i = int(np.clip(np.argmax(values), 1, len(values) - 2))
+        best = frequencies[i]
+        step /= 4.0
+    return _parabolic(frequencies[i - 1:i + 2], values[i - 1:i + 2])
+
+
+def interpolated_dft(t, theta, min_period=1.9, max_period=2.1):
+    """The period from the peak of the discrete time Fourier transform refined by Quinn and Aboutanios-Mulgrew."""
+    t, y = _centered(t, theta)
+    min_period, max_period = _narrow(interpolated_dft, t, y, min_period, max_period)
+    # The refinements depend on the phases of the transform, which are those of a DFT with the time starting at 0
+    t = t - t[0]
+    span = t[-1] - t[0]
+    bin_width = 1.0 / span
+    frequencies = np.arange(1.0 / max_period - bin_width, 1.0 / min_period + 2.0 * bin_width, bin_width)
+    coarse_t, coarse_y = _coarse(t, y, min_period)
+    k = int(np.clip(np.argmax(np.abs(_transform(coarse_t, coarse_y, frequencies))), 1, len(frequencies) - 2))
+    below, peak, above = _transform(t, y, frequencies[k - 1:k + 2]) - _image(t, y, frequencies[k],
+                                                                               frequencies[k - 1:k + 2])
+    # Quinn's first estimator
+    alpha_below = (below / peak).real
+    alpha_above = (above / peak).real
+    delta_below = alpha_below / (1.0 - alpha_below)
+    delta_above = -alpha_above / (1.0 - alpha_above)
+    delta = delta_above if delta_below > 0.0 and delta_above > 0.0 else delta_below
+    frequency = frequencies[k] + delta * bin_width
+    for _ in range(3):
+        half_bins = [frequency - 0.5 * bin_width, frequency + 0.5 * bin_width]
+        below, above = _transform(t, y, half_bins) - _image(t, y, frequency, half_bins)
+        if above == below:
+            break
+        frequency += 0.5 * bin_width * ((above + below) / (above - below)).real
+    return 1.0 / frequency
+
+
+def frequency_grid(t, theta, min_period=1.9, max_period=2.1):
+    """The period of the best least squares fit of a sine and an offset over a grid of frequencies."""
+    t, y = _centered(t, theta)
+    min_period, max_period = _narrow(frequency_grid, t, y, min_period, max_period)
+    return 1.0 / _grid_search(_sine_power, t, y, min_period, max_period)
+
+
+def lomb_scargle(t, theta, min_period=1.9, max_period=2.1):
+    """The period of the peak of the Lomb-Scargle periodogram."""
+    t, y = _centered(t, theta)
+    min_period, max_period = _narrow(lomb_scargle, t, y, min_period, max_period)
+    return 1.0 / _grid_search(_lomb_scargle_power, t, y, min_period, max_period)
+
+
+PERIOD_ESTIMATORS = {
+    'dft': interpolated_dft,
+    'grid': frequency_grid,
+    'lomb_scargle': lomb_scargle,
+}
+
+
+def fit_at_period(t, theta, period):
+    """The (amplitude, phase, offset, r_squared) of the least squares fit of a sine with the period."""
+    t = np.asarray(t, dtype=np.float64)
+    theta = np.asarray(theta, dtype=np.float64)
+    angle = 2.0 * np.pi * (t - t[0]) / period
+    design = np.column_stack((np.sin(angle), np.cos(angle), np.ones_like(angle)))
+    (a, b, offset), _, _, _ = np.linalg.lstsq(design, theta, rcond=None)
+    residual = theta - design @ (a, b, offset)
+    total = np.sum((theta - theta.mean()) ** 2)
+    r_squared = 1.0 - np.sum(residual ** 2) / total if total > 0.0 else 0.0
+    return math.hypot(a, b), math.atan2(b, a), offset, r_squared
+
+
+def estimate_period(data, index, estimator='dft', min_period=1.9, max_period=2.1):
+    """
+    The (period, amplitude, offset, r_squared) of a window of points in the format of pendulum_equation(): a list
+    of tuples of time and positions where 'index' is the position that is used.
+    """
+    points = np.asarray(data, dtype=np.float64)
+    t, theta = points[:, 0] - points[0, 0], points[:, index]
+    period = PERIOD_ESTIMATORS[estimator](t, theta, min_period, max_period)
+    amplitude, _, offset, r_squared = fit_at_period(t, theta, period)
+    return period, amplitude, offset, r_squared
@@ -1,74 +1,262 @@
-import numpy as np
-from scipy import stats
+import math
 import logging
+from bisect import bisect_left, insort
+from collections import deque
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
-def remove_outliers_zscore(data, column_index, threshold=2.25):
+# Outlier filters of columns of floats (e.g. the first and last edges of a window of NANOS_FIRST_N_LAST_DTYPE rows)
+# that return masks of the values that are kept, so that several columns are filtered in one pass and the rows are
+# selected with the masks without boxing each value in a tuple:
+#
+#   zscore_mask()   |value - mean| <= threshold standard deviations
+#   mad_mask()      the modified z-score: |value - median| <= threshold * 1.4826 MAD (median absolute deviation),
+#                   which isn't dragged by the outliers themselves as the mean and standard deviation are
+#   iqr_mask()      within k interquartile ranges of the quartiles
+#   hampel_mask()   within threshold * 1.4826 MAD of the median of the half_window values either side, so a spike
+#                   is found against where the signal is at that moment (a swinging pendulum's edge is nowhere near
+#                   the median of the whole window at the ends of its swing)
+#
+# remove_outliers_zscore() and remove_outliers_iqr() are the list of tuples versions that were here first.
+#
+# The streaming filters decide each value as it arrives (per scan in run_scanner()), before it reaches a fit:
+# RollingMedian keeps the last 'window' values in sorted order, and finds the median and the MAD from it with
+# binary searches, O(log w) comparisons (the values are inserted and removed by bisection; the list is moved up or
+# down by a memmove, which for the windows used here is faster than any tree in Python). MedianMADFilter compares a
+# value with the median/MAD of the values before it; HampelFilter compares each value with the median/MAD of the
+# half_window values either side of it, and so decides each value half_window values after it arrives.
+
+# The MAD of normally distributed values times this is their standard deviation
+MAD_SCALE = 1.4826
+
+
+def _columns(values):
+    """The values with each column in a row of its own (reducing along rows of a few columns is slow)."""
+    return np.ascontiguousarray(np.asarray(values, dtype=np.float64).T)
+
+
+def zscore_mask(values, threshold=2.25):
     """
-    Removes outliers from an array of tuples based on the Z-score of a specific column.
+    The values (an array of n values, or n rows of columns) whose |z-score| of their column is within threshold.
+    A column whose values are all the same has no outliers; NaN is never kept, and the z-scores are of the other
+    values of its column.
+    """
+    columns = _columns(values)
+    kept = ~np.isnan(columns)
+    count = kept.sum(axis=-1, keepdims=True)
+    # A column of only NaN divides by 0; all of it is rejected anyway
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(kept, columns, 0.0).sum(axis=-1, keepdims=True) / count
+        deviation = np.abs(columns - mean)
+        std = np.sqrt(np.where(kept, deviation * deviation, 0.0).sum(axis=-1, keepdims=True) / count)
+        return (deviation <= threshold * std).T
 
-    Args:
-        data (list): A list of tuples.
-        column_index (int): The index of the value in the tuple to check for outliers.
-        threshold (float): The Z-score threshold for identifying an outlier.
 
-    Returns:
-        list: A new list of tuples with outliers removed.
+def mad_mask(values, threshold=3.5):
+    """The values (an array of n values, or n rows of columns) within threshold * 1.4826 MAD of the median."""
+    columns = _columns(values)
+    deviation = np.abs(columns - np.median(columns, axis=-1, keepdims=True))
+    return (deviation <= threshold * MAD_SCALE * np.median(deviation, axis=-1, keepdims=True)).T
+
+
+def iqr_mask(values, k=1.5):
+    """The values (an array of n values, or n rows of columns) within k interquartile ranges of the quartiles."""
+    columns = _columns(values)
+    n = columns.shape[-1]
+    # The quartiles as remove_outliers_iqr() has always taken them
+    q1_index, q3_index = math.floor(n * 0.25), min(math.ceil(n * 0.75), n - 1)
+    ordered = np.partition(columns, (q1_index, q3_index), axis=-1)
+    q1, q3 = ordered[..., q1_index:q1_index + 1], ordered[..., q3_index:q3_index + 1]
+    iqr = q3 - q1
+    return ((columns >= q1 - k * iqr) & (columns <= q3 + k * iqr)).T
+
+
+def _hampel_outlier(value, median, mad, threshold, min_sigma):
+    return bool(abs(value - median) > threshold * max(MAD_SCALE * mad, min_sigma))
+
+
+def hampel_mask(values, half_window=3, threshold=3.0, min_sigma=0.0):
+    """
+    The values (an array of n values, or n rows of columns) within threshold * 1.4826 MAD (or min_sigma, when that is
+    more) of the median of the values from half_window before to half_window after them (fewer at the ends).
+    HampelFilter decides the same values as they arrive.
     """
-    # 1. Extract the values from the specified column
-    values = np.array([item[column_index] for item in data])
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    width = 2 * half_window + 1
+    kept = np.ones(values.shape, dtype=bool)
+    if n >= width:
+        windows = np.lib.stride_tricks.sliding_window_view(values, width, axis=0)
+        medians = np.median(windows, axis=-1)
+        mads = np.median(np.abs(windows - medians[..., None]), axis=-1)
+        centre = values[half_window:n - half_window]
+        kept[half_window:n - half_window] = (np.abs(centre - medians)
+                                             <= threshold * np.maximum(MAD_SCALE * mads, min_sigma))
+    for i in list(range(min(half_window, n))) + list(range(max(n - half_window, half_window), n)):
+        window = values[max(0, i - half_window):i + half_window + 1]
+        median = np.median(window, axis=0)
+        mad = np.median(np.abs(window - median), axis=0)
+        kept[i] = np.abs(values[i] - median) <= threshold * np.maximum(MAD_SCALE * mad, min_sigma)
+    return kept
 
-    # 2. Calculate the absolute Z-scores for each value
-    z_scores = np.abs(stats.zscore(values))
 
-    # 3. Create a boolean mask for non-outliers
-    # Points with an absolute Z-score <= threshold are kept
-    not_outlier_mask = z_scores <= threshold
+class RollingMedian:
+    """The median and the MAD of the last 'window' values added."""
 
-    # 4. Filter the original data using the mask
-    # Convert list of tuples to numpy array for efficient boolean indexing
-    data_np = np.array(data, dtype=object)  # Use dtype=object if tuples contain mixed types
-    filtered_data_np = data_np[not_outlier_mask]
+    def __init__(self, window):
+        self.window = window
+        self._values = deque()
+        self._sorted = []
 
-    # 5. Convert the result back to a list of tuples
-    filtered_data = [tuple(row) for row in filtered_data_np.tolist()]
-    outlier_data = list(set(data) - set(filtered_data))
+    def __len__(self):
+        return len(self._sorted)
 
-    return filtered_data, outlier_data
+    def add(self, value):
+        if len(self._values) == self.window:
+            self.remove_oldest()
+        self._values.append(value)
+        insort(self._sorted, value)
 
+    def remove_oldest(self):
+        del self._sorted[bisect_left(self._sorted, self._values.popleft())]
 
-import math
+    @property
+    def median(self):
+        ordered, n = self._sorted, len(self._sorted)
+        return (ordered[(n - 1) // 2] + ordered[n // 2]) / 2.0
 
+    def _deviation(self, k, median, split):
+        """The k-th (from 0) smallest |value - median|; 'split' values are below the median."""
+        # The deviations below the median (from the median down) and above it (from the median up) are each in
+        # order, so the k-th of both is found by bisecting how many of it are from below
+        ordered, above = self._sorted, len(self._sorted) - split
+        low, high = max(0, k + 1 - above), min(k + 1, split)
+        while low < high:
+            i = (low + high) // 2
+            j = k + 1 - i
+            if j > 0 and median - ordered[split - 1 - i] < ordered[split + j - 1] - median:
+                low = i + 1
+            else:
+                high = i
+        j = k + 1 - low
+        return max(median - ordered[split - low] if low > 0 else -math.inf,
+                   ordered[split + j - 1] - median if j > 0 else -math.inf)
 
-def remove_outliers_iqr(data, column_index):
+    def mad(self):
+        """The median absolute deviation from the median."""
+        n = len(self._sorted)
+        median = self.median
+        split = bisect_left(self._sorted, median)
+        return (self._deviation((n - 1) // 2, median, split) + self._deviation(n // 2, median, split)) / 2.0
+
+
+class MedianMADFilter:
     """
-    Removes tuples where a specific member (by column_index) is an outlier
-    using the IQR method.
+    A value is an outlier when it is more than threshold * 1.4826 MAD (or min_sigma, when that is more) from the
+    median of the 'window' values before it. Nothing is an outlier until there are min_count values.
     """
-    # Extract the values from the specified column
-    values = sorted([item[column_index] for item in data])
 
-    # Calculate the first (Q1) and third (Q3) quartiles
-    q1_idx = math.floor(len(values) * 0.25)
-    q3_idx = math.ceil(len(values) * 0.75)
-    q1 = values[q1_idx]
-    q3 = values[q3_idx]
+    def __init__(self, window=31, threshold=3.5, min_sigma=0.0, min_count=None):
+        self.rolling = RollingMedian(window)
+        self.threshold = threshold
+        self.min_sigma = min_sigma
+        self.min_count = window // 2 + 1 if min_count is None else min_count
+        self.outliers = 0
 
-    # Calculate the Interquartile Range (IQR)
-    iqr = q3 - q1
+    def update(self, value):
+        """Add the value; returns True when it is an outlier (it is added to the window all the same)."""
+        outlier = (len(self.rolling) >= self.min_count and
+                   _hampel_outlier(value, self.rolling.median, self.rolling.mad(), self.threshold, self.min_sigma))
+        self.rolling.add(value)
+        self.outliers += outlier
+        return outlier
+
+
+class HampelFilter:
+    """
+    A Hampel filter of 'columns' columns of values that arrive a row at a time: a value is an outlier when it is more
+    than threshold * 1.4826 MAD (or min_sigma, when that is more) from the median of its column from half_window rows
+    before it to half_window rows after it. A row is decided when the row half_window after it arrives.
+    """
+
+    def __init__(self, half_window=3, threshold=3.0, min_sigma=0.0, columns=1):
+        self.half_window = half_window
+        self.threshold = threshold
+        self.min_sigma = min_sigma
+        self.rolling = [RollingMedian(2 * half_window + 1) for _ in range(columns)]
+        self.count = 0
+        self.outliers = [0] * columns
+        self._pending = deque()
+
+    def _decide(self):
+        t, values, payload = self._pending.popleft()
+        outliers = tuple(_hampel_outlier(value, rolling.median, rolling.mad(), self.threshold, self.min_sigma)
+                         for value, rolling in zip(values, self.rolling))
+        for column, outlier in enumerate(outliers):
+            self.outliers[column] += outlier
+        return t, values, payload, outliers
+
+    def update(self, t, values, payload=None):
+        """
+        Add the row of values (one for each column) at time t, with anything to pass on with it as its payload.
+        Returns the rows that were decided, [(t, values, payload, (outlier of each column))]; none until
+        half_window rows have arrived, and then the one half_window before this one.
+        """
+        for value, rolling in zip(values, self.rolling):
+            rolling.add(value)
+        self.count += 1
+        self._pending.append((t, values, payload))
+        if len(self._pending) > self.half_window:
+            return [self._decide()]
+        return []
+
+    def flush(self):
+        """Decide the rows that are waiting for the ones after them (with those there are) and start over."""
+        decided = []
+        while self._pending:
+            # The window of the first row waiting starts half_window rows before it
+            first = self.count - len(self._pending)
+            keep = self.count - max(0, first - self.half_window)
+            for rolling in self.rolling:
+                while len(rolling) > keep:
+                    rolling.remove_oldest()
+            decided.append(self._decide())
+        self.rolling = [RollingMedian(2 * self.half_window + 1) for _ in self.rolling]
+        self.count = 0
+        return decided
+
+
+def remove_outliers_zscore(data, column_index, threshold=2.25):
+    """
+    Removes outliers from an array of tuples based on the Z-score of a specific column.
 
-    # Define bounds for outliers (commonly 1.5 * IQR)
-    lower_bound = q1 - 1.5 * iqr
-    upper_bound = q3 + 1.5 * iqr
+    Args:
+        data (list): A list of tuples.
+        column_index (int): The index of the value in the tuple to check for outliers.
+        threshold (float): The Z-score threshold for identifying an outlier.
 
-    # Filter the original data list, keeping only non-outliers
-    cleaned_data = [item for item in data if lower_bound <= item[column_index] <= upper_bound]
+    Returns:
+        list: A new list of tuples with outliers removed, and a list of the outliers.
+    See zscore_mask() to filter an array (or several columns of it) without the tuples.
+    """
+    kept = zscore_mask([item[column_index] for item in data], threshold)
+    filtered_data = [item for item, keep in zip(data, kept) if keep]
+    outlier_data = [item for item, keep in zip(data, kept) if not keep]
+    return filtered_data, outlier_data
 
-    outlier_data = list(set(data) - set(cleaned_data))
 
+def remove_outliers_iqr(data, column_index):
+    """
+    Removes tuples where a specific member (by column_index) is an outlier
+    using the IQR method (see iqr_mask()).
+    """
+    kept = iqr_mask([item[column_index] for item in data])
+    cleaned_data = [item for item, keep in zip(data, kept) if keep]
+    outlier_data = [item for item, keep in zip(data, kept) if not keep]
     return cleaned_data, outlier_data
 
+
 if __name__ == '__main__':
     # Example Usage:
     #data = [('A', 10), ('B', 20), ('C', 25), ('D', 100), ('E', 30), ('F', 22), ('G', 15), ('H', 200)]
@@ -83,3 +271,14 @@ if __name__ == '__main__':
     cleaned_list_iqr, outlier_list_iqr = remove_outliers_iqr(data, column_index=column_to_check)
     print("Cleaned list (IQR):", cleaned_list_iqr)
     print("Outlier list:", outlier_list_iqr)
+
+    # The first and last edges of a swinging pendulum with two spikes, filtered together and as they arrive
+    t = np.arange(0.0, 10.0, 1.0 / 14.2)
+    edges = np.column_stack((100.0 * np.sin(np.pi * t), 100.0 * np.sin(np.pi * t) + 200.0))
+    edges[40, 0] += 400.0
+    edges[90, 1] -= 300.0
+    print("z-score outliers (rows, columns):", np.argwhere(~zscore_mask(edges)).tolist())
+    print("Hampel outliers (rows, columns):", np.argwhere(~hampel_mask(edges, min_sigma=3.0)).tolist())
+    hampel = HampelFilter(min_sigma=3.0, columns=2)
+    decided = [row for i in range(len(t)) for row in hampel.update(t[i], edges[i], i)] + hampel.flush()
+    print("HampelFilter outliers (rows):", [(row[2], row[3]) for row in decided if any(row[3])])
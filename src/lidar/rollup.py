@@ -0,0 +1,295 @@
+import math
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Rolls up what run_scanner() learns about the pendulum into a ROLLUP_DTYPE record per minute, hour, and day of
+# sufficient statistics, so that longer windows are combined from the records rather than fit again from the points:
+#
+# - the points (first and last edges): counts, means and sums of squared deviations (M2), minimums and maximums,
+# - the blocks of lidar.fit_sine_with_fft_guess.StreamingSineFit: the weighted mean time and phase and their
+#   co-moments (the normal equations of the straight line through the phases, whose slope is the frequency), the
+#   sum of the squared residuals, and the weighted mean and M2 of the points they fit,
+# - the beats of lidar.beat_timer.BeatTimer: counts, means and M2 of the periods, half periods, and amplitudes,
+# - the scans and the scans where the pendulum wasn't found.
+#
+# The means and M2 of a set of records are pooled as in the parallel algorithm for the variance (the M2 of each plus
+# the squared deviations of its mean from the pooled mean), which stays accurate however many records there are and
+# however far from the epoch they are. A block or a beat is in the minute that it is added in. The points, blocks,
+# and beats of the minute that is open are only kept until it is closed (by a point in a later minute), when its
+# record is made from them in one vectorized pass, so adding them costs no more than appending to a list.
+#
+# The minutes, hours, and days are those of the wall clock (UTC): the scan times are time.perf_counter() times, so
+# the Rollup adds clock_offset (time.time() - time.perf_counter()) to them before it finds the minute they are in, and
+# the start and end of its records are wall clock times. An hour closes on the hour, not an hour after an arbitrary
+# epoch.
+#
+# The last day of minutes, month of hours, and year of days are kept in rings, so memory is bounded, and a window of
+# any number of the latest minutes (a sliding hour updated every minute) is pooled in one vectorized pass.
+
+ROLLUP_DTYPE = np.dtype([(name, np.float64) for name in (
+    'start', 'end', 'scans', 'failures',
+    'points', 'first_mean', 'first_m2', 'first_min', 'first_max', 'last_mean', 'last_m2', 'last_min', 'last_max',
+    'fit_weight', 'fit_time', 'fit_phase', 'fit_tt', 'fit_tp', 'fit_sse', 'fit_mean', 'fit_m2',
+    'fit_amplitude', 'fit_offset',
+    'beats', 'period_count', 'period_mean', 'period_m2', 'up_count', 'up_mean', 'down_count', 'down_mean',
+    'amplitude_mean', 'amplitude_m2')])
+
+# (count, mean, M2) fields that are pooled together
+_MOMENTS = (('points', 'first_mean', 'first_m2'), ('points', 'last_mean', 'last_m2'),
+            ('fit_weight', 'fit_mean', 'fit_m2'), ('period_count', 'period_mean', 'period_m2'),
+            ('up_count', 'up_mean', None), ('down_count', 'down_mean', None),
+            ('beats', 'amplitude_mean', 'amplitude_m2'), ('fit_weight', 'fit_amplitude', None),
+            ('fit_weight', 'fit_offset', None))
+_SUMS = ('scans', 'failures', 'points', 'fit_weight', 'fit_sse', 'beats', 'period_count', 'up_count', 'down_count')
+
+
+def _empty():
+    record = np.zeros(1, dtype=ROLLUP_DTYPE)[0]
+    for name in ('first_min', 'last_min'):
+        record[name] = np.inf
+    for name in ('first_max', 'last_max'):
+        record[name] = -np.inf
+    return record
+
+
+def _pool(counts, means, m2s=None):
+    """The (count, mean, M2) of groups given theirs."""
+    total = counts.sum()
+    if total == 0:
+        return 0.0, 0.0, 0.0
+    mean = np.dot(counts, np.where(counts > 0, means, 0.0)) / total
+    if m2s is None:
+        return total, mean, 0.0
+    deviation = np.where(counts > 0, means - mean, 0.0)
+    return total, mean, m2s.sum() + np.dot(counts, deviation * deviation)
+
+
+def combine(records):
+    """The record of a set of records (an array of ROLLUP_DTYPE)."""
+    result = _empty()
+    if len(records) == 0:
+        return result
+    result['start'] = records['start'].min()
+    result['end'] = records['end'].max()
+    for count, mean, m2 in _MOMENTS:
+        _, result[mean], pooled_m2 = _pool(records[count], records[mean], records[m2] if m2 else None)
+        if m2:
+            result[m2] = pooled_m2
+    for name in _SUMS:
+        result[name] = records[name].sum()
+    for name in ('first_min', 'last_min'):
+        result[name] = records[name].min()
+    for name in ('first_max', 'last_max'):
+        result[name] = records[name].max()
+    # The co-moments of the block times and phases
+    weight = records['fit_weight']
+    total, result['fit_time'], result['fit_tt'] = _pool(weight, records['fit_time'], records['fit_tt'])
+    _, result['fit_phase'], _ = _pool(weight, records['fit_phase'])
+    if total > 0:
+        dt = np.where(weight > 0, records['fit_time'] - result['fit_time'], 0.0)
+        dp = np.where(weight > 0, records['fit_phase'] - result['fit_phase'], 0.0)
+        result['fit_tp'] = records['fit_tp'].sum() + np.dot(weight, dt * dp)
+    return result
+
+
+def estimate(record, omega0):
+    """The pendulum over a record: a dict of its period, R^2, swing, and beats (the ones it has data for)."""
+    result = {'start': float(record['start']), 'end': float(record['end']), 'scans': int(record['scans']),
+              'failures': int(record['failures']), 'points': int(record['points'])}
+    if record['points'] > 0:
+        result['swing'] = float(record['first_max'] - record['first_min'])
+        result['width'] = float(abs(record['first_min'] - record['last_min']))
+    if record['fit_weight'] > 0 and record['fit_tt'] > 0:
+        result['period'] = float(2.0 * math.pi / (omega0 + record['fit_tp'] / record['fit_tt']))
+        result['r_squared'] = float(1.0 - record['fit_sse'] / record['fit_m2']) if record['fit_m2'] > 0 else 0.0
+        result['amplitude'] = float(record['fit_amplitude'])
+    if record['period_count'] > 1:
+        result['beat_period'] = float(record['period_mean'])
+        result['beat_period_std'] = float(math.sqrt(record['period_m2'] / (record['period_count'] - 1)))
+    if record['up_count'] > 0 and record['down_count'] > 0:
+        result['beat_error'] = float(record['up_mean'] - record['down_mean']) / 2.0
+    if record['beats'] > 0:
+        result['beat_amplitude'] = float(record['amplitude_mean'])
+    return result
+
+
+class _Ring:
+    def __init__(self, size):
+        self.records = np.zeros(size, dtype=ROLLUP_DTYPE)
+        self.count = 0
+
+    def append(self, record):
+        self.records[self.count % len(self.records)] = record
+        self.count += 1
+
+    def latest(self, n):
+        n = min(n, self.count, len(self.records))
+        return self.records[np.arange(self.count - n, self.count) % len(self.records)]
+
+
+class Rollup:
+    """
+    period: the expected period the StreamingSineFit uses (its omega0). minutes, hours, days: records kept of each.
+    clock_offset: added to the times of the points to put them on the wall clock (time.time()).
+    """
+
+    def __init__(self, period=2.0, minutes=1440, hours=744, days=366, clock_offset=0.0):
+        self.omega0 = 2.0 * math.pi / period
+        self.clock_offset = clock_offset
+        self.minutes = _Ring(minutes)
+        self.hours = _Ring(hours)
+        self.days = _Ring(days)
+        # The start of the minute that is open (None before the first point) and what has been added to it
+        self._start = None
+        self._points = []
+        self._blocks = []
+        self._beats = []
+        self._failures = 0
+        self._hour = None
+        self._day = None
+
+    def _record(self):
+        """The record of the minute that is open."""
+        record = _empty()
+        record['start'], record['end'] = self._start, self._start + 60.0
+        record['failures'] = self._failures
+        if self._points:
+            t, first, last = np.concatenate(self._points, axis=1)
+            record['points'] = len(t)
+            for name, values in (('first', first), ('last', last)):
+                mean = values.mean()
+                record[f"{name}_mean"] = mean
+                record[f"{name}_m2"] = np.sum((values - mean) ** 2)
+                record[f"{name}_min"] = values.min()
+                record[f"{name}_max"] = values.max()
+        record['scans'] = record['points'] + record['failures']
+        if self._blocks:
+            blocks = np.concatenate(self._blocks)
+            weight = blocks['count']
+            record['fit_weight'] = weight.sum()
+            record['fit_time'] = np.dot(weight, blocks['time']) / record['fit_weight']
+            record['fit_phase'] = np.dot(weight, blocks['phase']) / record['fit_weight']
+            dt = blocks['time'] - record['fit_time']
+            record['fit_tt'] = np.dot(weight, dt * dt)
+            record['fit_tp'] = np.dot(weight, dt * (blocks['phase'] - record['fit_phase']))
+            record['fit_sse'] = blocks['sse'].sum()
+            block_means = blocks['sum'] / weight
+            _, record['fit_mean'], record['fit_m2'] = _pool(weight, block_means,
+                                                            blocks['sum_sq'] - blocks['sum'] * block_means)
+            record['fit_amplitude'] = np.dot(weight, blocks['amplitude']) / record['fit_weight']
+            record['fit_offset'] = np.dot(weight, blocks['offset']) / record['fit_weight']
+        if self._beats:
+            beats = np.concatenate(self._beats)
+            record['beats'] = len(beats)
+            record['amplitude_mean'] = beats['amplitude'].mean()
+            record['amplitude_m2'] = np.sum((beats['amplitude'] - record['amplitude_mean']) ** 2)
+            periods = beats['period'][~np.isnan(beats['period'])]
+            if len(periods):
+                record['period_count'] = len(periods)
+                record['period_mean'] = periods.mean()
+                record['period_m2'] = np.sum((periods - record['period_mean']) ** 2)
+            for name, direction in (('up', 1), ('down', -1)):
+                half_periods = beats['half_period'][beats['direction'] == direction]
+                if len(half_periods):
+                    record[f"{name}_count"] = len(half_periods)
+                    record[f"{name}_mean"] = half_periods.mean()
+        return record
+
+    @staticmethod
+    def _fold(total, record, seconds):
+        """Combine record into the total of the 'seconds' long period it is in."""
+        total = record.copy() if total is None else combine(np.array([total, record]))
+        total['start'] = math.floor(record['start'] / seconds) * seconds
+        total['end'] = total['start'] + seconds
+        return total
+
+    def _open(self, t):
+        """Close the minute that is open (and the hour and day when t is in a later one). Returns the hours closed."""
+        closed = []
+        if self._start is not None:
+            minute = self._record()
+            self.minutes.append(minute)
+            self._hour = self._fold(self._hour, minute, 3600.0)
+            if t >= self._hour['end']:
+                self.hours.append(self._hour)
+                closed.append(self._hour)
+                self._day = self._fold(self._day, self._hour, 86400.0)
+                self._hour = None
+                if t >= self._day['end']:
+                    self.days.append(self._day)
+                    self._day = None
+            self._points, self._blocks, self._beats = [], [], []
+            self._failures = 0
+        self._start = math.floor(t / 60.0) * 60.0
+        return closed
+
+    def add_points(self, t, first, last, failures=0):
+        """
+        Add the scans at times t (sec, in time order, before clock_offset) where the pendulum's edges were at first
+        and last, and the number of scans since the last call where it wasn't found (counted in the minute of the last
+        scan added). Returns the hour records that were closed by them.
+        """
+        points = np.array((np.asarray(t, dtype=np.float64) + self.clock_offset, first, last), dtype=np.float64)
+        closed = []
+        while points.shape[1]:
+            if self._start is None or points[0, 0] >= self._start + 60.0:
+                closed += self._open(points[0, 0])
+            # The points in the minute that is open
+            split = np.searchsorted(points[0], self._start + 60.0)
+            self._points.append(points[:, :split])
+            points = points[:, split:]
+        self._failures += failures
+        return closed
+
+    def add_blocks(self, blocks):
+        """Add the blocks (StreamingSineFit.blocks records) completed since the last call."""
+        if len(blocks):
+            self._blocks.append(blocks)
+
+    def add_beats(self, beats):
+        """Add the beats (BEAT_DTYPE records) completed since the last call."""
+        if len(beats):
+            self._beats.append(beats)
+
+    def window(self, minutes):
+        """The estimate() of the complete minutes of the last 'minutes'; None when there are none."""
+        records = self.minutes.latest(minutes)
+        # Minutes without a scan have no record
+        records = records[records['start'] >= self._start - 60.0 * minutes]
+        if len(records) == 0:
+            return None
+        return estimate(combine(records), self.omega0)
+
+    def summary(self):
+        """The last minute, and the sliding hour and day, rounded for the telemetry summary."""
+        summary = {}
+        for name, minutes in (('minute', 1), ('hour', 60), ('day', 1440)):
+            window = self.window(minutes)
+            if window is not None:
+                summary[name] = {key: round(value, 6) if isinstance(value, float) else value
+                                 for key, value in window.items()}
+        return summary
+
+
+if __name__ == '__main__':
+    # Example Usage: scans at time.perf_counter() times, starting 20 sec before 14:00 UTC on the wall clock
+    from datetime import datetime, timezone
+    wall_start = datetime(2026, 3, 1, 13, 59, 40, tzinfo=timezone.utc).timestamp()
+    perf_start = 1234.567
+    rollup = Rollup(clock_offset=wall_start - perf_start)
+    closed = []
+    for second in range(0, 3700, 10):
+        t = perf_start + second + np.arange(0.0, 10.0, 1.0 / 14.2)
+        theta = 100.0 * np.sin(np.pi * t)
+        closed += rollup.add_points(t, theta, theta + 200.0)
+    for hour in closed:
+        start = datetime.fromtimestamp(hour['start'], timezone.utc)
+        end = datetime.fromtimestamp(hour['end'], timezone.utc)
+        print(f"hour {start:%H:%M:%S} to {end:%H:%M:%S}: {int(hour['scans'])} scans")
+    # The first hour is the 20 sec before 14:00, and it closes at 14:00 (not an hour after the first scan)
+    if [datetime.fromtimestamp(hour['end'], timezone.utc).strftime('%H:%M:%S') for hour in closed] != ['14:00:00',
+                                                                                                        '15:00:00']:
+        raise SystemExit("The hours didn't close on the hour")
+    print(rollup.summary()['minute'])
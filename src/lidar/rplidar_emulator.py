@@ -0,0 +1,406 @@
+import os
+import pty
+import tty
+import time
+import math
+import select
+import struct
+import random
+import logging
+import threading
+import numpy as np
+from lidar.rplidar_protocol import (SYNC_BYTE, SYNC_BYTE2, CMD_STOP, CMD_RESET, CMD_SCAN, CMD_FORCE_SCAN,
+                                    CMD_EXPRESS_SCAN, CMD_GET_INFO, CMD_GET_HEALTH, CMD_GET_SAMPLERATE,
+                                    CMD_GET_LIDAR_CONF, CMD_SET_PWM, ANS_TYPE_DEVINFO, ANS_TYPE_DEVHEALTH,
+                                    ANS_TYPE_SAMPLERATE, ANS_TYPE_GET_LIDAR_CONF, ANS_TYPE_MEASUREMENT,
+                                    ANS_TYPE_MEASUREMENT_CAPSULED, ANS_TYPE_MEASUREMENT_DENSE_CAPSULED,
+                                    CONF_SCAN_MODE_COUNT, CONF_SCAN_MODE_US_PER_SAMPLE, CONF_SCAN_MODE_MAX_DISTANCE,
+                                    CONF_SCAN_MODE_ANS_TYPE, CONF_SCAN_MODE_TYPICAL, CONF_SCAN_MODE_NAME)
+
+logger = logging.getLogger(__name__)
+
+# An emulated RPLIDAR on a pseudo-terminal. It answers enough of the RPLIDAR serial protocol
+# (docs/LR001_SLAMTEC_rplidar_protocol_v2.1_en.pdf) for rplidar.RPLidar and lidar.rplidar_protocol.RPLidarNative
+# to connect through lidar.const.startup_lidar, and streams scans of a pendulum bob swinging in front of the back
+# of the clock case. Point [RPLIDAR] PORT in config.ini at the emulator's port (or its --link) to run run_scanner()
+# without the LIDAR, at higher than real scan rates (--speed), and with faults injected:
+#   corrupt packets - a byte of a capsule (so its checksum fails) or the check bit of a measurement node is broken,
+#   stalls          - nothing is sent for a while as if the LIDAR hung,
+#   overflows       - a burst of scans is sent as fast as possible to overrun the reader's input buffer.
+#
+# NOTE: run_scanner() timestamps the scans when they are read, so with --speed N the pendulum period is measured
+# as PERIOD / N. Use --period to compensate when the period matters (e.g. --speed 4 --period 8).
+
+# The scan modes returned by GET_LIDAR_CONF; (name, answer type, samples per revolution relative to Standard)
+_SCAN_MODES = (('Standard', ANS_TYPE_MEASUREMENT, 1),
+               ('Express', ANS_TYPE_MEASUREMENT_CAPSULED, 2),
+               ('Boost', ANS_TYPE_MEASUREMENT_DENSE_CAPSULED, 4))
+_TYPICAL_SCAN_MODE = 2
+_CAPSULE_SAMPLES = {ANS_TYPE_MEASUREMENT: 1, ANS_TYPE_MEASUREMENT_CAPSULED: 32, ANS_TYPE_MEASUREMENT_DENSE_CAPSULED: 40}
+_PACKET_SIZE = {ANS_TYPE_MEASUREMENT: 5, ANS_TYPE_MEASUREMENT_CAPSULED: 84, ANS_TYPE_MEASUREMENT_DENSE_CAPSULED: 84}
+_MAX_DISTANCE_M = 12.0
+_FAR_DISTANCE_MM = 3000.0
+
+
+class PendulumScene:
+    """
+    A round bob (radius bob_radius_mm) bob_distance_mm from the LIDAR in the direction bob_bearing_deg swings
+    sideways by amplitude_mm with the given period. wall_gap_mm behind it is the back of the clock case; everything
+    else is far away. Distances get Gaussian noise_mm and a fraction 'dropout' of the samples have no reading.
+    """
+
+    def __init__(self, bob_distance_mm=300.0, bob_radius_mm=50.0, bob_bearing_deg=90.0, amplitude_mm=50.0,
+                 period=2.0, wall_gap_mm=150.0, noise_mm=1.0, dropout=0.01, seed=None):
+        self.bob_distance_mm = bob_distance_mm
+        self.bob_radius_mm = bob_radius_mm
+        self.bob_bearing_deg = bob_bearing_deg
+        self.amplitude_mm = amplitude_mm
+        self.period = period
+        self.wall_gap_mm = wall_gap_mm
+        self.noise_mm = noise_mm
+        self.dropout = dropout
+        self.rng = np.random.default_rng(seed)
+
+    def bob_offset(self, t):
+        return self.amplitude_mm * np.sin(2.0 * np.pi * t / self.period)
+
+    def revolution(self, t0, samples, rate_hz):
+        """
+        One revolution of 'samples' samples starting at time t0 (sec) as (quality, angle, distance) arrays. The
+        first sample of each revolution is at a random angle just past 0 as it is with the LIDAR.
+        """
+        step = 360.0 / samples
+        angle = (self.rng.uniform(0.0, step) + np.arange(samples) * step) % 360.0
+        t = t0 + np.arange(samples) / (samples * rate_hz)
+        # The scan code mirrors the LIDAR angle (360 - angle), so the scene is laid out in the mirrored angles
+        local = np.radians(360.0 - angle - self.bob_bearing_deg)
+        cos, sin = np.cos(local), np.sin(local)
+        distance = np.full(samples, _FAR_DISTANCE_MM)
+        ahead = cos > 1e-6
+        wall = (self.bob_distance_mm + self.wall_gap_mm) / np.where(ahead, cos, 1.0)
+        distance = np.where(ahead & (wall < distance), wall, distance)
+        # The ray hits the bob where it meets the circle centred at (bob_distance_mm, bob_offset(t))
+        cx, cy = self.bob_distance_mm, self.bob_offset(t)
+        along = cos * cx + sin * cy
+        disc = along ** 2 - (cx ** 2 + cy ** 2) + self.bob_radius_mm ** 2
+        hit = (disc >= 0.0) & (along > 0.0)
+        bob = along - np.sqrt(np.where(hit, disc, 0.0))
+        distance = np.where(hit & (bob < distance), bob, distance)
+        distance = distance + self.rng.normal(0.0, self.noise_mm, samples)
+        distance = np.where(self.rng.random(samples) < self.dropout, 0.0, np.clip(distance, 0.0, None))
+        quality = np.where(distance > 0, 47, 0).astype(np.uint8)
+        return quality, angle, distance
+
+
+def _descriptor(size, dtype, multiple=False):
+    return bytes((SYNC_BYTE, SYNC_BYTE2)) + struct.pack('<I', size | ((1 if multiple else 0) << 30)) + bytes((dtype,))
+
+
+def _encode_measurements(quality, angle, distance):
+    """Legacy SCAN measurement nodes; the first sample is flagged as the start of a new scan."""
+    n = len(angle)
+    angle_q6 = np.round(angle * 64.0).astype(np.uint16) & 0x7FFF
+    dist_q2 = np.round(np.minimum(distance, _MAX_DISTANCE_M * 1000.0) * 4.0).astype(np.uint16)
+    start = np.zeros(n, dtype=np.uint8)
+    start[0] = 1
+    nodes = np.empty((n, 5), dtype=np.uint8)
+    nodes[:, 0] = (quality.astype(np.uint8) << 2) | start | ((1 - start) << 1)
+    nodes[:, 1] = ((angle_q6 & 0x7F) << 1) | 1
+    nodes[:, 2] = angle_q6 >> 7
+    nodes[:, 3] = dist_q2 & 0xFF
+    nodes[:, 4] = dist_q2 >> 8
+    return nodes
+
+
+def _encode_capsules(angle, distance, ans_type, first):
+    """Express or dense capsules of the samples; 'first' sets the S flag on the first capsule."""
+    samples = _CAPSULE_SAMPLES[ans_type]
+    n = len(angle) // samples
+    capsules = np.zeros((n, 84), dtype=np.uint8)
+    start_q6 = np.round(angle[::samples][:n] * 64.0).astype(np.uint16) & 0x7FFF
+    capsules[:, 2] = start_q6 & 0xFF
+    capsules[:, 3] = start_q6 >> 8
+    if first:
+        capsules[0, 3] |= 0x80
+    mm = np.round(distance[:n * samples]).astype(np.uint16).reshape(n, samples)
+    if ans_type == ANS_TYPE_MEASUREMENT_CAPSULED:
+        # 16 cabins of two 14 bit distances; the angle compensations (dθ) are left at 0
+        mm = np.minimum(mm, 0x3FFF)
+        cabins = capsules[:, 4:84].reshape(n, 16, 5)
+        cabins[:, :, 0] = (mm[:, 0::2] << 2) & 0xFF
+        cabins[:, :, 1] = mm[:, 0::2] >> 6
+        cabins[:, :, 2] = (mm[:, 1::2] << 2) & 0xFF
+        cabins[:, :, 3] = mm[:, 1::2] >> 6
+    else:
+        capsules[:, 4:84] = mm.astype('<u2').view(np.uint8).reshape(n, 80)
+    checksum = np.bitwise_xor.reduce(capsules[:, 2:], axis=1)
+    capsules[:, 0] = 0xA0 | (checksum & 0x0F)
+    capsules[:, 1] = 0x50 | (checksum >> 4)
+    return capsules
+
+
+class RPLidarEmulator:
+    """
+    rate_hz: revolutions per second of the emulated LIDAR and samples_per_scan the samples per revolution in the
+    Standard scan mode (the express modes have more). speed runs the emulation faster than real-time.
+    corrupt_rate: the fraction of the packets that are corrupted.
+    stall_every/stall_seconds: every stall_every seconds (emulated) nothing is sent for stall_seconds.
+    overflow_every/overflow_scans: every overflow_every seconds (emulated) overflow_scans scans are sent at once.
+    link: a symlink made to the pseudo-terminal so that config.ini can name a fixed port.
+    """
+
+    def __init__(self, scene=None, rate_hz=14.2, samples_per_scan=400, speed=1.0, corrupt_rate=0.0,
+                 stall_every=0.0, stall_seconds=0.0, overflow_every=0.0, overflow_scans=50, link=None):
+        self.scene = scene if scene is not None else PendulumScene()
+        self.rate_hz = rate_hz
+        self.samples_per_scan = samples_per_scan
+        self.speed = speed
+        self.corrupt_rate = corrupt_rate
+        self.stall_every = stall_every
+        self.stall_seconds = stall_seconds
+        self.overflow_every = overflow_every
+        self.overflow_scans = overflow_scans
+        self.link = link
+        self.pwm = 0
+        self.scanning = None  # the answer type being streamed
+        self._first_capsule = False
+        self._pending = bytearray()
+        self._stop = threading.Event()
+        self._thread = None
+        self.revolutions = 0
+        self.revolutions_sent = 0
+        self.packets_corrupted = 0
+        self.bytes_dropped = 0
+        self.stalls = 0
+        self.overflows = 0
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.port, link)
+        logger.info(f"RPLIDAR emulator on {self.port}" + (f" ({link})" if link else ""))
+
+    @property
+    def emulated_time(self):
+        return self.revolutions / self.rate_hz
+
+    def _write(self, data):
+        # Like the UART, bytes that the host doesn't make room for are lost
+        try:
+            written = os.write(self._master, data)
+        except BlockingIOError:
+            written = 0
+        self.bytes_dropped += len(data) - written
+
+    def _reply(self, dtype, payload):
+        self._write(_descriptor(len(payload), dtype) + payload)
+
+    def _lidar_conf(self, payload):
+        conf_type = struct.unpack('<I', payload[:4])[0]
+        mode = struct.unpack('<H', payload[4:6])[0] if len(payload) >= 6 else 0
+        if conf_type == CONF_SCAN_MODE_COUNT:
+            value = struct.pack('<H', len(_SCAN_MODES))
+        elif conf_type == CONF_SCAN_MODE_TYPICAL:
+            value = struct.pack('<H', _TYPICAL_SCAN_MODE)
+        elif mode >= len(_SCAN_MODES):
+            value = b''
+        elif conf_type == CONF_SCAN_MODE_US_PER_SAMPLE:
+            samples = self.samples_per_scan * _SCAN_MODES[mode][2]
+            value = struct.pack('<I', int(1e6 / (self.rate_hz * samples) * 256))
+        elif conf_type == CONF_SCAN_MODE_MAX_DISTANCE:
+            value = struct.pack('<I', int(_MAX_DISTANCE_M * 256))
+        elif conf_type == CONF_SCAN_MODE_ANS_TYPE:
+            value = bytes((_SCAN_MODES[mode][1],))
+        elif conf_type == CONF_SCAN_MODE_NAME:
+            value = _SCAN_MODES[mode][0].encode('utf-8') + b'\0'
+        else:
+            value = b''
+        self._reply(ANS_TYPE_GET_LIDAR_CONF, struct.pack('<I', conf_type) + value)
+
+    def _start_scan(self, ans_type):
+        self.scanning = ans_type
+        self._first_capsule = True
+        self._write(_descriptor(_PACKET_SIZE[ans_type], ans_type, multiple=True))
+        logger.info(f"Scanning with answer type {ans_type:#04x}")
+
+    def _command(self, cmd, payload):
+        if cmd == CMD_STOP:
+            self.scanning = None
+        elif cmd == CMD_RESET:
+            self.scanning = None
+            self.pwm = 0
+        elif cmd in (CMD_SCAN, CMD_FORCE_SCAN):
+            self._start_scan(ANS_TYPE_MEASUREMENT)
+        elif cmd == CMD_EXPRESS_SCAN:
+            # Working mode 0 is the legacy express scan, otherwise the id of one of the scan modes
+            mode = payload[0] if payload else 0
+            self._start_scan(_SCAN_MODES[mode][1] if 0 < mode < len(_SCAN_MODES) else ANS_TYPE_MEASUREMENT_CAPSULED)
+        elif cmd == CMD_GET_INFO:
+            # model, firmware minor, major, hardware, serial number
+            self._reply(ANS_TYPE_DEVINFO, bytes((0x2C, 32, 1, 6)) + b'RPLIDAR-EMULATOR')
+        elif cmd == CMD_GET_HEALTH:
+            self._reply(ANS_TYPE_DEVHEALTH, bytes((0, 0, 0)))
+        elif cmd == CMD_GET_SAMPLERATE:
+            us = 1e6 / (self.rate_hz * self.samples_per_scan)
+            self._reply(ANS_TYPE_SAMPLERATE, struct.pack('<HH', int(us), int(us / 2)))
+        elif cmd == CMD_GET_LIDAR_CONF:
+            self._lidar_conf(payload)
+        elif cmd == CMD_SET_PWM:
+            self.pwm = struct.unpack('<H', payload[:2])[0]
+        else:
+            logger.warning(f"Unknown command {cmd:#04x}")
+
+    def _read_commands(self):
+        try:
+            self._pending += os.read(self._master, 1024)
+        except (BlockingIOError, OSError):
+            return
+        while True:
+            sync = self._pending.find(SYNC_BYTE)
+            if sync < 0:
+                self._pending.clear()
+                return
+            del self._pending[:sync]
+            if len(self._pending) < 2:
+                return
+            cmd = self._pending[1]
+            if not cmd & 0x80:
+                del self._pending[:2]
+                self._command(cmd, b'')
+                continue
+            if len(self._pending) < 3 or len(self._pending) < 4 + self._pending[2]:
+                return
+            size = self._pending[2]
+            request = bytes(self._pending[:3 + size])
+            checksum = self._pending[3 + size]
+            del self._pending[:4 + size]
+            check = 0
+            for b in request:
+                check ^= b
+            if check != checksum:
+                logger.warning(f"Bad checksum on command {cmd:#04x}")
+                continue
+            self._command(cmd, request[3:])
+
+    def _revolution_bytes(self):
+        mode = [m for m in _SCAN_MODES if m[1] == self.scanning][0]
+        samples = self.samples_per_scan * mode[2]
+        samples -= samples % _CAPSULE_SAMPLES[self.scanning]
+        quality, angle, distance = self.scene.revolution(self.emulated_time, samples, self.rate_hz)
+        if self.scanning == ANS_TYPE_MEASUREMENT:
+            packets = _encode_measurements(quality, angle, distance)
+        else:
+            packets = _encode_capsules(angle, distance, self.scanning, self._first_capsule)
+            self._first_capsule = False
+        if self.corrupt_rate > 0:
+            corrupt = np.nonzero(self.scene.rng.random(len(packets)) < self.corrupt_rate)[0]
+            if self.scanning == ANS_TYPE_MEASUREMENT:
+                packets[corrupt, 1] &= 0xFE
+            else:
+                packets[corrupt, 4 + self.scene.rng.integers(0, 80, len(corrupt))] ^= 0xFF
+            self.packets_corrupted += len(corrupt)
+        return packets.tobytes()
+
+    def _every(self, interval):
+        """True on the revolution that starts each 'interval' seconds of emulated time."""
+        if interval <= 0:
+            return False
+        per = max(1, round(interval * self.rate_hz))
+        return self.revolutions > 0 and self.revolutions % per == 0
+
+    def run(self):
+        """Answer commands and stream scans until stop() is called."""
+        stalled_until = 0
+        next_revolution = time.perf_counter()
+        last_report = next_revolution
+        while not self._stop.is_set():
+            streaming = self.scanning is not None and self.pwm > 0
+            timeout = max(0.0, next_revolution - time.perf_counter()) if streaming else 0.1
+            if select.select([self._master], [], [], timeout)[0]:
+                self._read_commands()
+                continue
+            if not streaming:
+                next_revolution = time.perf_counter()
+                continue
+            if self._every(self.stall_every):
+                self.stalls += 1
+                stalled_until = self.revolutions + round(self.stall_seconds * self.rate_hz)
+                logger.info(f"Stalling for {self.stall_seconds} sec")
+            burst = 1
+            if self._every(self.overflow_every):
+                self.overflows += 1
+                burst = self.overflow_scans
+            for _ in range(burst):
+                if self.revolutions >= stalled_until:
+                    self._write(self._revolution_bytes())
+                    self.revolutions_sent += 1
+                self.revolutions += 1
+            next_revolution += 1.0 / (self.rate_hz * self.speed)
+            now = time.perf_counter()
+            if next_revolution < now - 1.0:
+                # The emulator itself fell behind; don't try to catch up
+                next_revolution = now
+            if now - last_report > 60.0:
+                last_report = now
+                logger.info(self.stats())
+
+    def stats(self):
+        return (f"emulated time: {self.emulated_time:.0f} sec; revolutions sent: {self.revolutions_sent}"
+                f"; packets corrupted: {self.packets_corrupted}; stalls: {self.stalls}; overflows: {self.overflows}"
+                f"; bytes dropped: {self.bytes_dropped}")
+
+    def start(self):
+        """Run the emulator in a thread, e.g. in the same process as the code under test."""
+        self._thread = threading.Thread(target=self.run, name='RPLidarEmulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        logger.info(self.stats())
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="RPLIDAR emulator on a pseudo-terminal.")
+    parser.add_argument("--link", default=None, help="Symlink to make to the pseudo-terminal, e.g. /tmp/rplidar")
+    parser.add_argument("--rate", type=float, default=14.2, help="Revolutions per second.")
+    parser.add_argument("--samples", type=int, default=400, help="Samples per revolution in the Standard mode.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Times faster than real-time.")
+    parser.add_argument("--period", type=float, default=2.0, help="Pendulum period (sec).")
+    parser.add_argument("--amplitude", type=float, default=50.0, help="Pendulum swing amplitude (mm).")
+    parser.add_argument("--bearing", type=float, default=90.0, help="Direction of the bob from the LIDAR (deg).")
+    parser.add_argument("--noise", type=float, default=1.0, help="Distance noise (mm).")
+    parser.add_argument("--dropout", type=float, default=0.01, help="Fraction of samples without a reading.")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Fraction of packets corrupted.")
+    parser.add_argument("--stall-every", type=float, default=0.0, help="Stall every N seconds (emulated).")
+    parser.add_argument("--stall", type=float, default=5.0, help="Length of a stall (sec).")
+    parser.add_argument("--overflow-every", type=float, default=0.0, help="Burst every N seconds (emulated).")
+    parser.add_argument("--overflow-scans", type=int, default=50, help="Scans sent in a burst.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    emulator = RPLidarEmulator(PendulumScene(period=args.period, amplitude_mm=args.amplitude,
+                                             bob_bearing_deg=args.bearing, noise_mm=args.noise,
+                                             dropout=args.dropout),
+                               rate_hz=args.rate, samples_per_scan=args.samples, speed=args.speed,
+                               corrupt_rate=args.corrupt, stall_every=args.stall_every, stall_seconds=args.stall,
+                               overflow_every=args.overflow_every, overflow_scans=args.overflow_scans,
+                               link=args.link)
+    print(f"RPLIDAR emulator on {emulator.port}" + (f" ({args.link})" if args.link else ""))
+    try:
+        emulator.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
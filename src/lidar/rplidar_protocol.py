@@ -0,0 +1,604 @@
+import abc
+import struct
+import time
+import logging
+import numpy as np
+import serial
+from rplidar import RPLidarException
+
+logger = logging.getLogger(__name__)
+
+# A decoder for the Slamtec RPLIDAR serial protocol (docs/LR001_SLAMTEC_rplidar_protocol_v2.1_en.pdf).
+#
+# The 'rplidar-roboticia' driver decodes one measurement at a time into a (quality, angle, distance) tuple and only
+# knows the legacy SCAN and legacy EXPRESS_SCAN responses. Here the serial port is read in large chunks and every
+# complete response packet in the chunk is decoded at once with NumPy into a preallocated structured array. The
+# express (capsuled), dense capsuled, and ultra capsuled (boost/sensitivity/stability) responses are supported so
+# that the higher sample rate scan modes can be used.
+#
+# RPLidarNative can be used in place of rplidar.RPLidar (see lidar.const.startup_lidar) and raises
+# RPLidarException so the error handling in run_scanner() is unchanged. Its scans are NumPy structured arrays
+# with the fields (quality, angle, distance), so scan[i] still reads as (quality, angle, distance).
+
+SYNC_BYTE = 0xA5
+SYNC_BYTE2 = 0x5A
+
+CMD_STOP = 0x25
+CMD_RESET = 0x40
+CMD_SCAN = 0x20
+CMD_EXPRESS_SCAN = 0x82
+CMD_FORCE_SCAN = 0x21
+CMD_GET_INFO = 0x50
+CMD_GET_HEALTH = 0x52
+CMD_GET_SAMPLERATE = 0x59
+CMD_GET_LIDAR_CONF = 0x84
+CMD_SET_PWM = 0xF0
+
+ANS_TYPE_DEVINFO = 0x04
+ANS_TYPE_DEVHEALTH = 0x06
+ANS_TYPE_SAMPLERATE = 0x15
+ANS_TYPE_GET_LIDAR_CONF = 0x20
+ANS_TYPE_MEASUREMENT = 0x81
+ANS_TYPE_MEASUREMENT_CAPSULED = 0x82
+ANS_TYPE_MEASUREMENT_CAPSULED_ULTRA = 0x84
+ANS_TYPE_MEASUREMENT_DENSE_CAPSULED = 0x85
+
+CONF_SCAN_MODE_COUNT = 0x70
+CONF_SCAN_MODE_US_PER_SAMPLE = 0x71
+CONF_SCAN_MODE_MAX_DISTANCE = 0x74
+CONF_SCAN_MODE_ANS_TYPE = 0x75
+CONF_SCAN_MODE_TYPICAL = 0x7C
+CONF_SCAN_MODE_NAME = 0x7F
+
+DESCRIPTOR_LEN = 7
+DEFAULT_MOTOR_PWM = 660
+MAX_MOTOR_PWM = 1023
+
+HEALTH_STATUSES = {0: 'Good', 1: 'Warning', 2: 'Error'}
+
+# The capsuled responses do not carry a quality, so samples with a distance are given the quality the legacy
+# SCAN response reports for a good reading.
+CAPSULE_QUALITY = 15
+
+SCAN_DTYPE = np.dtype([('quality', np.uint8), ('angle', np.float64), ('distance', np.float64)])
+
+
+def ignore_missing_modem_lines(serial_port):
+    """
+    A pseudo-terminal (see lidar.rplidar_emulator) has no DTR line, so switching the motor with DTR fails with
+    'Inappropriate ioctl for device'. When that is the case the DTR changes are ignored.
+    """
+    try:
+        serial_port.dtr = serial_port.dtr
+    except OSError:
+        logger.info(f"{serial_port.port} has no DTR line; the motor will not be switched with DTR")
+        serial_port._update_dtr_state = lambda: None
+
+
+def _angle_diff(start, next_start):
+    """AngleDiff(w_i, w_i+1) from the protocol; the angle covered by a capsule in degrees."""
+    return (next_start - start) % 360.0
+
+
+def _capsule_start_angles(packets):
+    return (packets[:, 2].astype(np.uint16) | ((packets[:, 3].astype(np.uint16) & 0x7F) << 8)) / 64.0
+
+
+def _capsule_valid(packets):
+    """Sync nibbles and the XOR checksum (of everything after the two sync bytes) of each capsule."""
+    sync = ((packets[:, 0] >> 4) == 0xA) & ((packets[:, 1] >> 4) == 0x5)
+    checksum = (packets[:, 0] & 0x0F) | ((packets[:, 1] & 0x0F) << 4)
+    return sync & (np.bitwise_xor.reduce(packets[:, 2:], axis=1) == checksum)
+
+
+class _MeasurementDecoder:
+    """Legacy SCAN response; 5 byte measurement nodes."""
+    packet_size = 5
+
+    def reset(self):
+        pass
+
+    @staticmethod
+    def valid(packets):
+        start = packets[:, 0] & 0x01
+        not_start = (packets[:, 0] >> 1) & 0x01
+        check = packets[:, 1] & 0x01
+        return (start != not_start) & (check == 1)
+
+    def decode(self, packets):
+        quality = packets[:, 0] >> 2
+        angle = ((packets[:, 1].astype(np.uint16) >> 1) | (packets[:, 2].astype(np.uint16) << 7)) / 64.0
+        distance = (packets[:, 3].astype(np.uint16) | (packets[:, 4].astype(np.uint16) << 8)) / 4.0
+        new_scan = (packets[:, 0] & 0x01).astype(bool)
+        return quality, angle, distance, new_scan
+
+
+class _CapsuleDecoder(abc.ABC):
+    """
+    Base for the capsuled EXPRESS_SCAN responses. The angles of the samples in a capsule can only be computed
+    with the start angle of the capsule that follows it, so the last capsule of each batch is held back.
+    """
+    packet_size = 84
+    samples = 32
+
+    def __init__(self):
+        self._previous = None
+        self._last_angle = -1.0
+
+    def reset(self):
+        self._previous = None
+
+    @staticmethod
+    def valid(packets):
+        return _capsule_valid(packets)
+
+    @abc.abstractmethod
+    def _distances_and_offsets(self, packets, next_packets):
+        """(distance mm, angle compensation in degrees) of each sample; both shaped (len(packets), samples)."""
+
+    def decode(self, packets):
+        # S set means that the LIDAR restarted its measurements, the capsule before it can't be used.
+        restart = np.nonzero(packets[:, 3] >> 7)[0]
+        if restart.size:
+            self._previous = None
+            packets = packets[restart[-1]:]
+        if self._previous is not None:
+            packets = np.concatenate((self._previous[np.newaxis, :], packets))
+        self._previous = packets[-1].copy()
+        if len(packets) < 2:
+            empty = np.empty(0)
+            return empty.astype(np.uint8), empty, empty, empty.astype(bool)
+
+        current, following = packets[:-1], packets[1:]
+        start = _capsule_start_angles(current)
+        step = _angle_diff(start, _capsule_start_angles(following)) / self.samples
+        raw_angle = start[:, np.newaxis] + step[:, np.newaxis] * np.arange(self.samples)
+        distance, offset = self._distances_and_offsets(current, following)
+
+        # A new scan starts at the sample whose (uncompensated) angle passes through 0. The samples before the
+        # first pass through 0 are not a full revolution so they are never flagged as a new scan.
+        raw_angle = raw_angle.ravel() % 360.0
+        new_scan = raw_angle < np.concatenate(([self._last_angle], raw_angle[:-1]))
+        self._last_angle = raw_angle[-1]
+        angle = (raw_angle - offset.ravel()) % 360.0
+        distance = distance.ravel()
+        quality = np.where(distance > 0, CAPSULE_QUALITY, 0).astype(np.uint8)
+        return quality, angle, distance, new_scan
+
+
+class _ExpressCapsuleDecoder(_CapsuleDecoder):
+    """Legacy EXPRESS_SCAN response; 16 cabins of 2 samples with an angle compensation (dθ) for each."""
+    packet_size = 84
+    samples = 32
+
+    def _distances_and_offsets(self, packets, next_packets):
+        cabins = packets[:, 4:84].reshape(-1, 16, 5).astype(np.uint16)
+        distance1 = (cabins[:, :, 0] >> 2) | (cabins[:, :, 1] << 6)
+        distance2 = (cabins[:, :, 2] >> 2) | (cabins[:, :, 3] << 6)
+        # dθ is q3 fixed point with a sign bit: bits 3:0 come from the last byte of the cabin and bit 4 and the
+        # sign from the low bits of the distance.
+        offset1 = ((cabins[:, :, 4] & 0x0F) | ((cabins[:, :, 0] & 0x01) << 4)) / 8.0
+        offset1 = np.where(cabins[:, :, 0] & 0x02, -offset1, offset1)
+        offset2 = ((cabins[:, :, 4] >> 4) | ((cabins[:, :, 2] & 0x01) << 4)) / 8.0
+        offset2 = np.where(cabins[:, :, 2] & 0x02, -offset2, offset2)
+        distance = np.stack((distance1, distance2), axis=2).reshape(len(packets), self.samples)
+        offset = np.stack((offset1, offset2), axis=2).reshape(len(packets), self.samples)
+        return distance.astype(np.float64), offset
+
+
+class _DenseCapsuleDecoder(_CapsuleDecoder):
+    """Dense EXPRESS_SCAN response; 40 distances in mm, no angle compensation."""
+    packet_size = 84
+    samples = 40
+
+    def _distances_and_offsets(self, packets, next_packets):
+        distance = np.ascontiguousarray(packets[:, 4:84]).view('<u2').astype(np.float64)
+        return distance, np.zeros_like(distance)
+
+
+# The varbit scale used by the ultra capsules; the bounds of the scaled value, the scale level, and the base of
+# the decoded value. See _varbitscale_decode in the public RPLIDAR SDK.
+_VBS_SCALED_BASE = np.array([3328, 1792, 1280, 512, 0])
+_VBS_SCALED_LVL = np.array([4, 3, 2, 1, 0])
+_VBS_TARGET_BASE = np.array([1 << 14, 1 << 12, 1 << 11, 1 << 9, 0])
+
+
+def _varbitscale_decode(scaled):
+    level_index = np.argmax(scaled[..., np.newaxis] >= _VBS_SCALED_BASE, axis=-1)
+    level = _VBS_SCALED_LVL[level_index]
+    return _VBS_TARGET_BASE[level_index] + ((scaled - _VBS_SCALED_BASE[level_index]) << level), level
+
+
+class _UltraCapsuleDecoder(_CapsuleDecoder):
+    """
+    Ultra capsuled EXPRESS_SCAN response (boost, sensitivity, and stability modes); 32 cabins of 32 bits each
+    holding one varbit encoded measurement and two 10 bit predictions. This follows the public RPLIDAR SDK since
+    the protocol document leaves the encoding to it.
+    """
+    packet_size = 132
+    samples = 96
+
+    def _distances_and_offsets(self, packets, next_packets):
+        combined = np.ascontiguousarray(packets[:, 4:132]).view('<u4').astype(np.int64)
+        next_major = np.ascontiguousarray(next_packets[:, 4:8]).view('<u4').astype(np.int64) & 0xFFF
+        major = combined & 0xFFF
+        major2 = np.concatenate((major[:, 1:], next_major), axis=1)
+        predict1 = (combined >> 12) & 0x3FF
+        predict1 = np.where(predict1 >= 0x200, predict1 - 0x400, predict1)
+        predict2 = (combined >> 22) & 0x3FF
+        predict2 = np.where(predict2 >= 0x200, predict2 - 0x400, predict2)
+
+        major, level1 = _varbitscale_decode(major)
+        major2, level2 = _varbitscale_decode(major2)
+        base1 = np.where((major == 0) & (major2 != 0), major2, major)
+        level1 = np.where((major == 0) & (major2 != 0), level2, level1)
+        invalid1 = (predict1 == -0x200) | (predict1 == 0x1FF)
+        invalid2 = (predict2 == -0x200) | (predict2 == 0x1FF)
+        distance = np.stack((major,
+                             np.where(invalid1, 0, predict1 * (1 << level1) + base1),
+                             np.where(invalid2, 0, predict2 * (1 << level2) + major2)),
+                            axis=2).reshape(len(packets), self.samples)
+
+        # Optical model of the angle offset of each sample (in q16 radians in the SDK).
+        dist_q2 = distance * 4
+        k2 = 98361 // np.maximum(dist_q2, 1)
+        offset_q16 = np.where(dist_q2 >= 50 * 4,
+                              int(8 * 3.1415926535 * (1 << 16) / 180) - (k2 << 6) - (k2 * k2 * k2) // 98304,
+                              int(7.5 * 3.1415926535 * (1 << 16) / 180))
+        offset = offset_q16 * 180.0 / 3.14159265 / (1 << 16)
+        return distance.astype(np.float64), offset
+
+
+_DECODERS = {
+    ANS_TYPE_MEASUREMENT: _MeasurementDecoder,
+    ANS_TYPE_MEASUREMENT_CAPSULED: _ExpressCapsuleDecoder,
+    ANS_TYPE_MEASUREMENT_DENSE_CAPSULED: _DenseCapsuleDecoder,
+    ANS_TYPE_MEASUREMENT_CAPSULED_ULTRA: _UltraCapsuleDecoder,
+}
+
+
+class ScanAssembler:
+    """
+    Collects decoded samples into a preallocated structured array and hands back a scan each time a new
+    revolution starts. Samples without a distance are dropped the same way rplidar.RPLidar.iter_scans does.
+    """
+
+    def __init__(self, max_buf_meas=8192, min_len=5):
+        self.buffer = np.zeros(max_buf_meas, dtype=SCAN_DTYPE)
+        self.count = 0
+        self.min_len = min_len
+        self.started = False
+        self.overflows = 0
+
+    def reset(self):
+        self.count = 0
+        self.started = False
+
+    def _append(self, quality, angle, distance):
+        keep = distance > 0
+        n = int(np.count_nonzero(keep))
+        if n == 0:
+            return
+        if self.count + n > len(self.buffer):
+            self.overflows += 1
+            n = len(self.buffer) - self.count
+            logger.warning(f"Scan has more than {len(self.buffer)} measurements; truncating it")
+        end = self.count + n
+        self.buffer['quality'][self.count:end] = quality[keep][:n]
+        self.buffer['angle'][self.count:end] = angle[keep][:n]
+        self.buffer['distance'][self.count:end] = distance[keep][:n]
+        self.count = end
+
+    def add(self, quality, angle, distance, new_scan):
+        """Add the decoded samples; returns the list of scans completed by them."""
+        scans = []
+        start = 0
+        for i in np.nonzero(new_scan)[0]:
+            if self.started:
+                self._append(quality[start:i], angle[start:i], distance[start:i])
+                if self.count >= self.min_len:
+                    scans.append(self.buffer[:self.count].copy())
+            self.started = True
+            self.count = 0
+            start = i
+        if self.started:
+            self._append(quality[start:], angle[start:], distance[start:])
+        return scans
+
+
+class RPLidarNative:
+    """
+    RPLIDAR driver with a NumPy protocol decoder. It has the methods of rplidar.RPLidar that are used in this
+    repository, plus scan mode support:
+        scan_mode: 'normal' (legacy SCAN), 'express' (legacy EXPRESS_SCAN), 'typical' (the LIDAR's recommended
+                   mode), or the name of one of the modes returned by get_scan_modes() such as 'Boost'.
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=1, logger=None, scan_mode='normal', chunk_size=1024):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.scan_mode = scan_mode
+        self.chunk_size = chunk_size
+        self._serial = None
+        self._motor_speed = DEFAULT_MOTOR_PWM
+        self.motor_running = None
+        self.scanning = False
+        self.bytes_discarded = 0
+        self.buffer_overflows = 0
+        self.connect()
+        self.start_motor()
+
+    def connect(self):
+        if self._serial is not None:
+            self.disconnect()
+        try:
+            self._serial = serial.Serial(self.port, self.baudrate, parity=serial.PARITY_NONE,
+                                         stopbits=serial.STOPBITS_ONE, timeout=self.timeout)
+        except serial.SerialException as err:
+            raise RPLidarException(f"Failed to connect to the sensor due to: {err}")
+        ignore_missing_modem_lines(self._serial)
+
+    def disconnect(self):
+        if self._serial is None:
+            return
+        self._serial.close()
+        self._serial = None
+
+    def _send_cmd(self, cmd):
+        self._serial.write(bytes((SYNC_BYTE, cmd)))
+        self.logger.debug(f"Command sent: {cmd:#04x}")
+
+    def _send_payload_cmd(self, cmd, payload):
+        request = bytes((SYNC_BYTE, cmd, len(payload))) + payload
+        checksum = 0
+        for b in request:
+            checksum ^= b
+        self._serial.write(request + bytes((checksum,)))
+        self.logger.debug(f"Command sent: {cmd:#04x} payload: {payload.hex()}")
+
+    def _read_descriptor(self):
+        descriptor = self._serial.read(DESCRIPTOR_LEN)
+        if len(descriptor) != DESCRIPTOR_LEN:
+            raise RPLidarException('Descriptor length mismatch')
+        if descriptor[0] != SYNC_BYTE or descriptor[1] != SYNC_BYTE2:
+            raise RPLidarException('Incorrect descriptor starting bytes')
+        size_and_mode = struct.unpack('<I', descriptor[2:6])[0]
+        is_single = (size_and_mode >> 30) == 0
+        return size_and_mode & 0x3FFFFFFF, is_single, descriptor[6]
+
+    def _read_response(self, size):
+        data = self._serial.read(size)
+        if len(data) != size:
+            raise RPLidarException('Wrong body size')
+        return data
+
+    def _single_request(self, cmd, ans_type, payload=None):
+        if payload is None:
+            self._send_cmd(cmd)
+        else:
+            self._send_payload_cmd(cmd, payload)
+        size, is_single, dtype = self._read_descriptor()
+        if not is_single:
+            raise RPLidarException('Not a single response mode')
+        if dtype != ans_type:
+            raise RPLidarException('Wrong response data type')
+        return self._read_response(size)
+
+    @property
+    def motor_speed(self):
+        return self._motor_speed
+
+    @motor_speed.setter
+    def motor_speed(self, pwm):
+        if not 0 <= pwm <= MAX_MOTOR_PWM:
+            raise RPLidarException(f"Motor PWM must be between 0 and {MAX_MOTOR_PWM}")
+        self._motor_speed = pwm
+        if self.motor_running:
+            self._set_pwm(pwm)
+
+    def _set_pwm(self, pwm):
+        self._send_payload_cmd(CMD_SET_PWM, struct.pack('<H', pwm))
+
+    def start_motor(self):
+        # For the A2 the DTR line enables the motor controller
+        self._serial.dtr = False
+        self._set_pwm(self._motor_speed)
+        self.motor_running = True
+
+    def stop_motor(self):
+        self._set_pwm(0)
+        time.sleep(.001)
+        self._serial.dtr = True
+        self.motor_running = False
+
+    def get_info(self):
+        if self._serial.in_waiting > 0:
+            raise RPLidarException('Data in buffer, you can\'t have info ! Run clean_input() to emptied the buffer.')
+        raw = self._single_request(CMD_GET_INFO, ANS_TYPE_DEVINFO)
+        return {
+            'model': raw[0],
+            'firmware': (raw[2], raw[1]),
+            'hardware': raw[3],
+            'serialnumber': raw[4:20].hex().upper(),
+        }
+
+    def get_health(self):
+        if self._serial.in_waiting > 0:
+            raise RPLidarException('Data in buffer, you can\'t have info ! Run clean_input() to emptied the buffer.')
+        raw = self._single_request(CMD_GET_HEALTH, ANS_TYPE_DEVHEALTH)
+        status = HEALTH_STATUSES.get(raw[0], str(raw[0]))
+        return status, raw[1] | (raw[2] << 8)
+
+    def get_samplerate(self):
+        """Microseconds per sample for the (standard, express) scans."""
+        raw = self._single_request(CMD_GET_SAMPLERATE, ANS_TYPE_SAMPLERATE)
+        return struct.unpack('<HH', raw)
+
+    def _get_lidar_conf(self, conf_type, payload=b''):
+        raw = self._single_request(CMD_GET_LIDAR_CONF, ANS_TYPE_GET_LIDAR_CONF,
+                                   struct.pack('<I', conf_type) + payload)
+        if len(raw) < 4 or struct.unpack('<I', raw[:4])[0] != conf_type:
+            raise RPLidarException('Wrong configuration entry in response')
+        return raw[4:]
+
+    def get_scan_modes(self):
+        """
+        The scan modes of the LIDAR (firmware 1.24 and later) as a list of dicts with the keys id, name,
+        us_per_sample, max_distance (m), ans_type, and typical.
+        """
+        count = struct.unpack('<H', self._get_lidar_conf(CONF_SCAN_MODE_COUNT)[:2])[0]
+        typical = struct.unpack('<H', self._get_lidar_conf(CONF_SCAN_MODE_TYPICAL)[:2])[0]
+        modes = []
+        for mode_id in range(count):
+            mode = struct.pack('<H', mode_id)
+            modes.append({
+                'id': mode_id,
+                'name': self._get_lidar_conf(CONF_SCAN_MODE_NAME, mode).split(b'\0')[0].decode('utf-8'),
+                'us_per_sample': struct.unpack('<I', self._get_lidar_conf(CONF_SCAN_MODE_US_PER_SAMPLE, mode)[:4])[0] / 256.0,
+                'max_distance': struct.unpack('<I', self._get_lidar_conf(CONF_SCAN_MODE_MAX_DISTANCE, mode)[:4])[0] / 256.0,
+                'ans_type': self._get_lidar_conf(CONF_SCAN_MODE_ANS_TYPE, mode)[0],
+                'typical': mode_id == typical,
+            })
+        return modes
+
+    def clean_input(self):
+        if self.scanning:
+            raise RPLidarException('Cleaning not allowed during scanning process active !')
+        self._serial.reset_input_buffer()
+
+    def stop(self):
+        self.logger.info('Stopping scanning')
+        self._send_cmd(CMD_STOP)
+        time.sleep(.1)
+        self.scanning = False
+        self.clean_input()
+
+    def reset(self):
+        self.logger.info('Resetting the sensor')
+        self._send_cmd(CMD_RESET)
+        time.sleep(2)
+        self.clean_input()
+
+    def _start_scan(self, scan_mode):
+        """Send the scan request for scan_mode and return the decoder for the response."""
+        status, error_code = self.get_health()
+        if status == HEALTH_STATUSES[2]:
+            self.logger.warning(f"Trying to reset sensor due to the error. Error code: {error_code}")
+            self.reset()
+            status, error_code = self.get_health()
+            if status == HEALTH_STATUSES[2]:
+                raise RPLidarException(f"RPLidar hardware failure. Error code: {error_code}")
+        elif status == HEALTH_STATUSES[1]:
+            self.logger.warning(f"Warning sensor status detected! Error code: {error_code}")
+
+        mode = str(scan_mode).lower()
+        if mode in ('normal', 'standard'):
+            self._send_cmd(CMD_SCAN)
+        elif mode == 'force':
+            self._send_cmd(CMD_FORCE_SCAN)
+        elif mode == 'express':
+            self._send_payload_cmd(CMD_EXPRESS_SCAN, bytes(5))
+        else:
+            modes = self.get_scan_modes()
+            if mode == 'typical':
+                selected = [m for m in modes if m['typical']]
+            else:
+                selected = [m for m in modes if m['name'].lower() == mode]
+            if not selected:
+                raise RPLidarException(f"Scan mode {scan_mode} is not supported; the LIDAR has: "
+                                       f"{', '.join(m['name'] for m in modes)}")
+            self.logger.info(f"Scan mode: {selected[0]}")
+            self._send_payload_cmd(CMD_EXPRESS_SCAN, bytes((selected[0]['id'], 0, 0, 0, 0)))
+        size, is_single, dtype = self._read_descriptor()
+        if is_single:
+            raise RPLidarException('Not a multiple response mode')
+        if dtype not in _DECODERS:
+            raise RPLidarException(f"Unsupported response data type {dtype:#04x}")
+        decoder = _DECODERS[dtype]()
+        if size != decoder.packet_size:
+            raise RPLidarException('Wrong response packet size')
+        self.scanning = True
+        return decoder
+
+    def _decode_buffer(self, decoder, data):
+        """
+        Decode every complete packet in 'data'. Packets that fail their checks are skipped a byte at a time
+        until the stream is back in sync. Returns (decoded samples or None, number of bytes used).
+        """
+        size = decoder.packet_size
+        used = 0
+        decoded = []
+        while len(data) - used >= size:
+            n = (len(data) - used) // size
+            packets = np.frombuffer(data, dtype=np.uint8, count=n * size, offset=used).reshape(n, size)
+            valid = decoder.valid(packets)
+            good = n if valid.all() else int(np.argmin(valid))
+            if good == 0:
+                used += 1
+                self.bytes_discarded += 1
+                decoder.reset()
+                continue
+            decoded.append(decoder.decode(packets[:good]))
+            used += good * size
+        if not decoded:
+            return None, used
+        if len(decoded) == 1:
+            return decoded[0], used
+        return tuple(np.concatenate(column) for column in zip(*decoded)), used
+
+    def iter_scans(self, scan_mode=None, max_buf_meas=8192, min_len=5):
+        """
+        Generator of scans; each is a NumPy structured array of SCAN_DTYPE (quality, angle, distance).
+        max_buf_meas is the most measurements kept for one scan. If the serial input backs up past
+        max_buf_meas measurements the input is cleaned so that the scans stay current.
+        """
+        if not self.motor_running:
+            self.start_motor()
+        decoder = self._start_scan(self.scan_mode if scan_mode is None else scan_mode)
+        assembler = ScanAssembler(max_buf_meas, min_len)
+        max_buf_bytes = max_buf_meas * decoder.packet_size
+        pending = bytearray()
+        while True:
+            waiting = self._serial.in_waiting
+            if waiting > max_buf_bytes:
+                self.buffer_overflows += 1
+                self.logger.warning(f"Too many bytes in the input buffer: {waiting}/{max_buf_bytes}. "
+                                    f"Cleaning buffer...")
+                self._serial.reset_input_buffer()
+                pending.clear()
+                decoder.reset()
+                assembler.reset()
+                continue
+            data = self._serial.read(max(waiting, self.chunk_size))
+            if not data:
+                raise RPLidarException('Timed out waiting for scan data')
+            pending += data
+            samples, used = self._decode_buffer(decoder, bytes(pending))
+            del pending[:used]
+            if samples is not None:
+                for scan in assembler.add(*samples):
+                    yield scan
+
+
+if __name__ == '__main__':
+    # Print the scan modes and a few scans...
+    import sys
+    port = sys.argv[1] if len(sys.argv) > 1 else '/dev/cu.SLAB_USBtoUART'
+    scan_mode = sys.argv[2] if len(sys.argv) > 2 else 'express'
+    lidar = RPLidarNative(port, 256000, scan_mode=scan_mode)
+    try:
+        print(f"Lidar Info: {lidar.get_info()}")
+        print(f"Lidar Health: {lidar.get_health()}")
+        for m in lidar.get_scan_modes():
+            print(f"Scan mode: {m}")
+        start = time.perf_counter()
+        for i, scan in enumerate(lidar.iter_scans()):
+            print(f"Scan {i}: {len(scan)} measurements; {(i + 1) / (time.perf_counter() - start):.1f} Hz")
+            if i >= 50:
+                break
+    finally:
+        lidar.stop()
+        lidar.stop_motor()
+        lidar.disconnect()
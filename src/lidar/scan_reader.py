@@ -0,0 +1,117 @@
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reading the serial port must never wait on the processing of the scans, otherwise the RPLIDAR's buffer overflows
+# and rplidar raises an RPLidarException (see the README). A ScanReader reads (and timestamps) the scans of a scan
+# source (see lidar.scan_source) in its own thread and only puts them on a bounded queue. When the queue is full
+# because the consumer fell behind one scan is dropped according to the drop policy:
+#   'drop_oldest' - drop the oldest scan in the queue so that the consumer always works on the most recent scans.
+#   'drop_newest' - drop the scan just read so that the consumer sees an uninterrupted run of older scans.
+#   'block'       - wait for the consumer; nothing is dropped. Use this when replaying a recording.
+# The number of scans dropped and the high-water mark of the queue are counted so that they can be reported with
+# the LIDAR readings rate; the counters are updated by the reader thread and taken by the consumer under a lock, so
+# no count is lost between taking them and resetting them.
+
+DROP_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+# Put on the queue after the last scan; an exception from the scan source is put on the queue and re-raised by
+# iter_scans() in the consumer.
+_END_OF_SCANS = object()
+
+
+class ScanReader:
+
+    def __init__(self, source, queue_size=64, drop_policy='drop_oldest'):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}; expected one of {DROP_POLICIES}")
+        self.source = source
+        self.drop_policy = drop_policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.scans_read = 0
+        self.scans_dropped = 0
+        self.high_water = 0
+        self._window_dropped = 0
+        self._window_high_water = 0
+        self._counters_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _put(self, item):
+        """Put 'item' on the queue even if it is full (unless the reader is being stopped)."""
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _read(self):
+        try:
+            for scan_with_time in self.source.iter_scans():
+                if self._stop.is_set():
+                    break
+                dropped = False
+                if self.drop_policy == 'block':
+                    self._put(scan_with_time)
+                else:
+                    try:
+                        self.queue.put_nowait(scan_with_time)
+                    except queue.Full:
+                        if self.drop_policy == 'drop_oldest':
+                            try:
+                                self.queue.get_nowait()
+                            except queue.Empty:
+                                pass
+                            self.queue.put_nowait(scan_with_time)
+                        dropped = True
+                depth = self.queue.qsize()
+                with self._counters_lock:
+                    self.scans_read += 1
+                    if dropped:
+                        self.scans_dropped += 1
+                        self._window_dropped += 1
+                    if depth > self._window_high_water:
+                        self._window_high_water = depth
+                        if depth > self.high_water:
+                            self.high_water = depth
+            self._put(_END_OF_SCANS)
+        except BaseException as e:
+            self._put(e)
+
+    def iter_scans(self):
+        """Generator over the (time, scan) read by the thread; raises any exception the scan source raised."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read, name='ScanReader', daemon=True)
+            self._thread.start()
+        while True:
+            item = self.queue.get()
+            if item is _END_OF_SCANS:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def take_window_counters(self):
+        """(scans dropped, queue high-water mark) since the last call."""
+        with self._counters_lock:
+            counters = self._window_dropped, self._window_high_water
+            self._window_dropped = 0
+            self._window_high_water = self.queue.qsize()
+        return counters
+
+    def get_health(self):
+        return self.source.get_health()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            # The serial read times out, so the thread will notice that it was stopped
+            self._thread.join(timeout=5)
+            if self._thread.is_alive():
+                logger.warning("The scan reader thread did not stop")
+        self.source.close()
+        logger.info(f"Scans read: {self.scans_read}; dropped: {self.scans_dropped}"
+                    f"; queue high-water mark: {self.high_water}")
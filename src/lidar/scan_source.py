@@ -0,0 +1,193 @@
+import pickle
+import time
+import logging
+from datetime import datetime
+from lidar.const import startup_lidar
+
+logger = logging.getLogger(__name__)
+
+# Scan sources all yield (time, scan) where 'time' is in seconds (time.perf_counter() when the scan was read) and
+# 'scan' is [(quality, angle, distance), ...] (a NumPy structured array of them with the native driver, see
+# lidar.rplidar_protocol). This allows run_scanner() to be driven by the LIDAR or by a
+# recording of the LIDAR so that the processing pipeline can be profiled and regression tested off the hardware.
+#
+# Each source also has a 'clock_offset': time.time() - time.perf_counter() of the clock its scan times are on, which
+# is what puts them on the wall clock. A recording keeps the offset of the LIDAR in its header (since version 2), so a
+# replay on another machine or after a reboot puts the scans at the wall clock times they were read at.
+
+RECORDING_FORMAT = 'lidar-scan-recording'
+RECORDING_VERSION = 2
+
+
+class LidarScanSource:
+    """Scans read from the RPLIDAR as it spins."""
+
+    def __init__(self, port, baud_rate, motor_rpm, rplidar_logger, driver='roboticia', scan_mode='normal'):
+        self.lidar = startup_lidar(port, baud_rate, motor_rpm, rplidar_logger, driver, scan_mode)
+        self.clock_offset = time.time() - time.perf_counter()
+
+    def iter_scans(self):
+        for scan in self.lidar.iter_scans():  # (quality, angle, distance)
+            # NOTE: While time.perf_counter() should be accurate to the submicrosecond (10^-6) level, when
+            # scan_with_time is printed we use millisecond accurate (10^-3).
+            yield time.perf_counter(), scan
+
+    def get_health(self):
+        return self.lidar.get_health()
+
+    def close(self):
+        self.lidar.stop()
+        self.lidar.stop_motor()
+        self.lidar.disconnect()
+
+
+class ScanRecorder:
+    """
+    Wraps another scan source and appends every timestamped scan that passes through it to 'path'.
+    The file is a stream of pickled records; the first is a header, the rest are (time, scan). The header has the
+    clock_offset of the source.
+    Recordings are appended to so that a LIDAR restart continues the same file.
+    """
+
+    def __init__(self, source, path, flush_every=150):
+        self.source = source
+        self.path = path
+        self.flush_every = flush_every
+        self.scans_recorded = 0
+        self.clock_offset = source.clock_offset
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            pickle.dump({'format': RECORDING_FORMAT, 'version': RECORDING_VERSION,
+                         'started': datetime.now().isoformat(), 'clock_offset': self.clock_offset},
+                        self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info(f"Recording scans to {path}")
+
+    def iter_scans(self):
+        for scan_with_time in self.source.iter_scans():
+            pickle.dump(scan_with_time, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.scans_recorded += 1
+            if self.scans_recorded % self.flush_every == 0:
+                self._file.flush()
+            yield scan_with_time
+
+    def get_health(self):
+        return self.source.get_health()
+
+    def close(self):
+        try:
+            self.source.close()
+        finally:
+            self._file.close()
+            logger.info(f"Recorded {self.scans_recorded} scans to {self.path}")
+
+
+def _read_header(f, path):
+    header = pickle.load(f)
+    if not isinstance(header, dict) or header.get('format') != RECORDING_FORMAT:
+        raise ValueError(f"{path} is not a scan recording")
+    return header
+
+
+def read_recording_header(path):
+    """The header of a file written by ScanRecorder."""
+    with open(path, 'rb') as f:
+        return _read_header(f, path)
+
+
+def read_recording(path):
+    """Generator over the (time, scan) records of a file written by ScanRecorder."""
+    with open(path, 'rb') as f:
+        _read_header(f, path)
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+            except pickle.UnpicklingError as e:
+                # The last record may have been cut short if the recorder was killed...
+                logger.warning(f"Truncated scan recording {path}: {e}")
+                return
+
+
+class ReplayScanSource:
+    """
+    Replays a file written by ScanRecorder.
+
+    speed: 1.0 replays in real-time, N replays N times faster than real-time, and 0 replays as fast as possible.
+    The recorded timestamps are passed on unchanged so that the pipeline computes the same results that it did
+    when the scans were recorded, and the clock_offset is the one they were recorded with.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.scans_replayed = 0
+        self.finished = False
+        self.clock_offset = read_recording_header(path).get('clock_offset')
+        if self.clock_offset is None:
+            # A version 1 recording; its scans are put on the wall clock as if they were read now
+            logger.warning(f"{path} has no clock offset; the wall clock times of its scans will be wrong")
+            self.clock_offset = time.time() - time.perf_counter()
+
+    def iter_scans(self):
+        wall_start = None
+        scan_start = None
+        for scan_time, scan in read_recording(self.path):
+            if self.speed > 0:
+                if wall_start is None:
+                    wall_start = time.perf_counter()
+                    scan_start = scan_time
+                delay = wall_start + (scan_time - scan_start) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.scans_replayed += 1
+            yield scan_time, scan
+        self.finished = True
+
+    def get_health(self):
+        return 'Replay', 0
+
+    def close(self):
+        logger.info(f"Replayed {self.scans_replayed} scans from {self.path}")
+
+
+def open_scan_source(mode, port, baud_rate, motor_rpm, rplidar_logger,
+                     record_file=None, replay_file=None, replay_speed=1.0, driver='roboticia', scan_mode='normal'):
+    """
+    Open the scan source for run_scanner().
+    mode: 'lidar' reads from the RPLIDAR with the given driver and scan_mode (see lidar.const.startup_lidar),
+          'replay' reads replay_file.
+    record_file: when given, every scan read from the source is also recorded there.
+    """
+    if mode == 'lidar':
+        source = LidarScanSource(port, baud_rate, motor_rpm, rplidar_logger, driver, scan_mode)
+    elif mode == 'replay':
+        if not replay_file:
+            raise ValueError("A REPLAY_FILE is needed to replay scans")
+        source = ReplayScanSource(replay_file, replay_speed)
+    else:
+        raise ValueError(f"Unknown scan source mode: {mode}")
+    if record_file:
+        source = ScanRecorder(source, record_file)
+    return source
+
+
+if __name__ == '__main__':
+    # Summarize a recording...
+    import sys
+    header = read_recording_header(sys.argv[1])
+    print(f"Version: {header.get('version')}; started: {header.get('started')}"
+          f"; clock offset: {header.get('clock_offset')}")
+    scans = 0
+    points = 0
+    first = last = None
+    for t, s in read_recording(sys.argv[1]):
+        if first is None:
+            first = t
+        last = t
+        scans += 1
+        points += len(s)
+    if scans:
+        duration = last - first
+        print(f"Scans: {scans}; points: {points}; duration: {duration:.1f} sec"
+              f"; {scans / duration if duration > 0 else 0.0:.1f} Hz; {points / scans:.1f} points/scan")
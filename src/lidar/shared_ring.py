@@ -0,0 +1,124 @@
+import logging
+import numpy as np
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+# A ring of fixed-layout records in shared memory. One process (run_scanner) writes records into the slots and the
+# pool workers read them by sequence number, so that only a small descriptor (spec, seq) is pickled for each task
+# rather than the scan or the window of points itself.
+#
+# Each slot holds up to max_rows rows of 'dtype' plus a header with the sequence number of the record in the
+# slot, its time, and its row count. A record is written to slot seq % slots. The writer marks the slot as
+# being written (seq -1) before it changes it and publishes the sequence number last, so a reader that sees the
+# same sequence number before and after it copies the rows knows the record was not overwritten underneath it.
+# The ring must have enough slots to cover the backlog of tasks in the pool; a record that was overwritten before
+# it was read is reported as lost (None).
+
+_HEADER_DTYPE = np.dtype([('seq', np.int64), ('time', np.float64), ('count', np.int64)])
+
+
+class SharedRing:
+
+    def __init__(self, dtype, slots, max_rows, name=None):
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.max_rows = max_rows
+        header_size = _HEADER_DTYPE.itemsize * slots
+        size = header_size + self.dtype.itemsize * slots * max_rows
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            try:
+                # Python 3.13+; the creating process is responsible for unlinking the memory
+                self._shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self.header = np.ndarray((slots,), dtype=_HEADER_DTYPE, buffer=self._shm.buf)
+        self.rows = np.ndarray((slots, max_rows), dtype=self.dtype, buffer=self._shm.buf, offset=header_size)
+        if self._owner:
+            self.header['seq'] = -1
+        self.truncated = 0
+
+    @property
+    def spec(self):
+        """What a worker needs to attach to the ring (see attach_ring)."""
+        return self.name, self.dtype.descr, self.slots, self.max_rows
+
+    def claim(self, seq):
+        """
+        Mark the slot of 'seq' as being written and return a view of its rows so that the writer can fill it in
+        place; publish() makes it readable.
+        """
+        slot = seq % self.slots
+        self.header['seq'][slot] = -1
+        return self.rows[slot]
+
+    def publish(self, seq, count, time=0.0):
+        slot = seq % self.slots
+        self.header['time'][slot] = time
+        self.header['count'][slot] = count
+        self.header['seq'][slot] = seq
+
+    def write(self, seq, rows, time=0.0):
+        """Copy 'rows' (an array of dtype or a list of tuples) into the slot of 'seq' and publish it."""
+        slot_rows = self.claim(seq)
+        count = len(rows)
+        if count > self.max_rows:
+            self.truncated += 1
+            logger.warning(f"Record {seq} has {count} rows; only {self.max_rows} fit in a slot")
+            count = self.max_rows
+            rows = rows[:count]
+        if isinstance(rows, np.ndarray):
+            slot_rows[:count] = rows
+        elif count:
+            slot_rows[:count] = np.array(rows, dtype=self.dtype)
+        self.publish(seq, count, time)
+
+    def read(self, seq):
+        """(time, copy of the rows) of the record 'seq', or None if it has been overwritten or is not published."""
+        slot = seq % self.slots
+        if self.header['seq'][slot] != seq:
+            return None
+        time = float(self.header['time'][slot])
+        rows = self.rows[slot, :self.header['count'][slot]].copy()
+        if self.header['seq'][slot] != seq:
+            return None
+        return time, rows
+
+    def close(self):
+        # The numpy views must be released before the shared memory can be closed
+        self.header = None
+        self.rows = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+_attached = {}
+
+
+def attach_ring(spec):
+    """Attach to a SharedRing given its spec; attachments are cached for the life of the (worker) process."""
+    ring = _attached.get(spec[0])
+    if ring is None:
+        name, descr, slots, max_rows = spec
+        ring = SharedRing(np.dtype([tuple(d) for d in descr]), slots, max_rows, name=name)
+        _attached[name] = ring
+    return ring
+
+
+if __name__ == '__main__':
+    # Example Usage:
+    from lidar.rplidar_protocol import SCAN_DTYPE
+    ring = SharedRing(SCAN_DTYPE, 4, 8)
+    try:
+        for seq in range(6):
+            ring.write(seq, [(15, float(seq), 100.0 + seq)] * 3, time=seq * 0.066)
+        print(f"spec: {ring.spec}")
+        print(f"seq 1 (overwritten): {ring.read(1)}")
+        print(f"seq 5: {attach_ring(ring.spec).read(5)}")
+    finally:
+        ring.close()
@@ -0,0 +1,158 @@
+import time
+import queue
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Runs the tasks of run_scanner() on a multiprocessing Pool without polling every pending AsyncResult.
+#
+# Each task is submitted with apply_async() and a completion callback that puts its result on a queue, so the main
+# loop only ever touches the tasks that have finished. Every kind of task has a deadline (seconds from being
+# submitted). The tasks of a kind are submitted in order with the same deadline, so only the oldest pending task of
+# each kind needs to be checked; finished tasks are removed from the front of the per-kind queues as they get there.
+# A Pool can't cancel one task or kill one worker, so when a task misses its deadline the Pool is terminated (which
+# kills the stuck worker) and replaced, and the tasks that were pending in it are cancelled. Results that arrive
+# from a terminated Pool are ignored.
+
+
+class TaskDispatcher:
+    """
+    deadlines: {kind: seconds}; kind is the name used to submit a task and report its completion.
+    error_handler: called (in the Pool's result thread) with the exception of a task that raised one.
+    The remaining arguments are passed to ctx.Pool().
+    """
+
+    def __init__(self, ctx, processes, deadlines, maxtasksperchild=None, initializer=None, initargs=(),
+                 error_handler=None):
+        self.ctx = ctx
+        self.processes = processes
+        self.deadlines = deadlines
+        self.maxtasksperchild = maxtasksperchild
+        self.initializer = initializer
+        self.initargs = initargs
+        self.error_handler = error_handler
+        self._completions = queue.SimpleQueue()
+        self._ready = deque()
+        # (token, tag, deadline) of the pending tasks of each kind in the order they were submitted
+        self._pending = {kind: deque() for kind in deadlines}
+        self._done = set()
+        self._token = 0
+        self._generation = 0
+        self.pending_count = 0
+        self.deadline_misses = 0
+        self.pool_recycles = 0
+        self.cancelled = 0
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        return self.ctx.Pool(processes=self.processes, maxtasksperchild=self.maxtasksperchild,
+                             initializer=self.initializer, initargs=self.initargs)
+
+    def submit(self, kind, func, args, tag=None):
+        """Submit func(*args); 'tag' is handed back with the result (e.g. a scan sequence number)."""
+        token = self._token
+        self._token += 1
+        generation = self._generation
+        submitted = time.perf_counter()
+        completions = self._completions
+
+        def done(value):
+            completions.put((generation, token, kind, tag, True, value, submitted))
+
+        def failed(e):
+            if self.error_handler is not None:
+                self.error_handler(e)
+            completions.put((generation, token, kind, tag, False, e, submitted))
+
+        self.pool.apply_async(func, args, callback=done, error_callback=failed)
+        self._pending[kind].append((token, tag, submitted + self.deadlines[kind]))
+        self.pending_count += 1
+        return token
+
+    def _accept(self, item):
+        if item[0] != self._generation:
+            return False
+        self._done.add(item[1])
+        self.pending_count -= 1
+        return True
+
+    def completed(self):
+        """
+        Generator over (kind, tag, ok, value, seconds from submit to complete) of the tasks that have finished
+        since the last call; it doesn't wait. 'value' is the exception when ok is False.
+        """
+        while True:
+            if self._ready:
+                item = self._ready.popleft()
+            else:
+                try:
+                    item = self._completions.get_nowait()
+                except queue.Empty:
+                    return
+                if not self._accept(item):
+                    continue
+            _, _, kind, tag, ok, value, submitted = item
+            yield kind, tag, ok, value, time.perf_counter() - submitted
+
+    def wait(self, timeout=None):
+        """Wait for a task to finish; it is returned by the next completed(). False if none finished in time."""
+        while True:
+            try:
+                item = self._completions.get(timeout=timeout)
+            except queue.Empty:
+                return False
+            if self._accept(item):
+                self._ready.append(item)
+                return True
+
+    def _trim(self, kind):
+        pending = self._pending[kind]
+        while pending and pending[0][0] in self._done:
+            self._done.discard(pending.popleft()[0])
+        return pending
+
+    def oldest(self, kind):
+        """The tag of the oldest pending task of 'kind', or None."""
+        pending = self._trim(kind)
+        return pending[0][1] if pending else None
+
+    def check_deadlines(self):
+        """Recycle the Pool if the oldest task of any kind missed its deadline; True if it was recycled."""
+        now = time.perf_counter()
+        for kind in self._pending:
+            pending = self._trim(kind)
+            if pending and pending[0][2] < now:
+                self.deadline_misses += 1
+                logger.error(f"{kind} {pending[0][1]} missed its deadline of {self.deadlines[kind]} sec"
+                             f"; recycling the pool and cancelling {self.pending_count} pending tasks")
+                self.recycle()
+                return True
+        return False
+
+    def recycle(self):
+        """Terminate the Pool (and any stuck worker in it), cancel its pending tasks, and start a new one."""
+        self.pool.terminate()
+        self.pool.join()
+        self._generation += 1
+        self.cancelled += self.pending_count
+        self.pending_count = 0
+        for pending in self._pending.values():
+            pending.clear()
+        self._done.clear()
+        self.pool_recycles += 1
+        self.pool = self._new_pool()
+
+    def close(self):
+        """Let the pending tasks finish (each within its deadline) and stop the Pool."""
+        self.pool.close()
+        while self.pending_count:
+            waits = [self._pending[kind][0][2] for kind in self._pending if self._trim(kind)]
+            if not waits:
+                break
+            remaining = min(waits) - time.perf_counter()
+            if remaining <= 0 or not self.wait(remaining):
+                logger.error(f"Terminating the pool with {self.pending_count} tasks pending")
+                break
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,382 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+import functools
+from multiprocessing.connection import Listener, Client, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Low overhead telemetry for run_scanner().
+#
+# The main loop only records values into fixed bucket histograms (a log2 and an increment). The subprocesses run
+# their tasks through @instrumented which sends a message when a task starts and ends, and a heartbeat thread in
+# each subprocess sends a heartbeat every HEARTBEAT_SECONDS. A Telemetry thread in the main process reads these
+# messages, flags workers that are stuck in a task or died in one, and every report_interval logs a summary
+# record (and serves the latest one as JSON on http://127.0.0.1:<metrics_port>/metrics when a port is given).
+#
+# Each subprocess sends its messages over a connection of its own to a Listener of the Telemetry (init_worker()
+# connects when the Pool starts the worker). The Pool is terminated when a task misses its deadline (see
+# TaskDispatcher.recycle()), which kills its workers wherever they are; a queue shared by the workers would be left
+# locked (or with half a message in it) by a worker killed while writing to it, which would stop every heartbeat. A
+# worker killed with a connection of its own only ends that connection, and the Telemetry thread sees it end.
+#
+# Everything runs in a thread of its own so that the summary keeps coming even when the main loop is not.
+
+HEARTBEAT_SECONDS = 5.0
+# Buckets per doubling of the histograms
+_BUCKETS_PER_OCTAVE = 4
+
+
+class Histogram:
+    """
+    Counts of values in logarithmic buckets from 'lowest' up; percentiles are approximate (to within a quarter
+    octave) while count, mean, standard deviation, and max are exact.
+    """
+
+    def __init__(self, lowest=1e-6, octaves=30):
+        self.lowest = lowest
+        self.size = octaves * _BUCKETS_PER_OCTAVE + 1
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value > self.lowest:
+            index = min(int(math.log2(value / self.lowest) * _BUCKETS_PER_OCTAVE) + 1, self.size - 1)
+        else:
+            index = 0
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """The upper edge of the bucket holding the q (0-100) percentile."""
+        target = self.count * q / 100.0
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(self.lowest * 2.0 ** (index / _BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+    def summary(self, scale=1.0):
+        if self.count == 0:
+            return {'count': 0}
+        mean = self.total / self.count
+        variance = max(self.total_sq / self.count - mean * mean, 0.0)
+        return {'count': self.count, 'mean': round(mean * scale, 3), 'std': round(math.sqrt(variance) * scale, 3),
+                'p50': round(self.percentile(50) * scale, 3), 'p99': round(self.percentile(99) * scale, 3),
+                'max': round(self.max * scale, 3)}
+
+
+# The subprocess side; set by init_worker() through the Pool initializer. The heartbeat thread and the tasks share
+# the connection, so a message is sent whole before the next one starts.
+_connection = None
+_send_lock = threading.Lock()
+
+
+def _send(message):
+    try:
+        with _send_lock:
+            _connection.send(message)
+    except OSError:
+        # The main process stopped listening
+        pass
+
+
+def _heartbeat():
+    pid = os.getpid()
+    while True:
+        _send(('beat', pid, time.time()))
+        time.sleep(HEARTBEAT_SECONDS)
+
+
+def init_worker(address, authkey):
+    """Pool initializer (initargs=Telemetry.worker_args); connects to the Telemetry and starts the heartbeat."""
+    global _connection
+    try:
+        _connection = Client(address, authkey=authkey)
+    except OSError as e:
+        logger.error(f"Unable to connect to the telemetry at {address}: {e}")
+        return
+    threading.Thread(target=_heartbeat, name='Heartbeat', daemon=True).start()
+
+
+def instrumented(func):
+    """Report the start and end of each call of a subprocess task to the Telemetry of the main process."""
+    kind = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _connection is None:
+            return func(*args, **kwargs)
+        pid = os.getpid()
+        start = time.time()
+        _send(('start', pid, start, kind))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _send(('end', pid, time.time(), kind, start))
+    return wrapper
+
+
+class _Worker:
+    __slots__ = ('last_seen', 'task', 'task_start', 'stuck')
+
+    def __init__(self, now):
+        self.last_seen = now
+        self.task = None
+        self.task_start = 0.0
+        self.stuck = False
+
+
+class Telemetry:
+    """
+    Pass init_worker and worker_args as the initializer and initargs of the Pool.
+    report_interval: seconds between summary records. stuck_seconds: a task running longer than this is reported.
+    metrics_port: serve the latest summary on this local port (0 to not serve it).
+    """
+
+    def __init__(self, report_interval=300.0, stuck_seconds=120.0, metrics_port=0):
+        self.authkey = os.urandom(32)
+        self.listener = Listener(authkey=self.authkey)
+        # The connection of each worker and its pid (None until its first message)
+        self._connections = {}
+        self._accepted = []
+        self._accepted_lock = threading.Lock()
+        self.report_interval = report_interval
+        self.stuck_seconds = stuck_seconds
+        self.metrics_port = metrics_port
+        # Main loop; times in seconds
+        self.scan_interarrival = Histogram()
+        self.results_depth = Histogram(lowest=1.0, octaves=20)
+        self.submit_to_complete = {}
+        # Telemetry thread
+        self.run_time = {}
+        self.workers = {}
+        self.gauges = {}
+        self.tasks_stuck = 0
+        self.workers_died = 0
+        self.last_summary = {}
+        self._last_scan = None
+        self._scans = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._accept_thread = None
+        self._server = None
+
+    @property
+    def worker_args(self):
+        """The initargs of init_worker()."""
+        return self.listener.address, self.authkey
+
+    # -- main loop --
+
+    def scan_arrived(self, scan_time):
+        if self._last_scan is not None:
+            self.scan_interarrival.record(scan_time - self._last_scan)
+        self._last_scan = scan_time
+        self._scans += 1
+
+    def task_completed(self, kind, seconds):
+        """A task of 'kind' completed 'seconds' after it was submitted."""
+        histogram = self.submit_to_complete.get(kind)
+        if histogram is None:
+            histogram = self.submit_to_complete[kind] = Histogram()
+        histogram.record(seconds)
+
+    def pending(self, depth):
+        self.results_depth.record(depth)
+
+    def add_gauge(self, name, value):
+        """Report value() (e.g. a counter of another component) in each summary."""
+        self.gauges[name] = value
+
+    # -- telemetry thread --
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                connection = self.listener.accept()
+            except OSError as e:
+                # Includes a client that fails the authentication
+                if self._stop.is_set():
+                    return
+                logger.warning(f"Telemetry connection refused: {e}")
+                continue
+            with self._accepted_lock:
+                self._accepted.append(connection)
+
+    def _closed(self, connection):
+        """The worker at the other end of 'connection' exited (or was terminated)."""
+        pid = self._connections.pop(connection)
+        connection.close()
+        worker = self.workers.pop(pid, None)
+        if worker is not None and worker.task is not None:
+            self.workers_died += 1
+            logger.error(f"Worker {pid} exited during {worker.task}"
+                         f" (started {time.time() - worker.task_start:.1f} sec ago); it died or was terminated")
+
+    def _drain(self, seconds=1.0):
+        """Read the messages from the subprocesses for up to 'seconds'."""
+        until = time.perf_counter() + seconds
+        while True:
+            with self._accepted_lock:
+                for connection in self._accepted:
+                    self._connections[connection] = None
+                self._accepted.clear()
+            timeout = until - time.perf_counter()
+            if timeout <= 0:
+                return
+            ready = wait(list(self._connections), timeout)
+            for connection in ready:
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    self._closed(connection)
+                    continue
+                self._connections[connection] = message[1]
+                self._message(message)
+
+    def _message(self, message):
+        pid, when = message[1], message[2]
+        worker = self.workers.get(pid)
+        if worker is None:
+            worker = self.workers[pid] = _Worker(when)
+        worker.last_seen = when
+        if message[0] == 'start':
+            worker.task, worker.task_start, worker.stuck = message[3], when, False
+        elif message[0] == 'end':
+            kind = message[3]
+            histogram = self.run_time.get(kind)
+            if histogram is None:
+                histogram = self.run_time[kind] = Histogram()
+            histogram.record(when - message[4])
+            if worker.stuck:
+                logger.warning(f"Worker {pid} finished {kind} after {when - message[4]:.1f} sec")
+            worker.task, worker.stuck = None, False
+
+    def _check_workers(self, now):
+        for pid, worker in list(self.workers.items()):
+            silent = now - worker.last_seen
+            if worker.task is None:
+                if silent > 3 * HEARTBEAT_SECONDS:
+                    # Recycled by the Pool (maxtasksperchild)
+                    del self.workers[pid]
+            elif silent > 3 * HEARTBEAT_SECONDS:
+                self.workers_died += 1
+                logger.error(f"Worker {pid} stopped sending heartbeats during {worker.task}"
+                             f" (started {now - worker.task_start:.1f} sec ago); it probably died")
+                del self.workers[pid]
+            elif not worker.stuck and now - worker.task_start > self.stuck_seconds:
+                worker.stuck = True
+                self.tasks_stuck += 1
+                logger.error(f"Worker {pid} has been running {worker.task} for {now - worker.task_start:.1f} sec")
+
+    def summary(self, interval):
+        now = time.time()
+        record = {
+            'time': now,
+            'interval_sec': round(interval, 1),
+            'scans': self._scans,
+            'scan_interarrival_ms': self.scan_interarrival.summary(1e3),
+            'results_depth': self.results_depth.summary(),
+            'workers': len(self.workers),
+            'workers_busy': sum(1 for w in self.workers.values() if w.task is not None),
+            'tasks_stuck': self.tasks_stuck,
+            'workers_died': self.workers_died,
+        }
+        for kind, histogram in list(self.submit_to_complete.items()):
+            record[f"{kind}_submit_to_complete_ms"] = histogram.summary(1e3)
+        for kind, histogram in list(self.run_time.items()):
+            record[f"{kind}_run_ms"] = histogram.summary(1e3)
+        for name, value in list(self.gauges.items()):
+            try:
+                record[name] = value()
+            except Exception as e:
+                record[name] = str(e)
+        return record
+
+    def _reset(self):
+        self._scans = 0
+        self.scan_interarrival.reset()
+        self.results_depth.reset()
+        for histogram in list(self.submit_to_complete.values()) + list(self.run_time.values()):
+            histogram.reset()
+
+    def _run(self):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            self._drain()
+            self._check_workers(time.time())
+            now = time.perf_counter()
+            if now - started >= self.report_interval:
+                self.last_summary = self.summary(now - started)
+                logger.warning(f"Telemetry: {json.dumps(self.last_summary)}")
+                self._reset()
+                started = now
+
+    def start(self):
+        self._accept_thread = threading.Thread(target=self._accept, name='TelemetryAccept', daemon=True)
+        self._accept_thread.start()
+        self._thread = threading.Thread(target=self._run, name='Telemetry', daemon=True)
+        self._thread.start()
+        if self.metrics_port:
+            self._server = _serve_metrics(self, self.metrics_port)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._accept_thread is not None:
+            # Wake the accept() so that the thread sees it was stopped
+            try:
+                Client(self.listener.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+            self._accept_thread.join(timeout=5)
+        self.listener.close()
+        for connection in list(self._connections) + self._accepted:
+            connection.close()
+
+
+def _serve_metrics(telemetry, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = json.dumps(telemetry.last_summary).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class MetricsServer(ThreadingHTTPServer):
+        # run_scanner() restarts with the LIDAR; don't wait for the port to time out
+        allow_reuse_address = True
+
+    server = MetricsServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    logger.warning(f"Telemetry metrics on http://127.0.0.1:{port}/metrics")
+    return server
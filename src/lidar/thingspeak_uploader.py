@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Posts the fields of the minute and hour processes to a ThingSpeak channel from a thread of the main process, so
+# that no pool worker is tied up waiting on the network or the rate limit (a free channel takes one update every 15
+# sec; see thingspeak_post() in Robotica/monitor_pendulum.py).
+#
+# submit() only puts the fields on a queue for the thread. The thread adds them to the last update that hasn't been
+# sent when it doesn't have any of those fields yet (the minute's fields 1-6 and 8 and the hour's field 7 become one
+# update), and otherwise starts a new update with its time (created_at). Once 'interval' has passed since the last
+# request one is made: a single update is sent to /update, and a backlog of them (after ThingSpeak or the network was
+# down) to /channels/<channel_id>/bulk_update.json, up to bulk_size updates at a time. A failed request (a "0"
+# response, an HTTP error, or no connection) is retried after a delay that doubles up to max_backoff; an update that
+# is rejected as bad (HTTP 400) is dropped.
+#
+# The updates that haven't been sent are kept in queue_file (JSON, replaced atomically) so they are sent after a
+# restart; only the thread touches the updates and the file while it runs, and stop() waits for it to finish the
+# request it is making before it saves what is left. The url is the ThingSpeak API, or a local stand-in server to try it out (see the example below).
+
+DEFAULT_URL = 'https://api.thingspeak.com'
+
+
+class ThingSpeakUploader:
+    """
+    write_api_key: of the channel. channel_id: needed to use the bulk update. queue_file: where the updates that
+    haven't been sent are kept; nowhere when empty. interval: seconds between requests. bulk_size: most updates in a
+    bulk update. max_backoff: longest delay (sec) after a failure. timeout: of each request (sec).
+    """
+
+    def __init__(self, write_api_key, channel_id='', queue_file='', url=DEFAULT_URL, interval=16.0, bulk_size=960,
+                 max_backoff=600.0, timeout=30.0):
+        self.write_api_key = write_api_key
+        self.channel_id = channel_id
+        self.queue_file = queue_file
+        self.url = url.rstrip('/')
+        self.interval = interval
+        self.bulk_size = bulk_size if channel_id else 1
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.updates = self._load()
+        self.sent = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_error = None
+        self._next_request = 0.0
+        self._backoff = interval
+        self._submitted = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _load(self):
+        if not self.queue_file or not os.path.exists(self.queue_file):
+            return []
+        try:
+            with open(self.queue_file) as f:
+                updates = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read the ThingSpeak queue {self.queue_file}: {e}")
+            return []
+        for update in updates:
+            # Written by a version that saved the updates being sent; they are sent again
+            update.pop('sending', None)
+        if updates:
+            logger.warning(f"ThingSpeak: {len(updates)} updates queued from before the restart")
+        return updates
+
+    def _save(self):
+        if not self.queue_file:
+            return
+        temp = self.queue_file + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump([{key: update[key] for key in ('created_at', 'fields')} for update in self.updates], f)
+            os.replace(temp, self.queue_file)
+        except OSError as e:
+            logger.error(f"Unable to write the ThingSpeak queue {self.queue_file}: {e}")
+
+    def submit(self, fields, when=None):
+        """Queue the fields ({'field1': value, ...}) of an update at 'when' (time.time(); now when None)."""
+        if fields:
+            self._submitted.put((time.time() if when is None else when, dict(fields)))
+
+    def _coalesce(self, when, fields):
+        last = self.updates[-1] if self.updates else None
+        if last is not None and not last.get('sending') and not fields.keys() & last['fields'].keys():
+            last['fields'].update(fields)
+            return
+        created_at = datetime.fromtimestamp(when, timezone.utc).isoformat(timespec='seconds')
+        self.updates.append({'created_at': created_at, 'fields': fields})
+
+    def _request(self, updates):
+        """Send the updates; True when they were accepted, False to retry them, None to drop them."""
+        try:
+            if len(updates) == 1:
+                data = {'api_key': self.write_api_key, 'created_at': updates[0]['created_at'], **updates[0]['fields']}
+                response = requests.post(f"{self.url}/update", data=data, timeout=self.timeout)
+                # The entry id of the update, or 0 when it wasn't accepted (usually the rate limit)
+                accepted = response.status_code == 200 and response.text.strip() not in ('', '0')
+            else:
+                body = {'write_api_key': self.write_api_key,
+                        'updates': [{'created_at': update['created_at'], **update['fields']} for update in updates]}
+                response = requests.post(f"{self.url}/channels/{self.channel_id}/bulk_update.json", json=body,
+                                         timeout=self.timeout)
+                accepted = response.status_code in (200, 202)
+        except requests.exceptions.RequestException as e:
+            self.last_error = f"connection failed: {e}"
+            return False
+        if accepted:
+            return True
+        self.last_error = f"status {response.status_code}: {response.text.strip()[:200]}"
+        return None if response.status_code == 400 else False
+
+    def _send(self):
+        updates = self.updates[:self.bulk_size]
+        for update in updates:
+            # Nothing more is added to an update once it has been sent
+            update['sending'] = True
+        result = self._request([{key: update[key] for key in ('created_at', 'fields')} for update in updates])
+        now = time.monotonic()
+        if result is False:
+            self.failures += 1
+            logger.error(f"ThingSpeak: {len(updates)} updates not sent ({self.last_error})"
+                         f"; retrying in {self._backoff:.0f} sec")
+            self._next_request = now + self._backoff
+            self._backoff = min(self._backoff * 2.0, self.max_backoff)
+            return
+        if result is None:
+            self.dropped += len(updates)
+            logger.error(f"ThingSpeak: {len(updates)} updates dropped ({self.last_error})")
+        else:
+            self.sent += len(updates)
+            logger.info(f"ThingSpeak: {len(updates)} updates sent")
+        del self.updates[:len(updates)]
+        self._save()
+        self._next_request = now + self.interval
+        self._backoff = self.interval
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            if self._stop.is_set():
+                # What was submitted after the last request is saved with the rest
+                while not self._submitted.empty():
+                    when, fields = self._submitted.get()
+                    if when is not None:
+                        self._coalesce(when, fields)
+                self._save()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            timeout = max(self._next_request - time.monotonic(), 0.0) if self.updates else None
+            try:
+                when, fields = self._submitted.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if when is None:
+                    break
+                self._coalesce(when, fields)
+                # Everything that was submitted together is coalesced before anything is sent
+                while not self._submitted.empty():
+                    when, fields = self._submitted.get()
+                    if when is None:
+                        self._stop.set()
+                        break
+                    self._coalesce(when, fields)
+                self._save()
+            if self.updates and not self._stop.is_set() and time.monotonic() >= self._next_request:
+                self._send()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ThingSpeakUploader', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the thread; what hasn't been sent stays in queue_file. The thread finishes the request it is making
+        (up to the request timeout) and saves the updates; 'timeout' (None waits for it) is how long to wait for that.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._submitted.put((None, None))
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("ThingSpeak: the uploader thread did not stop; it saves the updates when it does")
+            return
+        self._thread = None
+
+    def summary(self):
+        """Counters for the telemetry summary."""
+        return {'queued': len(self.updates), 'sent': self.sent, 'failures': self.failures, 'dropped': self.dropped,
+                'last_error': self.last_error}
+
+
+if __name__ == '__main__':
+    # Example Usage: a local stand-in for ThingSpeak that fails the first request
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StandIn(BaseHTTPRequestHandler):
+        requests_seen = 0
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+            StandIn.requests_seen += 1
+            print(f"{self.path}: {body}")
+            self.send_response(200 if StandIn.requests_seen > 1 else 500)
+            self.end_headers()
+            self.wfile.write(str(StandIn.requests_seen).encode())
+
+        def log_message(self, format, *args):
+            pass
+
+    logging.basicConfig(level=logging.INFO)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    uploader = ThingSpeakUploader('KEY', channel_id='1', url=f"http://127.0.0.1:{server.server_port}", interval=1.0)
+    uploader.start()
+    uploader.submit({'field1': 2.0001, 'field2': 4.3})
+    uploader.submit({'field7': 3.1})
+    time.sleep(0.5)
+    uploader.submit({'field1': 2.0002, 'field2': 8.6})
+    time.sleep(4.0)
+    uploader.stop()
+    print(uploader.summary())
+    server.shutdown()
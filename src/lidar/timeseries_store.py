@@ -0,0 +1,309 @@
+import os
+import json
+import queue
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# An append-only store of time series on the local disk, so that the scans, beats, and rollups are kept at full
+# resolution (ThingSpeak only takes 8 fields every 15 sec) for long term analysis, backfills, and dashboards.
+#
+# A series is a directory of segment files with the layout of its rows in schema.json. Each segment is a fixed size
+# file that is memory-mapped: a header with the number of rows in it followed by a column of segment_rows values for
+# each field of the dtype, so reading one field of a time range only touches the pages of that field. The first field
+# is the time (sec) and the rows must be appended in time order (rows before the last one are dropped); within a
+# segment the time column is sorted so a time range is found by binary search, and the segments are found from their
+# first and last times.
+#
+# There is one writer (run_scanner). An append copies the rows into the mapped columns and then publishes the new
+# row count in the header, as SharedRing publishes its sequence numbers, so a reader in another process (opened
+# with readonly=True) never sees a row that is half written and the writer never takes a lock or makes a system call
+# except to start a new segment. The pages are written to disk by the OS; flush() forces them out and a crash can
+# only lose the rows that weren't, never the earlier ones.
+#
+# Even so an append is a copy into pages that may have to be read in or a new segment to create, so run_scanner()
+# appends through a StoreWriter: append() only puts the rows on a bounded queue, and a thread of its own appends them
+# to the store in order. When the thread falls so far behind that the queue is full, the rows are dropped and counted
+# rather than holding up the caller.
+
+_MAGIC = b'TSSEG001'
+_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('capacity', np.int64), ('count', np.int64)])
+_HEADER_SIZE = 64
+_SCHEMA = 'schema.json'
+
+
+class _Segment:
+    """A memory-mapped segment file; 'columns' are views of the field columns."""
+
+    def __init__(self, path, dtype, capacity, create=False, readonly=False):
+        self.path = path
+        if create:
+            with open(path, 'wb') as f:
+                header = np.zeros(1, dtype=_HEADER_DTYPE)
+                header['magic'], header['capacity'] = _MAGIC, capacity
+                f.write(header.tobytes().ljust(_HEADER_SIZE, b'\0'))
+                # The rest of the file is sparse until it is written
+                f.truncate(_HEADER_SIZE + dtype.itemsize * capacity)
+        self.map = np.memmap(path, dtype=np.uint8, mode='r' if readonly else 'r+')
+        self.header = self.map[:_HEADER_DTYPE.itemsize].view(_HEADER_DTYPE)
+        if self.header['magic'][0] != _MAGIC or self.header['capacity'][0] != capacity:
+            raise ValueError(f"{path} is not a segment of {capacity} rows")
+        self.columns = {}
+        offset = _HEADER_SIZE
+        for name in dtype.names:
+            field = dtype.fields[name][0]
+            self.columns[name] = self.map[offset:offset + field.itemsize * capacity].view(field)
+            offset += field.itemsize * capacity
+
+    @property
+    def count(self):
+        return int(self.header['count'][0])
+
+    def close(self):
+        # The file is unmapped when the last view of it is released
+        self.columns = self.header = self.map = None
+
+
+class TimeSeries:
+    """
+    A series in 'path' (a directory). dtype: of its rows (the first field is the time); needed only to create it.
+    segment_rows: rows in each segment file. readonly: open it to read while another process appends to it.
+    """
+
+    def __init__(self, path, dtype=None, segment_rows=1 << 20, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        schema_path = os.path.join(path, _SCHEMA)
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                schema = json.load(f)
+            self.dtype = np.dtype([tuple(field) for field in schema['descr']])
+            self.segment_rows = schema['segment_rows']
+            if dtype is not None and np.dtype(dtype) != self.dtype:
+                raise ValueError(f"The series {path} has rows of {self.dtype}, not {np.dtype(dtype)}")
+        elif readonly or dtype is None:
+            raise FileNotFoundError(f"There is no series {path}")
+        else:
+            self.dtype = np.dtype(dtype)
+            # Whole cache lines of each column, so that every column is aligned
+            self.segment_rows = -(-segment_rows // 64) * 64
+            os.makedirs(path, exist_ok=True)
+            temp = schema_path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump({'descr': self.dtype.descr, 'segment_rows': self.segment_rows}, f)
+            os.replace(temp, schema_path)
+        self.time_field = self.dtype.names[0]
+        self.segments = []
+        self.dropped = 0
+        self._refresh()
+        self._last = self.last_time()
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f"{number:08d}.seg")
+
+    def _refresh(self):
+        """Map the segments that aren't mapped yet (a reader sees the ones the writer has started since)."""
+        number = len(self.segments)
+        while os.path.exists(self._segment_path(number)):
+            self.segments.append(_Segment(self._segment_path(number), self.dtype, self.segment_rows,
+                                          readonly=self.readonly))
+            number += 1
+
+    @property
+    def count(self):
+        return sum(segment.count for segment in self.segments)
+
+    def last_time(self):
+        """The time of the last row; None when there are none."""
+        for segment in reversed(self.segments):
+            if segment.count:
+                return float(segment.columns[self.time_field][segment.count - 1])
+        return None
+
+    def append(self, rows):
+        """Append 'rows' (an array of the series' dtype in time order); the ones before the last row are dropped."""
+        rows = np.asarray(rows, dtype=self.dtype)
+        if len(rows) == 0:
+            return
+        if self._last is not None and rows[self.time_field][0] < self._last:
+            late = np.count_nonzero(rows[self.time_field] < self._last)
+            if self.dropped == 0:
+                logger.warning(f"Dropped {late} rows before the last one of {self.path} at {self._last}")
+            self.dropped += late
+            rows = rows[rows[self.time_field] >= self._last]
+            if len(rows) == 0:
+                return
+        written = 0
+        while written < len(rows):
+            if not self.segments or self.segments[-1].count == self.segment_rows:
+                self.segments.append(_Segment(self._segment_path(len(self.segments)), self.dtype, self.segment_rows,
+                                              create=True))
+            segment = self.segments[-1]
+            count = segment.count
+            n = min(len(rows) - written, self.segment_rows - count)
+            for name, column in segment.columns.items():
+                column[count:count + n] = rows[name][written:written + n]
+            # Published after the rows are in place
+            segment.header['count'] = count + n
+            written += n
+        self._last = float(rows[self.time_field][-1])
+
+    def _ranges(self, start, end):
+        """(segment, first row, stop row) of the rows from start to (not including) end."""
+        if self.readonly:
+            self._refresh()
+        for segment in self.segments:
+            count = segment.count
+            if count == 0:
+                continue
+            times = segment.columns[self.time_field][:count]
+            if times[0] >= end or times[-1] < start:
+                continue
+            first = int(np.searchsorted(times, start, side='left'))
+            stop = int(np.searchsorted(times, end, side='left'))
+            if stop > first:
+                yield segment, first, stop
+
+    def read(self, start=-np.inf, end=np.inf, fields=None):
+        """
+        A copy of the rows with times from start to (not including) end, as an array of the series' dtype or of
+        only 'fields' (names).
+        """
+        names = list(fields) if fields is not None else list(self.dtype.names)
+        dtype = np.dtype([(name, self.dtype.fields[name][0]) for name in names])
+        parts = list(self._ranges(start, end))
+        rows = np.empty(sum(stop - first for _, first, stop in parts), dtype=dtype)
+        offset = 0
+        for segment, first, stop in parts:
+            for name in names:
+                rows[name][offset:offset + stop - first] = segment.columns[name][first:stop]
+            offset += stop - first
+        return rows
+
+    def flush(self):
+        if not self.readonly and self.segments:
+            self.segments[-1].map.flush()
+
+    def close(self):
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+class TimeSeriesStore:
+    """
+    The series in a directory, each in a subdirectory of its name. segment_rows: rows in each segment file of the
+    series it creates. readonly: see TimeSeries.
+    """
+
+    def __init__(self, root, segment_rows=1 << 20, readonly=False):
+        self.root = root
+        self.segment_rows = segment_rows
+        self.readonly = readonly
+        if not readonly:
+            os.makedirs(root, exist_ok=True)
+        self._series = {}
+
+    def names(self):
+        """The names of the series; none when the writer hasn't created the store yet."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, _SCHEMA)))
+
+    def series(self, name, dtype=None):
+        """The series 'name', created with rows of dtype if there isn't one."""
+        series = self._series.get(name)
+        if series is None:
+            series = TimeSeries(os.path.join(self.root, name), dtype, self.segment_rows, self.readonly)
+            self._series[name] = series
+        return series
+
+    def append(self, name, rows):
+        """Append rows to the series 'name', creating it with their dtype if there isn't one."""
+        self.series(name, np.asarray(rows).dtype).append(rows)
+
+    def read(self, name, start=-np.inf, end=np.inf, fields=None):
+        return self.series(name).read(start, end, fields)
+
+    def flush(self):
+        for series in self._series.values():
+            series.flush()
+
+    def close(self):
+        for series in self._series.values():
+            series.close()
+        self._series = {}
+
+
+class StoreWriter:
+    """
+    Appends to a TimeSeriesStore from a thread of its own. queue_size: batches of rows waiting to be appended.
+    """
+
+    def __init__(self, store, queue_size=1024):
+        self.store = store
+        self.written = 0
+        self.dropped = 0
+        self.last_error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def append(self, name, rows):
+        """Queue the rows (which must not be changed afterwards) to be appended to the series 'name'."""
+        try:
+            self._queue.put_nowait((name, rows))
+        except queue.Full:
+            if self.dropped == 0:
+                logger.error(f"The store writer is behind; dropping rows of {name}")
+            self.dropped += len(rows)
+
+    def _run(self):
+        while True:
+            name, rows = self._queue.get()
+            if name is None:
+                break
+            try:
+                self.store.append(name, rows)
+                self.written += len(rows)
+            except (OSError, ValueError) as e:
+                self.last_error = f"{name}: {e}"
+                logger.error(f"Unable to append {len(rows)} rows to {name}: {e}")
+        self.store.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='StoreWriter', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Append what is queued and stop the thread; the store is left open."""
+        if self._thread is None:
+            return
+        self._queue.put((None, None))
+        self._thread.join()
+        self._thread = None
+
+    def summary(self):
+        """Counters for the telemetry summary."""
+        return {'queued': self._queue.qsize(), 'written': self.written, 'dropped': self.dropped,
+                'last_error': self.last_error}
+
+
+if __name__ == '__main__':
+    # Example Usage:
+    import tempfile
+    from lidar.const import NANOS_FIRST_N_LAST_DTYPE
+    with tempfile.TemporaryDirectory() as root:
+        store = TimeSeriesStore(root, segment_rows=1000)
+        t = 1000.0 + np.arange(2500) / 14.2
+        edges = np.zeros(len(t), dtype=NANOS_FIRST_N_LAST_DTYPE)
+        edges['time'], edges['first'], edges['last'] = t, 100.0 * np.sin(np.pi * t), 100.0 * np.sin(np.pi * t) + 200.0
+        store.append('edges', edges)
+        reader = TimeSeriesStore(root, readonly=True)
+        print(f"series: {reader.names()}, segments: {len(reader.series('edges').segments)}")
+        print(f"1010 to 1011 sec: {reader.read('edges', 1010.0, 1011.0, fields=('time', 'first'))}")
+        reader.close()
+        store.close()